@@ -1,58 +1,239 @@
+import atexit
+import base64
+import bisect
+import fnmatch
+import functools
+import hashlib
+import io
 import json
+import mimetypes
+import multiprocessing
 import os
 import platform
+import posixpath
 import queue
 import re
 import shutil
+import signal
+import sqlite3
+import struct
 import subprocess
 import tempfile
 import threading
+import time
 import traceback
 import uuid
 import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
 from pathlib import Path, PurePosixPath
-from typing import Any, Dict, Optional
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import unquote, urlsplit
 
+import click
 from flask import (
     Flask,
     abort,
+    g,
     jsonify,
     redirect,
     render_template,
     request,
     send_file,
     session,
+    stream_with_context,
     url_for,
 )
+from flask.helpers import get_debug_flag
+from flask.wrappers import Request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
+from sqlalchemy import case, desc, event, func, inspect, or_, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import FileStorage
+from werkzeug.serving import is_running_from_reloader
 from werkzeug.utils import secure_filename
-import warnings
-from ebooklib import epub, ITEM_DOCUMENT, ITEM_STYLE
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
-from playwright.sync_api import sync_playwright
+from lxml import etree
+from playwright.sync_api import Error as PlaywrightError, Page, Route, TimeoutError as PlaywrightTimeoutError, sync_playwright
+from PIL import Image, ImageOps
+from pypdf import PdfWriter
+
+from epub_text import decode_bytes, resolve_resource, rewrite_document_batch
 
 BASE_DIR = Path(__file__).resolve().parent
 STORAGE_DIR = BASE_DIR / "storage"
 STORAGE_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR = BASE_DIR / "output"
 OUTPUT_DIR.mkdir(exist_ok=True)
+# Pseudo-origin under which book resources are served to Chromium from the archive.
+BOOK_ORIGIN = "http://epub.local/"
+BOOK_DOCUMENT = "__book__.html"
+
+class UploadInfo(NamedTuple):
+    size: int
+    sha256: str
+    is_epub: bool
+    seconds: float
+
+
+class IngestingFile:
+    """Upload spool file that hashes, sizes and keeps the zip head/tail as bytes arrive.
+
+    The retained head holds the first local header (the ``mimetype`` entry) and
+    the tail holds the end-of-central-directory record, so a well-formed EPUB
+    is validated without reading the spooled file again.
+    """
+
+    head_size = 256
+    tail_size = 1024 * 1024
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=directory, suffix=".upload", delete=False)
+        self.path = Path(self._file.name)
+        self.size = 0
+        self._started = time.perf_counter()
+        self._digest = hashlib.sha256()
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._digest.update(data)
+        self.size += len(data)
+        if len(self._head) < self.head_size:
+            self._head += data[: self.head_size - len(self._head)]
+        self._tail += data
+        if len(self._tail) > 2 * self.tail_size:
+            del self._tail[: -self.tail_size]
+        return self._file.write(data)
+
+    def finish(self) -> UploadInfo:
+        self._file.flush()
+        is_epub = _central_directory_is_epub(bytes(self._head), bytes(self._tail[-self.tail_size:]), self.size)
+        return UploadInfo(self.size, self._digest.hexdigest(), is_epub, time.perf_counter() - self._started)
+
+    def move_to(self, destination: Path) -> None:
+        self._file.close()
+        os.replace(self.path, destination)
+
+    def close(self) -> None:
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._file, name)
+
+
+def parse_stage_limits(value: str) -> Dict[str, float]:
+    """Parse ``"goto=180,pdf=900"`` into ``{"goto": 180.0, "pdf": 900.0}``."""
+    limits = {}
+    for item in value.split(","):
+        stage, _, seconds = item.partition("=")
+        if stage.strip() and seconds.strip():
+            limits[stage.strip()] = float(seconds)
+    return limits
+
+
+class IngestRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return IngestingFile(STORAGE_DIR / "incoming")
+
+
+def engine_options(database_url: str) -> Dict[str, Any]:
+    options: Dict[str, Any] = {
+        "pool_size": int(os.environ.get("EPUB_PDF_DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("EPUB_PDF_DB_MAX_OVERFLOW", "20")),
+        "pool_timeout": 30,
+    }
+    if database_url.startswith("sqlite"):
+        # Pooled SQLite connections move between request, render and heartbeat threads.
+        options["connect_args"] = {"check_same_thread": False}
+    else:
+        # Server connections can be dropped while idle; test them on checkout.
+        options["pool_pre_ping"] = True
+    return options
+
 
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+DATABASE_URL = os.environ.get("EPUB_PDF_DATABASE_URL", f"sqlite:///{BASE_DIR / 'epub_pdf.db'}")
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
+app.request_class = IngestRequest
 app.config.update(
     SECRET_KEY=os.environ.get("EPUB_PDF_SECRET", "epub-pdf-secret"),
-    SQLALCHEMY_DATABASE_URI=f"sqlite:///{BASE_DIR / 'epub_pdf.db'}",
+    SQLALCHEMY_DATABASE_URI=DATABASE_URL,
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    SQLALCHEMY_ENGINE_OPTIONS=engine_options(DATABASE_URL),
+    EPUB_PDF_SQLITE_JOURNAL_MODE=os.environ.get("EPUB_PDF_SQLITE_JOURNAL_MODE", "wal").lower(),
+    EPUB_PDF_SQLITE_BUSY_TIMEOUT_MS=int(os.environ.get("EPUB_PDF_SQLITE_BUSY_TIMEOUT_MS", "10000")),
+    EPUB_PDF_PROGRESS_MIN_SECONDS=float(os.environ.get("EPUB_PDF_PROGRESS_MIN_SECONDS", "1")),
+    EPUB_PDF_CANCEL_CHECK_SECONDS=float(os.environ.get("EPUB_PDF_CANCEL_CHECK_SECONDS", "0.5")),
+    EPUB_PDF_CANCEL_GRACE_SECONDS=float(os.environ.get("EPUB_PDF_CANCEL_GRACE_SECONDS", "5")),
+    EPUB_PDF_JOB_TIMEOUT_SECONDS=float(os.environ.get("EPUB_PDF_JOB_TIMEOUT_SECONDS", "0")),
+    EPUB_PDF_STAGE_TIMEOUTS=parse_stage_limits(os.environ.get("EPUB_PDF_STAGE_TIMEOUTS", "goto=180,pdf=900")),
+    EPUB_PDF_DEGRADED_CHUNK_KB=int(os.environ.get("EPUB_PDF_DEGRADED_CHUNK_KB", "1024")),
+    EPUB_PDF_READY_TIMEOUT_SECONDS=float(os.environ.get("EPUB_PDF_READY_TIMEOUT_SECONDS", "30")),
+    EPUB_PDF_ALLOWED_HOSTS=tuple(
+        host.strip().lower() for host in os.environ.get("EPUB_PDF_ALLOWED_HOSTS", "").split(",") if host.strip()
+    ),
     MAX_CONTENT_LENGTH=1024 * 1024 * 150,  # 150 MB upload limit
     EPUB_PDF_SYNC=os.environ.get("EPUB_PDF_SYNC", "").lower() in {"1", "true", "yes"},
+    EPUB_PDF_BROWSER_POOL_SIZE=int(os.environ.get("EPUB_PDF_BROWSER_POOL_SIZE", "2")),
+    EPUB_PDF_BROWSER_MAX_RENDERS=int(os.environ.get("EPUB_PDF_BROWSER_MAX_RENDERS", "50")),
+    EPUB_PDF_WORKERS=int(os.environ.get("EPUB_PDF_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    EPUB_PDF_WORKER_MEMORY_MB=int(os.environ.get("EPUB_PDF_WORKER_MEMORY_MB", "0")),
+    EPUB_PDF_CACHE_MAX_MB=int(os.environ.get("EPUB_PDF_CACHE_MAX_MB", "5120")),
+    EPUB_PDF_RESOURCE_MODE=os.environ.get("EPUB_PDF_RESOURCE_MODE", "zip").lower(),
+    EPUB_PDF_CHUNK_MAX_KB=int(os.environ.get("EPUB_PDF_CHUNK_MAX_KB", "8192")),
+    EPUB_PDF_CHUNK_DOCUMENTS=int(os.environ.get("EPUB_PDF_CHUNK_DOCUMENTS", "16")),
+    EPUB_PDF_IMAGE_THREADS=int(os.environ.get("EPUB_PDF_IMAGE_THREADS", str(min(4, os.cpu_count() or 1)))),
+    EPUB_PDF_IMAGE_CACHE_MAX_MB=int(os.environ.get("EPUB_PDF_IMAGE_CACHE_MAX_MB", "1024")),
+    EPUB_PDF_CSS_PRUNE=os.environ.get("EPUB_PDF_CSS_PRUNE", "1").lower() in {"1", "true", "yes"},
+    EPUB_PDF_RENDER_THREADS=int(os.environ.get("EPUB_PDF_RENDER_THREADS", "0")),
+    EPUB_PDF_FRAGMENT_CACHE_MAX_MB=int(os.environ.get("EPUB_PDF_FRAGMENT_CACHE_MAX_MB", "2048")),
+    EPUB_PDF_PREPROCESS_WORKERS=int(os.environ.get("EPUB_PDF_PREPROCESS_WORKERS", "0")),
+    EPUB_PDF_PREPROCESS_MIN_CHAPTERS=int(os.environ.get("EPUB_PDF_PREPROCESS_MIN_CHAPTERS", "200")),
+    EPUB_PDF_PREPROCESS_MAX_IN_FLIGHT=int(os.environ.get("EPUB_PDF_PREPROCESS_MAX_IN_FLIGHT", "256")),
+    EPUB_PDF_EVENTS_POLL_SECONDS=float(os.environ.get("EPUB_PDF_EVENTS_POLL_SECONDS", "1")),
+    EPUB_PDF_EVENTS_STREAM_SECONDS=float(os.environ.get("EPUB_PDF_EVENTS_STREAM_SECONDS", "30")),
+    EPUB_PDF_JOBS_PAGE_SIZE=int(os.environ.get("EPUB_PDF_JOBS_PAGE_SIZE", "50")),
+    EPUB_PDF_JOBS_PAGE_MAX=int(os.environ.get("EPUB_PDF_JOBS_PAGE_MAX", "500")),
+    EPUB_PDF_LEASE_SECONDS=int(os.environ.get("EPUB_PDF_LEASE_SECONDS", "60")),
+    EPUB_PDF_MAX_ATTEMPTS=int(os.environ.get("EPUB_PDF_MAX_ATTEMPTS", "3")),
+    EPUB_PDF_BULK_THRESHOLD=int(os.environ.get("EPUB_PDF_BULK_THRESHOLD", "3")),
+    EPUB_PDF_SMALL_BOOK_MB=float(os.environ.get("EPUB_PDF_SMALL_BOOK_MB", "5")),
+    EPUB_PDF_LARGE_BOOK_MB=float(os.environ.get("EPUB_PDF_LARGE_BOOK_MB", "50")),
+    EPUB_PDF_QUEUE_AGING_SECONDS=int(os.environ.get("EPUB_PDF_QUEUE_AGING_SECONDS", "600")),
+    EPUB_PDF_QUEUE_ESTIMATE_SECONDS=float(os.environ.get("EPUB_PDF_QUEUE_ESTIMATE_SECONDS", "5")),
+    EPUB_PDF_BATCH_MAX_FILES=int(os.environ.get("EPUB_PDF_BATCH_MAX_FILES", "500")),
 )
 
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record) -> None:
+    """WAL lets API reads proceed while a worker writes; the busy timeout makes
+    concurrent writers queue instead of failing with "database is locked".
+
+    Only SQLite connections are touched. WAL needs shared memory, so every
+    process using a SQLite database must run on the same host.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(app.config['EPUB_PDF_SQLITE_BUSY_TIMEOUT_MS'])}")
+    journal_mode = app.config["EPUB_PDF_SQLITE_JOURNAL_MODE"]
+    if re.fullmatch(r"[a-z]+", journal_mode):
+        cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+    if journal_mode == "wal":
+        # Durable at checkpoints rather than every commit; safe in WAL mode.
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+
 def utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
@@ -64,6 +245,83 @@ class JobStatus:
     FAILED = "failed"
     CANCELED = "canceled"
 
+    ALL = (QUEUED, PROCESSING, COMPLETED, FAILED, CANCELED)
+
+
+class JobPriority:
+    INTERACTIVE = 0
+    BULK = 1
+
+    NAMES = {"interactive": INTERACTIVE, "bulk": BULK}
+
+
+PAGE_SIZES_MM = {"A4": (210.0, 297.0), "Letter": (215.9, 279.4), "Legal": (215.9, 355.6)}
+
+
+class ImageProfile(NamedTuple):
+    dpi: int
+    quality: int
+
+
+# ``imageQuality`` setting -> target resolution and JPEG quality; ``original`` serves images untouched.
+IMAGE_PROFILES: Dict[str, Optional[ImageProfile]] = {
+    "original": None,
+    "high": ImageProfile(300, 90),
+    "standard": ImageProfile(150, 80),
+    "compact": ImageProfile(96, 65),
+}
+# Pillow format names Chromium can display; anything else is converted.
+BROWSER_IMAGE_FORMATS = {"JPEG", "PNG", "GIF", "WEBP", "BMP", "ICO"}
+
+
+class StageRecorder:
+    """Accumulates wall-clock seconds and byte counts per pipeline stage for one job.
+
+    Repeated stages (one per chunk, say) are summed; recording is thread-safe
+    because chunks render on several threads at once. ``on_stage`` is called
+    with the stage name whenever a stage starts.
+    """
+
+    def __init__(self, on_stage: Optional[Callable[[str], None]] = None):
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.on_stage = on_stage
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, Any]]:
+        if self.on_stage is not None:
+            self.on_stage(name)
+        info: Dict[str, Any] = {"bytes": None}
+        started = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.add(name, time.perf_counter() - started, info["bytes"])
+
+    def add(self, name: str, seconds: float, nbytes: Optional[int] = None) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "bytes": None})
+            entry["seconds"] += seconds
+            if nbytes is not None:
+                entry["bytes"] = (entry["bytes"] or 0) + nbytes
+
+    def timed(self, name: str, items: Iterable[str]) -> Iterator[str]:
+        """Re-yield ``items``, charging the time spent producing each one to ``name``."""
+        iterator = iter(items)
+        while True:
+            with self.stage(name) as info:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                info["bytes"] = len(item)
+            yield item
+
+    def persist(self, job_id: str) -> None:
+        for name, entry in self.stages.items():
+            db.session.add(JobStage(job_id=job_id, stage=name, seconds=entry["seconds"], bytes=entry["bytes"]))
+            count_stage_latency(name, entry["seconds"], entry["bytes"])
+
 
 class User(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -86,8 +344,53 @@ class Job(db.Model):
     updated_at = db.Column(db.DateTime, default=utc_now, onupdate=utc_now)
     completed_at = db.Column(db.DateTime)
     last_progress = db.Column(db.String(120))
+    content_hash = db.Column(db.String(64), index=True)
+    cache_key = db.Column(db.String(64), index=True)
+    # Set while the finished PDF exists, so listings never stat the filesystem.
+    pdf_size_bytes = db.Column(db.Integer)
+    # Seconds from upload to completion, kept so analytics can aggregate in SQL.
+    latency_seconds = db.Column(db.Float)
+    # Queue lease: the worker processing the job renews ``lease_expires_at``;
+    # once it lapses the job is handed to another worker.
+    lease_owner = db.Column(db.String(120))
+    lease_expires_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    # Set after the job hit a time or memory limit; the retry renders with
+    # the lighter degraded profile (see convert_to_pdf).
+    degraded = db.Column(db.Boolean, default=False)
+    # Scheduling class (JobPriority); queue order is decided by scheduled_queue().
+    priority = db.Column(db.Integer, default=JobPriority.INTERACTIVE)
+    # When a worker claimed the job; completed jobs keep their render time in
+    # ``service_seconds`` so queue ETAs can be estimated from recent history.
+    started_at = db.Column(db.DateTime)
+    service_seconds = db.Column(db.Float)
+    # Jobs submitted together through /api/batches or ``flask convert-dir``.
+    batch_id = db.Column(db.String(36), index=True)
 
     user = db.relationship("User", backref=db.backref("jobs", lazy=True))
+    stages = db.relationship("JobStage", lazy=True, cascade="all, delete-orphan")
+
+    __table_args__ = (
+        db.Index("ix_job_user_created", "user_id", "created_at"),
+        db.Index("ix_job_user_updated", "user_id", "updated_at"),
+        db.Index("ix_job_status_latency", "status", "latency_seconds"),
+        db.Index("ix_job_created", "created_at"),
+        db.Index("ix_job_status_created", "status", "created_at"),
+        db.Index("ix_job_completed", "completed_at"),
+    )
+
+    def mark_completed(self, at: datetime) -> None:
+        self.status = JobStatus.COMPLETED
+        self.completed_at = at
+        self.updated_at = at
+        # Unsaved jobs (cache hits) complete as they are created; rows read
+        # back from SQLite are naive UTC.
+        created = self.created_at or at
+        created = created if created.tzinfo else created.replace(tzinfo=timezone.utc)
+        self.latency_seconds = max((at - created).total_seconds(), 0.0)
+        if self.started_at is not None:
+            started = self.started_at if self.started_at.tzinfo else self.started_at.replace(tzinfo=timezone.utc)
+            self.service_seconds = max((at - started).total_seconds(), 0.0)
 
     @property
     def job_dir(self) -> Path:
@@ -107,50 +410,213 @@ class Job(db.Model):
     def settings(self) -> Dict[str, Any]:
         if not self.settings_json:
             return {}
-        try:
-            return json.loads(self.settings_json)
-        except json.JSONDecodeError:
-            return {}
+        return dict(_parse_settings_json(self.settings_json))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_settings_json(settings_json: str) -> Dict[str, Any]:
+    # Jobs share a handful of distinct settings, so listings parse each once.
+    try:
+        return json.loads(settings_json)
+    except json.JSONDecodeError:
+        return {}
+
+
+class JobStage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(36), db.ForeignKey("job.id"), nullable=False, index=True)
+    stage = db.Column(db.String(40), nullable=False, index=True)
+    seconds = db.Column(db.Float, nullable=False)
+    bytes = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=utc_now)
+
+
+class StageHistogram(db.Model):
+    """Running totals behind ``/metrics``: one row per stage and latency bucket.
+
+    ``bucket`` indexes ``STAGE_BUCKETS``; ``len(STAGE_BUCKETS)`` is the overflow.
+    Counts are per bucket, not cumulative.
+    """
 
+    stage = db.Column(db.String(40), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    seconds = db.Column(db.Float, nullable=False, default=0.0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+def count_stage_latency(stage: str, seconds: float, nbytes: Optional[int]) -> None:
+    """Add one stage timing to ``StageHistogram`` in the current transaction.
+
+    Runs on the session's connection so pending ORM changes are not flushed early.
+    """
+    table = StageHistogram.__table__
+    bucket = bisect.bisect_left(STAGE_BUCKETS, seconds)
+    increment = (
+        table.update()
+        .where(table.c.stage == stage, table.c.bucket == bucket)
+        .values(count=table.c.count + 1, seconds=table.c.seconds + seconds, bytes=table.c.bytes + (nbytes or 0))
+    )
+    conn = db.session.connection()
+    if conn.execute(increment).rowcount:
+        return
+    try:
+        with conn.begin_nested():
+            conn.execute(table.insert().values(stage=stage, bucket=bucket, count=1, seconds=seconds, bytes=nbytes or 0))
+    except IntegrityError:
+        # Another worker created the row first.
+        conn.execute(increment)
+
+
+class ConversionCache(db.Model):
+    """Index of rendered PDFs keyed on the EPUB content hash plus render settings."""
+
+    key = db.Column(db.String(64), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    settings_json = db.Column(db.Text)
+    pdf_filename = db.Column(db.String(255), nullable=False)
+    size_bytes = db.Column(db.Integer, default=0)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=utc_now)
+    last_used_at = db.Column(db.DateTime, default=utc_now, index=True)
+
+    @property
+    def pdf_path(self) -> Path:
+        return OUTPUT_DIR / self.pdf_filename
 
-with app.app_context():
+
+def ensure_schema() -> None:
+    """Create missing tables and add columns introduced since the database was created."""
+    new_tables = set(db.metadata.tables) - set(inspect(db.engine).get_table_names())
     db.create_all()
+    if StageHistogram.__tablename__ in new_tables:
+        backfill_stage_histogram()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        if not missing:
+            continue
+        with db.engine.begin() as conn:
+            for column in missing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+        if table.name == Job.__tablename__:
+            backfill_job_columns({column.name for column in missing})
+
+
+def backfill_stage_histogram() -> None:
+    """Roll stage timings recorded before ``StageHistogram`` existed into it."""
+    bucket = case(
+        *[(JobStage.seconds <= bound, index) for index, bound in enumerate(STAGE_BUCKETS)],
+        else_=len(STAGE_BUCKETS),
+    )
+    rows = (
+        db.session.query(
+            JobStage.stage,
+            bucket,
+            func.count(JobStage.id),
+            func.sum(JobStage.seconds),
+            func.coalesce(func.sum(JobStage.bytes), 0),
+        )
+        .group_by(JobStage.stage, bucket)
+        .all()
+    )
+    for stage, index, count, seconds, nbytes in rows:
+        db.session.add(StageHistogram(stage=stage, bucket=index, count=count, seconds=seconds, bytes=nbytes))
+    db.session.commit()
+
+
+def backfill_job_columns(added: set) -> None:
+    """Fill derived columns for jobs completed before those columns existed."""
+    if not added & {"pdf_size_bytes", "latency_seconds"}:
+        return
+    for job in Job.query.filter_by(status=JobStatus.COMPLETED).all():
+        if "pdf_size_bytes" in added:
+            try:
+                job.pdf_size_bytes = job.pdf_path.stat().st_size
+            except OSError:
+                job.pdf_size_bytes = None
+        if "latency_seconds" in added and job.completed_at and job.created_at:
+            job.latency_seconds = (job.completed_at - job.created_at).total_seconds()
+    db.session.commit()
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
 
-job_queue: "queue.Queue[str]" = queue.Queue()
-worker_thread: Optional[threading.Thread] = None
+def init_db() -> None:
+    """Run ``ensure_schema`` once per process.
+
+    Called by the CLI commands and before the web app's first request, never
+    at import: worker and preprocessing processes are spawned and import this
+    module, and must not race each other altering the shared database.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            with app.app_context():
+                ensure_schema()
+            _schema_ready = True
+
+
+worker_pool: Optional["WorkerPool"] = None
 _worker_lock = threading.Lock()
 
 
+# Endpoints that never look at the visitor's identity: probes and scrapers
+# hit these without cookies and must not touch the session or the user table.
+SESSIONLESS_ENDPOINTS = {"health", "metrics", "static"}
+
+
 @app.before_request
-def ensure_user():
-    get_current_user()
+def prepare_database():
+    init_db()
 
 
-def get_current_user() -> User:
+@app.before_request
+def load_user():
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
     user_id = session.get("user_id")
-    if user_id:
-        user = db.session.get(User, user_id)
-        if user:
-            return user
+    g.user = db.session.get(User, user_id) if user_id else None
+
+
+def get_current_user(create: bool = True) -> Optional[User]:
+    """The visitor's user, created on first use when ``create`` is set.
+
+    Read-only routes pass ``create=False`` so cookie-less requests never
+    write to the database.
+    """
+    user = g.get("user")
+    if user is not None or not create:
+        return user
     user = User(id=str(uuid.uuid4()))
     db.session.add(user)
     db.session.commit()
     session["user_id"] = user.id
+    g.user = user
     return user
 
 
 @app.route("/")
 def index():
-    user = get_current_user()
-    return render_template("index.html", display_name=user.display_name or "新用户")
+    user = get_current_user(create=False)
+    display_name = user.display_name if user else None
+    return render_template("index.html", display_name=display_name or "新用户")
 
 
 @app.route("/api/session", methods=["GET"])
 def api_session():
-    user = get_current_user()
+    user = get_current_user(create=False)
     return jsonify({
-        "userId": user.id,
-        "displayName": user.display_name,
+        "userId": user.id if user else None,
+        "displayName": user.display_name if user else None,
     })
 
 
@@ -166,13 +632,139 @@ def api_profile():
 
 @app.route("/api/jobs", methods=["GET"])
 def api_jobs():
-    user = get_current_user()
-    jobs = (
-        Job.query.filter_by(user_id=user.id)
-        .order_by(desc(Job.created_at))
+    """List a page of the user's jobs, optionally filtered by ``status`` or ``updatedSince``."""
+    user = get_current_user(create=False)
+    if user is None:
+        return jsonify({"jobs": [], "nextCursor": None, "counts": {status: 0 for status in JobStatus.ALL}})
+    limit = request.args.get("limit", type=int) or app.config["EPUB_PDF_JOBS_PAGE_SIZE"]
+    limit = max(1, min(limit, app.config["EPUB_PDF_JOBS_PAGE_MAX"]))
+
+    query = Job.query.filter(Job.user_id == user.id)
+    statuses = [status for status in request.args.get("status", "").split(",") if status]
+    if statuses:
+        unknown = set(statuses) - set(JobStatus.ALL)
+        if unknown:
+            abort(400, f"未知的任务状态: {', '.join(sorted(unknown))}")
+        query = query.filter(Job.status.in_(statuses))
+
+    since = request.args.get("updatedSince")
+    if since is not None:
+        since_at = parse_cursor(since)
+        if since_at is None:
+            abort(400, "updatedSince 参数无效")
+        query = query.filter(Job.updated_at > since_at)
+        order_column, descending = Job.updated_at, False
+    else:
+        order_column, descending = Job.created_at, True
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        position = decode_page_cursor(cursor)
+        if position is None:
+            abort(400, "cursor 参数无效")
+        at, job_id = position
+        if descending:
+            query = query.filter((order_column < at) | ((order_column == at) & (Job.id < job_id)))
+        else:
+            query = query.filter((order_column > at) | ((order_column == at) & (Job.id > job_id)))
+
+    if descending:
+        query = query.order_by(order_column.desc(), Job.id.desc())
+    else:
+        query = query.order_by(order_column, Job.id)
+    jobs = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        last = jobs[-1]
+        next_cursor = encode_page_cursor(last.updated_at if since is not None else last.created_at, last.id)
+
+    counts = dict(
+        db.session.query(Job.status, func.count(Job.id))
+        .filter(Job.user_id == user.id)
+        .group_by(Job.status)
         .all()
     )
-    return jsonify({"jobs": [serialize_job(job) for job in jobs]})
+    return jsonify({
+        "jobs": [serialize_job(job) for job in jobs],
+        "nextCursor": next_cursor,
+        "counts": {status: counts.get(status, 0) for status in JobStatus.ALL},
+    })
+
+
+def encode_page_cursor(at: datetime, job_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{at.isoformat()}|{job_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_page_cursor(cursor: str) -> Optional[Tuple[datetime, str]]:
+    try:
+        at, job_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except (ValueError, UnicodeError):
+        return None
+    parsed = parse_cursor(at)
+    return (parsed, job_id) if parsed else None
+
+
+@app.route("/api/jobs/events", methods=["GET"])
+def api_job_events():
+    """Server-sent events for jobs whose status or progress changed, resumable via ``Last-Event-ID``."""
+    user = get_current_user(create=False)
+    user_id = user.id if user else None
+    cursor = parse_cursor(request.headers.get("Last-Event-ID") or request.args.get("since")) or utc_now().replace(tzinfo=None)
+    poll_seconds = app.config["EPUB_PDF_EVENTS_POLL_SECONDS"]
+    deadline = time.monotonic() + app.config["EPUB_PDF_EVENTS_STREAM_SECONDS"]
+
+    def generate():
+        nonlocal cursor
+        positions: Dict[str, Optional[int]] = {}
+        yield "retry: 2000\n\n"
+        while time.monotonic() < deadline:
+            if user_id is None:
+                # Visitors without jobs have nothing to watch; keep the connection idle.
+                yield ": keep-alive\n\n"
+                time.sleep(poll_seconds)
+                continue
+            changed = (
+                Job.query.filter(Job.user_id == user_id, Job.updated_at > cursor)
+                .order_by(Job.updated_at)
+                .all()
+            )
+            g.pop("queue_estimates", None)
+            for job in changed:
+                cursor = job.updated_at
+                payload = serialize_job(job)
+                positions[job.id] = payload["queuePosition"]
+                yield f"id: {cursor.isoformat()}\nevent: job\ndata: {json.dumps(payload)}\n\n"
+            # Queued jobs move up as others finish without their own row
+            # changing; send those without an id so the cursor stays put.
+            waiting = [job_id for (job_id,) in db.session.query(Job.id).filter_by(user_id=user_id, status=JobStatus.QUEUED)]
+            moved = [job_id for job_id in waiting if positions.get(job_id) != queue_estimates().get(job_id, (None, None))[0]]
+            for job in Job.query.filter(Job.id.in_(moved)).all() if moved else []:
+                payload = serialize_job(job)
+                positions[job.id] = payload["queuePosition"]
+                yield f"event: job\ndata: {json.dumps(payload)}\n\n"
+            db.session.remove()
+            if not changed and not moved:
+                yield ": keep-alive\n\n"
+            time.sleep(poll_seconds)
+
+    response = app.response_class(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def parse_cursor(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        cursor = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if cursor.tzinfo is not None:
+        cursor = cursor.astimezone(timezone.utc).replace(tzinfo=None)
+    return cursor
 
 
 @app.route("/api/jobs", methods=["POST"])
@@ -184,40 +776,148 @@ def api_create_job():
 
     settings = parse_settings(request.form)
     force = parse_force(request.form)
-    original_name = file.filename or "upload.epub"
+    priority = parse_priority(request.form, user.id)
+    try:
+        job, skipped = submit_upload(user.id, file, settings, force, priority)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if skipped:
+        return jsonify({"job": serialize_job(job), "skipped": True}), 200
+
+    enqueue_job(job.id)
+
+    return jsonify({"job": serialize_job(job)}), 202
 
-    existing = (
-        Job.query.filter_by(user_id=user.id, original_filename=original_name, status=JobStatus.COMPLETED)
-        .order_by(desc(Job.completed_at))
-        .first()
-    )
 
-    if existing and existing.pdf_path.exists() and existing.settings() == settings and not force:
-        return jsonify({"job": serialize_job(existing), "skipped": True}), 200
+@app.route("/api/batches", methods=["POST"])
+def api_create_batch():
+    """Queue every EPUB in ``files``; ``.zip`` uploads are expanded into the EPUBs they contain.
+
+    Batch jobs default to bulk priority. Invalid books are reported under
+    ``rejected`` without failing the rest of the batch.
+    """
+    user = get_current_user()
+    uploads = request.files.getlist("files") + request.files.getlist("file")
+    if not uploads:
+        return jsonify({"error": "Missing file upload"}), 400
+
+    settings = parse_settings(request.form)
+    force = parse_force(request.form)
+    priority = JobPriority.NAMES.get((request.form.get("priority") or "").strip().lower(), JobPriority.BULK)
+    batch_id = str(uuid.uuid4())
+    max_files = app.config["EPUB_PDF_BATCH_MAX_FILES"]
+    jobs: List[Job] = []
+    rejected: List[Dict[str, str]] = []
+    skipped = 0
+    for filename, upload in iter_batch_uploads(uploads):
+        if upload is None:
+            rejected.append({"filename": filename, "error": "文件过大"})
+            continue
+        if len(jobs) >= max_files:
+            rejected.append({"filename": filename, "error": f"每个批次最多 {max_files} 本书"})
+            continue
+        try:
+            job, was_skipped = submit_upload(user.id, upload, settings, force, priority, batch_id)
+        except ValueError as exc:
+            rejected.append({"filename": filename, "error": str(exc)})
+            continue
+        jobs.append(job)
+        if was_skipped:
+            skipped += 1
+        else:
+            enqueue_job(job.id)
 
+    if not jobs:
+        return jsonify({"error": "批次中没有可转换的 EPUB", "rejected": rejected}), 400
+    return jsonify({
+        "batch": {
+            "id": batch_id,
+            "jobs": [serialize_job(job) for job in jobs],
+            "skipped": skipped,
+            "rejected": rejected,
+        }
+    }), 202
+
+
+@app.route("/api/batches/<batch_id>", methods=["GET"])
+def api_batch(batch_id):
+    user = get_current_user(create=False)
+    jobs = (
+        Job.query.filter_by(user_id=user.id, batch_id=batch_id).order_by(Job.created_at).all()
+        if user is not None
+        else []
+    )
+    if not jobs:
+        abort(404, "批次不存在")
+    counts = {status: 0 for status in JobStatus.ALL}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return jsonify({"batch": {"id": batch_id, "counts": counts, "jobs": [serialize_job(job) for job in jobs]}})
+
+
+def submit_upload(
+    user_id: str,
+    file: FileStorage,
+    settings: Dict[str, Any],
+    force: bool,
+    priority: int,
+    batch_id: Optional[str] = None,
+) -> Tuple[Job, bool]:
+    """Store one uploaded EPUB as a new queued job, or reuse an earlier conversion of it.
+
+    Returns the job and whether it was served from an earlier conversion, in
+    which case there is nothing to enqueue. Raises ``ValueError`` with a
+    user-facing message when the file is not a valid EPUB.
+    """
+    original_name = file.filename or "upload.epub"
     job = Job(
         id=str(uuid.uuid4()),
-        user_id=user.id,
+        user_id=user_id,
         original_filename=original_name,
         stored_filename="source.epub",
         status=JobStatus.QUEUED,
         settings_json=json.dumps(settings),
-        pdf_filename=build_output_filename(original_name),
+        priority=priority,
+        batch_id=batch_id,
     )
-    db.session.add(job)
 
     job_dir = job.job_dir
     source_path = job.source_path
-    file.stream.seek(0)
-    file.save(source_path)
-    job.size_bytes = source_path.stat().st_size
+    recorder = StageRecorder()
+    upload = ingest_upload(file, source_path)
+    recorder.add("upload", upload.seconds, upload.size)
+    job.size_bytes, job.content_hash = upload.size, upload.sha256
+    job.cache_key = build_cache_key(job.content_hash, settings)
+    # Every job of one book and settings shares the file named after its first upload.
+    entry = db.session.get(ConversionCache, job.cache_key)
+    job.pdf_filename = entry.pdf_filename if entry else build_output_filename(original_name, job.cache_key)
+
+    if not force:
+        # A batch lists only its own jobs, so it gets a new job sharing the cached PDF.
+        existing = None if batch_id else (
+            Job.query.filter_by(user_id=user_id, cache_key=job.cache_key, status=JobStatus.COMPLETED)
+            .order_by(desc(Job.completed_at))
+            .first()
+        )
+        if existing and existing.pdf_path.exists():
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return existing, True
+
+        if entry and entry.pdf_path.exists():
+            db.session.add(job)
+            attach_cached_pdf(job, entry)
+            db.session.commit()
+            return job, True
+
+    db.session.add(job)
 
     try:
-        ensure_epub_archive(source_path)
+        if not upload.is_epub:
+            with recorder.stage("validate"):
+                ensure_epub_archive(source_path)
     except ValueError as exc:
         shutil.rmtree(job_dir, ignore_errors=True)
         db.session.rollback()
-        message = f"{exc}" if exc.args else "Uploaded file is not a valid EPUB archive."
         app.logger.warning(
             "Upload rejected: not a valid EPUB archive (job_id=%s, filename=%s, size=%s, reason=%s)",
             job.id,
@@ -225,74 +925,128 @@ def api_create_job():
             job.size_bytes,
             exc,
         )
-        return jsonify({"error": message}), 400
+        raise ValueError(f"{exc}" if exc.args else "Uploaded file is not a valid EPUB archive.") from exc
 
+    recorder.persist(job.id)
     db.session.commit()
+    return job, False
 
-    enqueue_job(job.id)
 
-    return jsonify({"job": serialize_job(job)}), 202
+def iter_batch_uploads(uploads: List[FileStorage]) -> Iterator[Tuple[str, Optional[FileStorage]]]:
+    """Yield ``(filename, upload)`` per book, expanding ``.zip`` bundles of EPUBs.
+
+    Expanded bundle members count against ``MAX_CONTENT_LENGTH`` together, as
+    if they had been uploaded unpacked; members past that budget are yielded
+    with ``None`` instead of being extracted.
+    """
+    budget = app.config["MAX_CONTENT_LENGTH"]
+    for upload in uploads:
+        name = upload.filename or "upload.epub"
+        bundle = None
+        if name.lower().endswith(".zip"):
+            try:
+                bundle = zipfile.ZipFile(upload.stream)
+            except zipfile.BadZipFile:
+                bundle = None
+        if bundle is None or "META-INF/container.xml" in bundle.namelist():
+            yield name, upload
+            continue
+        with bundle:
+            for info in bundle.infolist():
+                member_name = PurePosixPath(info.filename).name
+                if info.is_dir() or not member_name.lower().endswith(".epub") or member_name.startswith("._"):
+                    continue
+                if info.file_size > budget:
+                    yield member_name, None
+                    continue
+                # zipfile stops reading a member at its declared size.
+                budget -= info.file_size
+                with bundle.open(info) as member:
+                    yield member_name, FileStorage(stream=member, filename=member_name)
 
 
 @app.route("/api/analytics", methods=["GET"])
 def api_analytics():
-    total = Job.query.count()
-    completed = Job.query.filter_by(status=JobStatus.COMPLETED).count()
-    failed = Job.query.filter_by(status=JobStatus.FAILED).count()
-    canceled = Job.query.filter_by(status=JobStatus.CANCELED).count()
-    in_queue = Job.query.filter(Job.status.in_([JobStatus.QUEUED, JobStatus.PROCESSING])).count()
-
-    completed_jobs = Job.query.filter_by(status=JobStatus.COMPLETED).all()
-    latencies = [
-        (job.completed_at - job.created_at).total_seconds()
-        for job in completed_jobs
-        if job.completed_at and job.created_at
-    ]
-    average_latency = sum(latencies) / len(latencies) if latencies else None
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    completed = counts.get(JobStatus.COMPLETED, 0)
+    failed = counts.get(JobStatus.FAILED, 0)
 
     success_denominator = completed + failed
     success_rate = (completed / success_denominator) if success_denominator else None
 
-    cutoff = utc_now() - timedelta(days=7)
-    recent_jobs = Job.query.filter(Job.created_at >= cutoff).all()
-    daily = {}
-    for job in recent_jobs:
-        date_key = (job.created_at.astimezone(timezone.utc).date() if job.created_at else utc_now().date())
-        bucket = daily.setdefault(str(date_key), {"completed": 0, "failed": 0, "total": 0})
-        bucket["total"] += 1
-        if job.status == JobStatus.COMPLETED:
-            bucket["completed"] += 1
-        elif job.status == JobStatus.FAILED:
-            bucket["failed"] += 1
+    latency = Job.query.filter(Job.status == JobStatus.COMPLETED, Job.latency_seconds.isnot(None))
+    average_latency = latency.with_entities(func.avg(Job.latency_seconds)).scalar()
+
+    cutoff = (utc_now() - timedelta(days=7)).replace(tzinfo=None)
+    day = func.date(Job.created_at)
+    daily = (
+        db.session.query(
+            day,
+            func.count(Job.id),
+            func.sum(case((Job.status == JobStatus.COMPLETED, 1), else_=0)),
+            func.sum(case((Job.status == JobStatus.FAILED, 1), else_=0)),
+        )
+        .filter(Job.created_at >= cutoff)
+        .group_by(day)
+        .order_by(day)
+        .all()
+    )
 
     return jsonify({
         "totals": {
-            "total": total,
+            "total": sum(counts.values()),
             "completed": completed,
             "failed": failed,
-            "canceled": canceled,
-            "queued": in_queue,
+            "canceled": counts.get(JobStatus.CANCELED, 0),
+            "queued": counts.get(JobStatus.QUEUED, 0) + counts.get(JobStatus.PROCESSING, 0),
         },
         "successRate": success_rate,
         "averageLatencySeconds": average_latency,
+        "latencyPercentilesSeconds": latency_percentiles(latency, (0.5, 0.9, 0.99)),
         "daily": [
-            {"date": date, **stats}
-            for date, stats in sorted(daily.items())
+            {"date": str(date), "total": total, "completed": int(done or 0), "failed": int(errored or 0)}
+            for date, total, done, errored in daily
         ],
     })
 
 
+def latency_percentiles(query, fractions: Iterable[float]) -> Dict[str, Optional[float]]:
+    """Nearest-rank percentiles of ``Job.latency_seconds``, one indexed seek each."""
+    count = query.count()
+    result: Dict[str, Optional[float]] = {}
+    for fraction in fractions:
+        key = f"p{fraction * 100:g}"
+        if not count:
+            result[key] = None
+            continue
+        offset = min(int(round(fraction * (count - 1))), count - 1)
+        result[key] = (
+            query.with_entities(Job.latency_seconds)
+            .order_by(Job.latency_seconds)
+            .offset(offset)
+            .limit(1)
+            .scalar()
+        )
+    return result
+
+
 @app.route("/api/jobs/<job_id>/retry", methods=["POST"])
 def api_retry_job(job_id):
     job = get_job_for_user(job_id)
     if job.status not in {JobStatus.FAILED, JobStatus.COMPLETED, JobStatus.CANCELED}:
         abort(409, "当前状态无法重试")
 
-    if job.pdf_path.exists():
-        job.pdf_path.unlink()
+    if not release_cached_pdf(job):
+        job.pdf_path.unlink(missing_ok=True)
+    job.pdf_size_bytes = None
     job.status = JobStatus.QUEUED
     job.error_message = None
     job.completed_at = None
+    job.latency_seconds = None
+    job.started_at = None
+    job.service_seconds = None
+    job.attempts = 0
+    job.degraded = False
     job.updated_at = utc_now()
     db.session.commit()
 
@@ -315,7 +1069,9 @@ def api_delete_job(job_id):
 
 @app.route("/api/jobs", methods=["DELETE"])
 def api_clear_jobs():
-    user = get_current_user()
+    user = get_current_user(create=False)
+    if user is None:
+        return jsonify({"success": True})
     jobs = Job.query.filter_by(user_id=user.id).all()
     for job in jobs:
         cleanup_job(job, commit=False)
@@ -345,19 +1101,101 @@ def api_reveal(job_id):
     return jsonify({"success": True})
 
 
+@app.route("/api/jobs/<job_id>/stages", methods=["GET"])
+def api_job_stages(job_id):
+    job = get_job_for_user(job_id)
+    stages = JobStage.query.filter_by(job_id=job.id).order_by(JobStage.id).all()
+    return jsonify({
+        "stages": [
+            {
+                "stage": stage.stage,
+                "seconds": stage.seconds,
+                "bytes": stage.bytes,
+                "recordedAt": stage.created_at.isoformat() if stage.created_at else None,
+            }
+            for stage in stages
+        ]
+    })
+
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of stage latency histograms and job counts."""
+    # stage -> [per-bucket counts..., total seconds, total bytes]
+    rows: Dict[str, List[float]] = {}
+    for entry in StageHistogram.query.order_by(StageHistogram.stage):
+        totals = rows.setdefault(entry.stage, [0] * (len(STAGE_BUCKETS) + 3))
+        totals[entry.bucket] += entry.count
+        totals[-2] += entry.seconds
+        totals[-1] += entry.bytes
+
+    lines = [
+        "# HELP epub_pdf_stage_seconds Time spent in each conversion stage per job.",
+        "# TYPE epub_pdf_stage_seconds histogram",
+    ]
+    for stage, totals in rows.items():
+        cumulative = 0
+        for bound, bucket_count in zip(STAGE_BUCKETS, totals):
+            cumulative += bucket_count
+            lines.append(f'epub_pdf_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        count = cumulative + totals[len(STAGE_BUCKETS)]
+        lines.append(f'epub_pdf_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'epub_pdf_stage_seconds_sum{{stage="{stage}"}} {totals[-2]}')
+        lines.append(f'epub_pdf_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    lines += [
+        "# HELP epub_pdf_stage_bytes_total Bytes processed by each conversion stage.",
+        "# TYPE epub_pdf_stage_bytes_total counter",
+    ]
+    for stage, totals in rows.items():
+        lines.append(f'epub_pdf_stage_bytes_total{{stage="{stage}"}} {totals[-1]}')
+
+    lines += [
+        "# HELP epub_pdf_jobs Jobs by status.",
+        "# TYPE epub_pdf_jobs gauge",
+    ]
+    for status, count in db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).order_by(Job.status):
+        lines.append(f'epub_pdf_jobs{{status="{status}"}} {count}')
+
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/health")
 def health():
     return {"status": "ok"}
 
 
 def get_job_for_user(job_id: str) -> Job:
-    user = get_current_user()
+    user = get_current_user(create=False)
     job = db.session.get(Job, job_id)
-    if not job or job.user_id != user.id:
+    if not job or user is None or job.user_id != user.id:
         abort(404)
     return job
 
 
+@app.cli.command("prune-users")
+@click.option("--older-than-days", type=int, default=30, show_default=True, help="Only remove users created before this.")
+def prune_users_command(older_than_days: int) -> None:
+    """Delete users that never created a job."""
+    init_db()
+    removed = prune_users(timedelta(days=older_than_days))
+    click.echo(f"Removed {removed} users without jobs")
+
+
+def prune_users(min_age: timedelta) -> int:
+    cutoff = (utc_now() - min_age).replace(tzinfo=None)
+    has_jobs = db.session.query(Job.id).filter(Job.user_id == User.id).exists()
+    removed = (
+        User.query.filter(User.created_at < cutoff, ~has_jobs)
+        .delete(synchronize_session=False)
+    )
+    db.session.commit()
+    return removed
+
+
 def parse_settings(form_data) -> Dict[str, Any]:
     settings: Dict[str, Any] = {}
     page_size = form_data.get("pageSize") or "A4"
@@ -373,6 +1211,11 @@ def parse_settings(form_data) -> Dict[str, Any]:
     except (TypeError, ValueError):
         margin_value = 15.0
     settings["marginMm"] = margin_value
+
+    image_quality = form_data.get("imageQuality") or "original"
+    if image_quality not in IMAGE_PROFILES:
+        image_quality = "original"
+    settings["imageQuality"] = image_quality
     return settings
 
 
@@ -381,10 +1224,118 @@ def parse_force(form_data) -> bool:
     return value in {"1", "true", "yes", "on"}
 
 
+def parse_priority(form_data, user_id: str) -> int:
+    """An explicit ``priority`` wins; otherwise uploads from a user who already
+    has ``EPUB_PDF_BULK_THRESHOLD`` jobs waiting are treated as bulk."""
+    value = (form_data.get("priority") or "").strip().lower()
+    if value in JobPriority.NAMES:
+        return JobPriority.NAMES[value]
+    waiting = Job.query.filter_by(user_id=user_id, status=JobStatus.QUEUED).count()
+    return JobPriority.BULK if waiting >= app.config["EPUB_PDF_BULK_THRESHOLD"] else JobPriority.INTERACTIVE
+
+
+def scheduled_queue(batch_id: Optional[str] = None):
+    """Queued job ids in claim order: interactive first, users taking turns, small books first.
+
+    ``EPUB_PDF_QUEUE_AGING_SECONDS`` bounds how long size and bulk penalties apply.
+    """
+    small = int(app.config["EPUB_PDF_SMALL_BOOK_MB"] * 1024 * 1024)
+    large = int(app.config["EPUB_PDF_LARGE_BOOK_MB"] * 1024 * 1024)
+    aged = Job.created_at < (utc_now() - timedelta(seconds=app.config["EPUB_PDF_QUEUE_AGING_SECONDS"])).replace(tzinfo=None)
+    size = func.coalesce(Job.size_bytes, 0)
+    priority = case((aged, JobPriority.INTERACTIVE), else_=func.coalesce(Job.priority, JobPriority.INTERACTIVE))
+    size_class = case((aged, 0), (size <= small, 0), (size <= large, 1), else_=2)
+
+    running = (
+        select(Job.user_id, func.count(Job.id).label("running"))
+        .where(Job.status == JobStatus.PROCESSING)
+        .group_by(Job.user_id)
+        .subquery()
+    )
+    turn = func.coalesce(running.c.running, 0) + func.row_number().over(
+        partition_by=(Job.user_id, priority), order_by=(size_class, Job.created_at)
+    )
+    queued = (
+        select(
+            Job.id,
+            priority.label("priority"),
+            turn.label("turn"),
+            size_class.label("size_class"),
+            Job.created_at,
+        )
+        .outerjoin(running, running.c.user_id == Job.user_id)
+        .where(Job.status == JobStatus.QUEUED)
+    )
+    if batch_id is not None:
+        queued = queued.where(Job.batch_id == batch_id)
+    queued = queued.subquery()
+    return select(queued.c.id).order_by(queued.c.priority, queued.c.turn, queued.c.size_class, queued.c.created_at)
+
+
+_queue_estimates_cache: Dict[str, Any] = {}
+_queue_estimates_lock = threading.Lock()
+
+
+def queue_estimates() -> Dict[str, Tuple[int, Optional[float]]]:
+    """Map each queued job id to its 1-based queue position and ETA in seconds.
+
+    Shared across requests; recomputed when ``queue_watermark`` changes or the result is stale.
+    """
+    if "queue_estimates" in g:
+        return g.queue_estimates
+    watermark = queue_watermark()
+    now = time.monotonic()
+    with _queue_estimates_lock:
+        cached = _queue_estimates_cache.get("latest")
+    if cached is not None and cached[0] == watermark and now - cached[1] < app.config["EPUB_PDF_QUEUE_ESTIMATE_SECONDS"]:
+        g.queue_estimates = cached[2]
+        return cached[2]
+    estimates = compute_queue_estimates()
+    with _queue_estimates_lock:
+        _queue_estimates_cache["latest"] = (watermark, now, estimates)
+    g.queue_estimates = estimates
+    return estimates
+
+
+def queue_watermark() -> Tuple[Any, ...]:
+    """Changes whenever a job enters or leaves the queue or starts or stops processing."""
+    rows = (
+        db.session.query(Job.status, func.count(Job.id), func.max(Job.updated_at))
+        .filter(Job.status.in_((JobStatus.QUEUED, JobStatus.PROCESSING)))
+        .group_by(Job.status)
+        .all()
+    )
+    # Processing rows are touched by every progress update; only their number matters.
+    return tuple(sorted((status, count, last if status == JobStatus.QUEUED else None) for status, count, last in rows))
+
+
+def compute_queue_estimates() -> Dict[str, Tuple[int, Optional[float]]]:
+    order = db.session.execute(scheduled_queue()).scalars().all()
+    estimates: Dict[str, Tuple[int, Optional[float]]] = {}
+    if order:
+        processing = Job.query.filter_by(status=JobStatus.PROCESSING).count()
+        capacity = max(processing, app.config["EPUB_PDF_WORKERS"], 1)
+        recent = (
+            select(Job.service_seconds)
+            .where(Job.service_seconds.isnot(None))
+            .order_by(desc(Job.completed_at))
+            .limit(100)
+            .subquery()
+        )
+        average = db.session.execute(select(func.avg(recent.c.service_seconds))).scalar()
+        for position, job_id in enumerate(order, start=1):
+            eta = round(((position - 1) // capacity + 1) * average, 1) if average is not None else None
+            estimates[job_id] = (position, eta)
+    return estimates
+
+
 def serialize_job(job: Job) -> Dict[str, Any]:
     download_url = None
-    if job.status == JobStatus.COMPLETED and job.pdf_path.exists():
+    if job.status == JobStatus.COMPLETED and job.pdf_size_bytes is not None:
         download_url = url_for("api_download", job_id=job.id)
+    position, eta = None, None
+    if job.status == JobStatus.QUEUED:
+        position, eta = queue_estimates().get(job.id, (None, None))
 
     return {
         "id": job.id,
@@ -395,96 +1346,930 @@ def serialize_job(job: Job) -> Dict[str, Any]:
         "updatedAt": (job.updated_at.isoformat() if job.updated_at else None),
         "completedAt": (job.completed_at.isoformat() if job.completed_at else None),
         "sizeBytes": job.size_bytes,
+        "pdfSizeBytes": job.pdf_size_bytes,
         "settings": job.settings(),
+        "progress": job.last_progress,
+        "degraded": bool(job.degraded),
+        "priority": "bulk" if job.priority == JobPriority.BULK else "interactive",
+        "queuePosition": position,
+        "etaSeconds": eta,
         "downloadUrl": download_url,
     }
 
 
 def enqueue_job(job_id: str) -> None:
+    """Hand a committed ``queued`` job to the local pool, or run it inline."""
     app.logger.info("Queueing job %s", job_id)
-    if app.config.get("EPUB_PDF_SYNC") or app.config.get("TESTING"):
+    if runs_inline():
         process_job(job_id)
-    else:
-        start_worker()
-        job_queue.put(job_id)
+        return
+    pool = start_worker()
+    if pool is not None:
+        pool.submit(job_id)
 
 
-def start_worker():
-    global worker_thread
+def runs_inline() -> bool:
+    return bool(app.config.get("EPUB_PDF_SYNC") or app.config.get("TESTING"))
+
+
+def start_worker() -> Optional["WorkerPool"]:
+    global worker_pool
     with _worker_lock:
-        if worker_thread and worker_thread.is_alive():
+        if worker_pool is None and app.config["EPUB_PDF_WORKERS"] > 0:
+            worker_pool = WorkerPool(
+                app.config["EPUB_PDF_WORKERS"],
+                app.config["EPUB_PDF_WORKER_MEMORY_MB"],
+            )
+            worker_pool.start()
+            atexit.register(worker_pool.shutdown)
+        return worker_pool
+
+
+def serves_web_requests() -> bool:
+    """Whether this process is the web server rather than a worker, CLI command or reloader watcher."""
+    # Spawned children import this module before ``parent_process()`` is set, but after their name is.
+    if multiprocessing.current_process().name != "MainProcess" or runs_inline():
+        return False
+    if __name__ == "__main__":
+        # ``app.run(debug=True)`` below serves from a reloader child.
+        return is_running_from_reloader()
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return True  # Imported by a WSGI server.
+    if ctx.info_name != "run":
+        return False
+    reload = ctx.params.get("reload")
+    if reload is None:
+        reload = get_debug_flag()
+    return not reload or is_running_from_reloader()
+
+
+class _WorkerHandle:
+    """A worker process plus the shared memory it reports its activity in.
+
+    ``clock`` holds the wall-clock start of the current job and of its latest
+    stage; ``current_stage`` the name of that stage.
+    """
+
+    def __init__(self, process, current_job, current_stage=None, clock=None):
+        self.process = process
+        self.current_job = current_job
+        self.current_stage = current_stage
+        self.clock = clock
+
+    @property
+    def job_id(self) -> Optional[str]:
+        value = self.current_job.value.decode("ascii", errors="ignore")
+        return value or None
+
+    @property
+    def stage(self) -> Optional[str]:
+        if self.current_stage is None:
+            return None
+        return self.current_stage.value.decode("ascii", errors="ignore") or None
+
+
+class WorkerPool:
+    """Spawned conversion processes that claim jobs from the database under renewed leases.
+
+    A supervisor thread respawns crashed workers and kills those over their limits or on canceled jobs.
+    """
+
+    poll_interval = 1.0
+
+    def __init__(self, size: int, memory_limit_mb: int = 0, batch_id: Optional[str] = None):
+        self.size = max(1, size)
+        self.memory_limit_bytes = max(0, memory_limit_mb) * 1024 * 1024
+        self.batch_id = batch_id
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queue = self._ctx.Queue()
+        self._shutdown_event = self._ctx.Event()
+        self._workers: List[_WorkerHandle] = []
+        self._stopping = threading.Event()
+        self._supervisor: Optional[threading.Thread] = None
+        self._canceled_since: Dict[str, float] = {}
+
+    def start(self) -> None:
+        recovered = recover_stale_jobs()
+        if recovered:
+            app.logger.warning("Recovered %s jobs with expired leases", recovered)
+        for _ in range(self.size):
+            self._workers.append(self._spawn())
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+    def submit(self, job_id: str) -> None:
+        """Wake an idle worker; the job itself is already queued in the database."""
+        self._queue.put(job_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._stopping.is_set():
             return
-        worker_thread = threading.Thread(target=worker_loop, daemon=True)
-        worker_thread.start()
+        self._stopping.set()
+        self._shutdown_event.set()
+        for worker in self._workers:
+            if wait:
+                worker.process.join()
+            elif worker.process.is_alive():
+                worker.process.terminate()
+
+    def _spawn(self) -> _WorkerHandle:
+        current_job = self._ctx.Array("c", 36, lock=False)
+        current_stage = self._ctx.Array("c", 32, lock=False)
+        clock = self._ctx.Array("d", 2, lock=False)
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(self._queue, self._shutdown_event, current_job, current_stage, clock, self.batch_id),
+            name="epub-pdf-worker",
+        )
+        process.start()
+        return _WorkerHandle(process, current_job, current_stage, clock)
+
+    def _supervise(self) -> None:
+        next_recovery = time.monotonic() + app.config["EPUB_PDF_LEASE_SECONDS"]
+        while not self._stopping.wait(self.poll_interval):
+            if time.monotonic() >= next_recovery:
+                next_recovery = time.monotonic() + app.config["EPUB_PDF_LEASE_SECONDS"]
+                recover_stale_jobs()
+            self._reap_canceled()
+            for index, worker in enumerate(self._workers):
+                reason = None
+                if not worker.process.is_alive():
+                    reason = f"转换进程意外退出 (exit code {worker.process.exitcode})"
+                else:
+                    reason = self._limit_exceeded(worker)
+                    if reason is not None:
+                        _kill_process_tree(worker.process.pid)
+                        worker.process.join()
+                if reason is None or self._stopping.is_set():
+                    continue
+                job_id = worker.job_id
+                app.logger.error("Worker %s stopped: %s (job_id=%s)", worker.process.pid, reason, job_id)
+                if job_id:
+                    retry_degraded_or_fail(job_id, reason)
+                self._workers[index] = self._spawn()
+
+    def _limit_exceeded(self, worker: _WorkerHandle) -> Optional[str]:
+        if self.memory_limit_bytes:
+            rss = _process_tree_rss(worker.process.pid)
+            if rss is not None and rss > self.memory_limit_bytes:
+                return f"转换进程内存超出限制 ({rss // (1024 * 1024)} MB)"
+        if worker.clock is None or not worker.job_id:
+            return None
+        now = time.time()
+        job_limit = app.config["EPUB_PDF_JOB_TIMEOUT_SECONDS"]
+        if job_limit and now - worker.clock[0] > job_limit:
+            return f"转换超时（超过 {job_limit:g} 秒）"
+        stage = worker.stage
+        stage_limit = app.config["EPUB_PDF_STAGE_TIMEOUTS"].get(stage or "")
+        if stage_limit and now - worker.clock[1] > stage_limit:
+            return f"{stage} 阶段超时（超过 {stage_limit:g} 秒）"
+        return None
+
+    def _reap_canceled(self) -> None:
+        running = {worker.job_id: index for index, worker in enumerate(self._workers) if worker.job_id}
+        canceled = canceled_job_ids(list(running)) if running else set()
+        now = time.monotonic()
+        self._canceled_since = {job_id: self._canceled_since.get(job_id, now) for job_id in canceled}
+        grace = app.config["EPUB_PDF_CANCEL_GRACE_SECONDS"]
+        for job_id, since in list(self._canceled_since.items()):
+            index = running[job_id]
+            worker = self._workers[index]
+            if now - since < grace or worker.job_id != job_id or self._stopping.is_set():
+                continue
+            app.logger.warning("Killing worker %s still running canceled job %s", worker.process.pid, job_id)
+            _kill_process_tree(worker.process.pid)
+            worker.process.join()
+            del self._canceled_since[job_id]
+            self._workers[index] = self._spawn()
 
 
-def worker_loop():
-    while True:
-        job_id = job_queue.get()
+def retry_degraded_or_fail(job_id: str, reason: str) -> None:
+    """Requeue a job that hit a limit with the degraded profile, or fail it if it already had it."""
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        if not job or job.status not in {JobStatus.QUEUED, JobStatus.PROCESSING}:
+            return
+        if job.degraded:
+            fail_job(job_id, reason)
+            return
+        app.logger.warning("Retrying job %s with the degraded profile: %s", job_id, reason)
+        job.degraded = True
+        job.status = JobStatus.QUEUED
+        job.error_message = f"{reason}，将以降级模式重试"
+        job.lease_owner = None
+        job.lease_expires_at = None
+        job.updated_at = utc_now()
+        db.session.commit()
+
+
+def canceled_job_ids(job_ids: List[str]) -> set:
+    with app.app_context():
+        rows = db.session.query(Job.id).filter(Job.id.in_(job_ids), Job.status == JobStatus.CANCELED)
+        return {job_id for (job_id,) in rows}
+
+
+# Set inside worker processes: the shared stage name and clock the
+# supervisor's watchdog reads.
+_worker_activity: Optional[Tuple[Any, Any]] = None
+
+
+def _worker_main(wakeups, shutdown_event, current_job, current_stage, clock, batch_id=None) -> None:
+    global _worker_activity
+    # Ctrl+C reaches the whole process group; let the parent decide when to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_activity = (current_stage, clock)
+    owner = worker_identity()
+    while not shutdown_event.is_set():
+        job_id = claim_next_job(owner, batch_id)
+        if job_id is None:
+            try:
+                wakeups.get(timeout=WorkerPool.poll_interval)
+            except queue.Empty:
+                pass
+            continue
+        clock[0] = clock[1] = time.time()
+        current_stage.value = b""
+        current_job.value = job_id.encode("ascii")
         try:
-            process_job(job_id)
+            process_job(job_id, lease_owner=owner)
         except Exception as exc:  # pragma: no cover - logged for debugging
             app.logger.exception("Job %s failed: %s", job_id, exc)
         finally:
-            job_queue.task_done()
+            current_job.value = b""
+    # Browsers live on the render threads; their drivers exit with this process.
+
+
+def note_worker_stage(stage: str) -> None:
+    """Tell the supervisor which stage this worker process just started."""
+    if _worker_activity is None:
+        return
+    current_stage, clock = _worker_activity
+    clock[1] = time.time()
+    current_stage.value = stage.encode("ascii", errors="ignore")[:31]
+
+
+def worker_identity() -> str:
+    return f"{platform.node()}:{os.getpid()}"
+
+
+def lease_deadline() -> datetime:
+    return (utc_now() + timedelta(seconds=app.config["EPUB_PDF_LEASE_SECONDS"])).replace(tzinfo=None)
+
+
+def claim_next_job(owner: str, batch_id: Optional[str] = None) -> Optional[str]:
+    """Atomically move the next scheduled job to ``processing`` under ``owner``'s lease.
+
+    The UPDATE only matches while the row is still queued, so when two
+    workers pick the same candidate exactly one of them wins; the other
+    tries the next one. With ``batch_id`` only jobs of that batch are claimed.
+    """
+    with app.app_context():
+        for _ in range(5):
+            candidate = db.session.execute(scheduled_queue(batch_id).limit(1)).scalar()
+            if candidate is None:
+                return None
+            claimed = db.session.execute(
+                update(Job)
+                .where(Job.id == candidate, Job.status == JobStatus.QUEUED)
+                .values(
+                    status=JobStatus.PROCESSING,
+                    error_message=None,
+                    last_progress=None,
+                    lease_owner=owner,
+                    lease_expires_at=lease_deadline(),
+                    attempts=func.coalesce(Job.attempts, 0) + 1,
+                    started_at=utc_now(),
+                    updated_at=utc_now(),
+                )
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return candidate
+    return None
+
+
+def recover_stale_jobs() -> int:
+    """Requeue ``processing`` jobs whose lease lapsed; fail those out of attempts.
+
+    Rows without a lease were left behind by a version without leases or by
+    an inline run that crashed, and are treated as expired.
+    """
+    now = utc_now().replace(tzinfo=None)
+    stale = (
+        Job.status == JobStatus.PROCESSING,
+        or_(Job.lease_expires_at.is_(None), Job.lease_expires_at < now),
+    )
+    exhausted = func.coalesce(Job.attempts, 0) >= app.config["EPUB_PDF_MAX_ATTEMPTS"]
+    with app.app_context():
+        with db.engine.begin() as conn:
+            failed = conn.execute(
+                update(Job)
+                .where(*stale, exhausted)
+                .values(
+                    status=JobStatus.FAILED,
+                    error_message="多次尝试后仍未完成转换",
+                    lease_owner=None,
+                    lease_expires_at=None,
+                    updated_at=utc_now(),
+                )
+            ).rowcount
+            requeued = conn.execute(
+                update(Job)
+                .where(*stale)
+                .values(status=JobStatus.QUEUED, lease_owner=None, lease_expires_at=None, updated_at=utc_now())
+            ).rowcount
+    return failed + requeued
+
+
+class LeaseHeartbeat:
+    """Renews a job's lease from a background thread while it is processed."""
+
+    def __init__(self, engine, job_id: str, owner: str, lease_seconds: int):
+        self._engine = engine
+        self._job_id = job_id
+        self._owner = owner
+        self._interval = max(lease_seconds / 3, 0.1)
+        self._lease = timedelta(seconds=lease_seconds)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"lease-{job_id}")
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            with self._engine.begin() as conn:
+                renewed = conn.execute(
+                    update(Job)
+                    .where(Job.id == self._job_id, Job.lease_owner == self._owner)
+                    .values(lease_expires_at=(utc_now() + self._lease).replace(tzinfo=None))
+                ).rowcount
+            if not renewed:
+                app.logger.warning("Lost lease on job %s", self._job_id)
+                return
+
+
+@app.cli.command("worker")
+@click.option("--workers", type=int, default=None, help="Worker processes (default: EPUB_PDF_WORKERS).")
+def worker_command(workers: Optional[int]) -> None:
+    """Run conversion workers in the foreground, claiming jobs from the database."""
+    init_db()
+    pool = WorkerPool(workers or app.config["EPUB_PDF_WORKERS"] or 1, app.config["EPUB_PDF_WORKER_MEMORY_MB"])
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    pool.start()
+    click.echo(f"{pool.size} workers running as {worker_identity()}; Ctrl+C to stop")
+    while not stop.wait(1):
+        pass
+    click.echo("Waiting for running jobs to finish…")
+    pool.shutdown()
+
+
+CLI_USER_ID = "cli"
+
+
+@app.cli.command("convert-dir")
+@click.argument("source", type=click.Path(exists=True, file_okay=False, path_type=Path), default=BASE_DIR / "convert")
+@click.option("--workers", type=int, default=None, help="Books converted in parallel (default: EPUB_PDF_WORKERS).")
+@click.option("--page-size", type=click.Choice(["A4", "Letter", "Legal"]), default="A4", show_default=True)
+@click.option("--margin", type=float, default=15.0, show_default=True, help="Page margin in mm.")
+@click.option("--image-quality", type=click.Choice(list(IMAGE_PROFILES)), default="original", show_default=True)
+@click.option("--force", is_flag=True, help="Convert again even if an identical conversion is cached.")
+def convert_dir_command(
+    source: Path, workers: Optional[int], page_size: str, margin: float, image_quality: str, force: bool
+) -> None:
+    """Convert every EPUB under SOURCE (default: ./convert) into OUTPUT_DIR."""
+    init_db()
+    started = time.perf_counter()
+    settings = {"pageSize": page_size, "marginMm": margin, "imageQuality": image_quality}
+    summary = convert_directory(source, workers or app.config["EPUB_PDF_WORKERS"] or 1, settings, force)
+    elapsed = time.perf_counter() - started
+    for job in summary["failed"]:
+        click.echo(f"FAILED  {job.original_filename}: {job.error_message}")
+    for job in summary["converted"] + summary["skipped"]:
+        click.echo(f"ok      {job.original_filename} -> {job.pdf_path}")
+    for filename, error in summary["rejected"]:
+        click.echo(f"REJECTED {filename}: {error}")
+    converted = summary["converted"]
+    megabytes = sum(job.size_bytes or 0 for job in converted) / (1024 * 1024)
+    total = len(converted) + len(summary["skipped"]) + len(summary["failed"]) + len(summary["rejected"])
+    click.echo(
+        f"{len(converted)} converted, {len(summary['skipped'])} skipped (cached), "
+        f"{len(summary['failed']) + len(summary['rejected'])} failed of {total} books in {elapsed:.1f}s; "
+        f"{len(converted) / elapsed * 60:.1f} books/min, {megabytes / elapsed:.2f} MB/s"
+    )
+
+
+def convert_directory(source: Path, workers: int, settings: Dict[str, Any], force: bool) -> Dict[str, Any]:
+    """Queue every EPUB under ``source`` as one batch and convert it on a pool of its own."""
+    if db.session.get(User, CLI_USER_ID) is None:
+        db.session.add(User(id=CLI_USER_ID, display_name="convert-dir"))
+        db.session.commit()
+    batch_id = str(uuid.uuid4())
+    summary: Dict[str, Any] = {"batch_id": batch_id, "converted": [], "skipped": [], "failed": [], "rejected": []}
+    queued: List[str] = []
+    for path in iter_epub_sources(source):
+        try:
+            with open_epub_source(path) as stream:
+                upload = FileStorage(stream=stream, filename=path.name)
+                job, skipped = submit_upload(CLI_USER_ID, upload, settings, force, JobPriority.BULK, batch_id)
+        except (OSError, ValueError) as exc:
+            summary["rejected"].append((str(path.relative_to(source)), str(exc)))
+            continue
+        if skipped:
+            summary["skipped"].append(job)
+        else:
+            queued.append(job.id)
+
+    if queued and runs_inline():
+        for job_id in queued:
+            process_job(job_id)
+    elif queued:
+        pool = WorkerPool(workers, app.config["EPUB_PDF_WORKER_MEMORY_MB"], batch_id=batch_id)
+        pool.start()
+        try:
+            for job_id in queued:
+                pool.submit(job_id)
+            while Job.query.filter(Job.id.in_(queued), Job.status.in_((JobStatus.QUEUED, JobStatus.PROCESSING))).count():
+                db.session.remove()
+                time.sleep(1)
+        finally:
+            pool.shutdown()
 
+    db.session.expire_all()
+    for job in Job.query.filter(Job.id.in_(queued)).all() if queued else []:
+        summary["converted" if job.status == JobStatus.COMPLETED else "failed"].append(job)
+    return summary
 
-def process_job(job_id: str) -> None:
+
+def iter_epub_sources(source: Path) -> Iterator[Path]:
+    """``*.epub`` files under ``source``, plus unpacked EPUB folders (``*.epub`` directories)."""
+    for path in sorted(source.rglob("*")):
+        if path.suffix.lower() != ".epub" or path.name.startswith("._"):
+            continue
+        if path.is_file() or (path.is_dir() and is_epub_directory(path)):
+            yield path
+
+
+@contextmanager
+def open_epub_source(path: Path) -> Iterator[BinaryIO]:
+    if path.is_file():
+        with path.open("rb") as stream:
+            yield stream
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        packed = Path(tmp) / path.name
+        repack_epub_directory(path, packed)
+        with packed.open("rb") as stream:
+            yield stream
+
+
+def _process_tree(pid: int) -> Optional[List[int]]:
+    """``pid`` followed by all of its descendants, or ``None`` without /proc."""
+    proc = Path("/proc")
+    if not (proc / str(pid)).exists():
+        return None
+    children: Dict[int, List[int]] = {}
+    for stat_path in proc.glob("[0-9]*/stat"):
+        try:
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat_path.parent.name))
+
+    tree = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def _process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory of ``pid`` and its descendants, or ``None`` without /proc."""
+    tree = _process_tree(pid)
+    if tree is None:
+        return None
+    total = 0
+    for current in tree:
+        try:
+            status = (Path("/proc") / str(current) / "status").read_text()
+        except OSError:
+            continue
+        match = re.search(r"^VmRSS:\s+(\d+) kB", status, re.MULTILINE)
+        if match:
+            total += int(match.group(1)) * 1024
+    return total
+
+
+def _kill_process_tree(pid: int) -> None:
+    """SIGKILL ``pid`` and its descendants (Playwright driver, Chromium)."""
+    # Children first, so none is reparented and missed while we walk the tree.
+    for current in reversed(_process_tree(pid) or [pid]):
+        try:
+            os.kill(current, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            continue
+
+
+def fail_job(job_id: str, message: str) -> None:
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        if not job or job.status not in {JobStatus.QUEUED, JobStatus.PROCESSING}:
+            return
+        job.status = JobStatus.FAILED
+        job.error_message = message
+        job.lease_owner = None
+        job.lease_expires_at = None
+        job.updated_at = utc_now()
+        db.session.commit()
+
+
+def process_job(job_id: str, lease_owner: Optional[str] = None) -> None:
+    """Convert one job.
+
+    Workers pass the ``lease_owner`` they claimed the job with; inline runs
+    (``EPUB_PDF_SYNC``) take a lease of their own so no worker picks the job up.
+    """
     with app.app_context():
         job = db.session.get(Job, job_id)
         if not job:
             return
         if job.status == JobStatus.CANCELED:
             return
-
-        job.status = JobStatus.PROCESSING
-        job.error_message = None
-        job.updated_at = utc_now()
-        db.session.commit()
+        if lease_owner is None:
+            lease_owner = worker_identity()
+            job.lease_owner = lease_owner
+            job.lease_expires_at = lease_deadline()
+            job.attempts = (job.attempts or 0) + 1
+            job.started_at = utc_now()
+            job.status = JobStatus.PROCESSING
+            job.error_message = None
+            job.last_progress = None
+            job.updated_at = utc_now()
+            db.session.commit()
+        elif job.lease_owner != lease_owner:
+            app.logger.warning("Job %s is leased by %s, skipping", job_id, job.lease_owner)
+            return
+        # A claimed job was moved to processing by claim_next_job's UPDATE.
 
         output_path = job.pdf_path
         output_path.parent.mkdir(parents=True, exist_ok=True)
+        progress = ProgressReporter(db.engine, job.id, app.config["EPUB_PDF_PROGRESS_MIN_SECONDS"])
+        cancel = CancelToken(db.engine, job.id, app.config["EPUB_PDF_CANCEL_CHECK_SECONDS"])
+
+        def on_stage(stage: str) -> None:
+            cancel.check()
+            note_worker_stage(stage)
+            progress(stage)
+
+        recorder = StageRecorder(on_stage=on_stage)
+        heartbeat = LeaseHeartbeat(db.engine, job.id, lease_owner, app.config["EPUB_PDF_LEASE_SECONDS"])
 
         try:
-            convert_to_pdf(job.source_path, output_path, job.settings())
+            with heartbeat:
+                convert_to_pdf(job.source_path, output_path, job.settings(), recorder=recorder, degraded=bool(job.degraded))
             db.session.refresh(job)
             if job.status == JobStatus.CANCELED:
+                raise JobCanceled(job.id)
+            job.mark_completed(utc_now())
+            job.pdf_filename = output_path.name
+            job.pdf_size_bytes = output_path.stat().st_size
+            if job.cache_key:
+                register_cached_pdf(job)
+        except JobCanceled:
+            if not pdf_in_use(output_path.name):
                 output_path.unlink(missing_ok=True)
+            # Deleted jobs (cleared while rendering) count as canceled; with the
+            # row gone there is nothing to record and commit_if_leased drops it.
+            if db.session.get(Job, job.id, populate_existing=True) is not None:
                 job.error_message = job.error_message or "任务已取消"
                 job.updated_at = utc_now()
-            else:
-                job.status = JobStatus.COMPLETED
-                job.pdf_filename = output_path.name
-                job.completed_at = utc_now()
-                job.updated_at = utc_now()
+        except (PlaywrightTimeoutError, MemoryError) as exc:
+            # Worth one more try with the lighter profile before giving up.
+            job.status = JobStatus.QUEUED if not job.degraded else JobStatus.FAILED
+            job.error_message = (
+                f"渲染超时或内存不足，将以降级模式重试: {exc}" if not job.degraded else traceback.format_exc()
+            )
+            job.degraded = True
+            job.updated_at = utc_now()
         except Exception:
             job.status = JobStatus.FAILED
             job.error_message = traceback.format_exc()
             job.updated_at = utc_now()
         finally:
-            db.session.commit()
+            # Progress, stages, status and lease release go out in one commit.
+            job.last_progress = progress.latest
+            job.lease_owner = None
+            job.lease_expires_at = None
+            recorder.persist(job.id)
+            recorded = commit_if_leased(job.id, lease_owner)
+        if not recorded:
+            app.logger.warning("Job %s was deleted or lost its lease; discarding this attempt's result", job_id)
+            return
+        if job.status == JobStatus.COMPLETED and job.cache_key:
+            evict_conversion_cache()
+        requeued = job.status == JobStatus.QUEUED
+    if requeued and runs_inline():
+        process_job(job_id)
+
+
+def commit_if_leased(job_id: str, owner: str) -> bool:
+    """Commit the session's changes only while ``owner`` still holds the job's lease.
+
+    The lease is released by a conditional UPDATE in the same transaction as
+    the result, so a worker whose lease lapsed and was re-claimed by another
+    worker cannot overwrite that worker's result. Returns ``False`` (after
+    rolling back) when the lease is no longer held.
+    """
+    with db.session.no_autoflush:
+        released = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.lease_owner == owner)
+            .values(lease_owner=None, lease_expires_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    if not released:
+        db.session.rollback()
+        return False
+    db.session.commit()
+    return True
+
+
+class JobCanceled(Exception):
+    """Raised inside the pipeline once the job being converted has been canceled."""
+
+
+class CancelToken:
+    """Lets the pipeline notice a cancel request between stages.
+
+    ``check`` reads the job's status at most once per ``interval`` seconds
+    (from any thread) and raises :class:`JobCanceled` once the job is
+    canceled or gone.
+    """
+
+    def __init__(self, engine, job_id: str, interval: float = 0.5):
+        self._engine = engine
+        self._job_id = job_id
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._checked_at: Optional[float] = None
+        self.canceled = False
+
+    def check(self) -> None:
+        if not self.canceled:
+            with self._lock:
+                now = time.monotonic()
+                if self._checked_at is not None and now - self._checked_at < self._interval:
+                    return
+                self._checked_at = now
+            with self._engine.connect() as conn:
+                status = conn.execute(select(Job.status).where(Job.id == self._job_id)).scalar()
+            self.canceled = status in {None, JobStatus.CANCELED}
+        if self.canceled:
+            raise JobCanceled(self._job_id)
+
+
+class ProgressReporter:
+    """Publishes coarse pipeline progress to ``Job.last_progress``, coalescing writes."""
+
+    phases = {
+        "package": "parsing",
+        "extract": "parsing",
+        "assemble": "assembling",
+        "browser_launch": "rendering",
+        "goto": "rendering",
+        "pdf": "rendering",
+        "write": "writing",
+    }
+
+    def __init__(self, engine, job_id: str, min_interval: float = 0.0):
+        self._engine = engine
+        self._job_id = job_id
+        self._min_interval = min_interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._written_at: Optional[float] = None
+        self._chunks = 0
+        self.latest: Optional[str] = None
+
+    def __call__(self, stage: str) -> None:
+        phase = self.phases.get(stage)
+        if phase is None:
+            return
+        with self._lock:
+            if stage == "pdf":
+                self._chunks += 1
+            if self._chunks and phase in {"assembling", "rendering"}:
+                # Chunks are assembled while earlier ones render; report rendering only.
+                phase = f"rendering:{self._chunks}"
+            if phase == self.latest:
+                return
+            self.latest = phase
+            now = time.monotonic()
+            if self._written_at is not None and now - self._written_at < self._min_interval:
+                return
+            self._written_at = now
+        # Another thread already writing will be superseded by the next stage
+        # or by the final commit; don't queue behind it.
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(
+                    update(Job)
+                    .where(Job.id == self._job_id)
+                    .values(last_progress=self.latest, updated_at=utc_now())
+                )
+        finally:
+            self._write_lock.release()
 
 
 def cleanup_job(job: Job, commit: bool = True) -> None:
     job_dir = job.job_dir
     if job_dir.exists():
         shutil.rmtree(job_dir, ignore_errors=True)
+    if job.status == JobStatus.COMPLETED:
+        release_cached_pdf(job)
     db.session.delete(job)
     if commit:
         db.session.commit()
 
 
-def convert_to_pdf(source_path: Path, output_path: Path, settings: Dict[str, Any]) -> None:
+def ingest_upload(file: FileStorage, destination: Path) -> UploadInfo:
+    """Move an upload into place, returning its size, digest and whether it is a well-formed EPUB."""
+    stream = file.stream
+    if isinstance(stream, IngestingFile):
+        info = stream.finish()
+        stream.move_to(destination)
+        return info
+
+    started = time.perf_counter()
+    digest = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    with destination.open("wb") as out:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return UploadInfo(size, digest.hexdigest(), is_epub_archive(destination), time.perf_counter() - started)
+
+
+def _central_directory_is_epub(head: bytes, tail: bytes, size: int) -> bool:
+    """Check the zip central directory held in ``tail`` for an EPUB layout.
+
+    Only plain (non-zip64) archives whose central directory fits in ``tail`` are
+    inspected; anything else returns ``False`` so the caller takes the slower
+    ``ensure_epub_archive`` path.
+    """
+    eocd = tail.rfind(b"PK\x05\x06")
+    if eocd < 0 or len(tail) - eocd < 22:
+        return False
+    _, _, _, _, entries, cd_size, cd_offset, _ = struct.unpack("<IHHHHIIH", tail[eocd:eocd + 22])
+    start = cd_offset - (size - len(tail))
+    if entries == 0xFFFF or cd_offset == 0xFFFFFFFF or start < 0 or start + cd_size > eocd:
+        return False
+
+    names = set()
+    pos = start
+    for _ in range(entries):
+        if tail[pos:pos + 4] != b"PK\x01\x02":
+            return False
+        name_len, extra_len, comment_len = struct.unpack("<HHH", tail[pos + 28:pos + 34])
+        names.add(tail[pos + 46:pos + 46 + name_len].decode("utf-8", errors="replace").lower())
+        pos += 46 + name_len + extra_len + comment_len
+    if "meta-inf/container.xml" not in names:
+        return False
+    if "mimetype" not in names:
+        return True
+
+    if head[:4] != b"PK\x03\x04":
+        return False
+    method, = struct.unpack("<H", head[8:10])
+    stored_size, = struct.unpack("<I", head[18:22])
+    name_len, extra_len = struct.unpack("<HH", head[26:30])
+    if method != zipfile.ZIP_STORED or head[30:30 + name_len] != b"mimetype":
+        return False
+    data_start = 30 + name_len + extra_len
+    mimetype = head[data_start:data_start + stored_size].decode("utf-8", errors="ignore").strip().lower()
+    return mimetype in {"", "application/epub+zip"}
+
+
+def build_cache_key(content_hash: str, settings: Dict[str, Any]) -> str:
+    payload = f"{content_hash}:{json.dumps(settings, sort_keys=True)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def attach_cached_pdf(job: Job, entry: ConversionCache) -> None:
+    """Complete ``job`` with an already rendered PDF from the conversion cache."""
+    now = utc_now()
+    job.mark_completed(now)
+    job.pdf_filename = entry.pdf_filename
+    job.pdf_size_bytes = entry.size_bytes
+    entry.ref_count = ConversionCache.ref_count + 1
+    entry.last_used_at = now
+
+
+def register_cached_pdf(job: Job) -> None:
+    entry = db.session.get(ConversionCache, job.cache_key)
+    if entry is None:
+        entry = ConversionCache(
+            key=job.cache_key,
+            content_hash=job.content_hash,
+            settings_json=job.settings_json,
+            ref_count=0,
+        )
+        db.session.add(entry)
+    entry.pdf_filename = job.pdf_filename
+    entry.size_bytes = job.pdf_size_bytes
+    entry.ref_count = (entry.ref_count or 0) + 1
+    entry.last_used_at = utc_now()
+
+
+def release_cached_pdf(job: Job) -> bool:
+    """Drop ``job``'s reference to its cached PDF; the file stays until evicted.
+
+    Returns ``False`` when the PDF is not tracked by the conversion cache.
+    """
+    entry = db.session.get(ConversionCache, job.cache_key) if job.cache_key else None
+    if entry is None:
+        return False
+    if job.status != JobStatus.COMPLETED:
+        return True
+    entry.ref_count = max((entry.ref_count or 0) - 1, 0)
+    if job.pdf_filename != entry.pdf_filename:
+        # Concurrent first uploads under different names each render their own
+        # copy and only the last is cached; drop the others with their last job.
+        shared = Job.query.filter(Job.pdf_filename == job.pdf_filename, Job.id != job.id).first()
+        if shared is None:
+            job.pdf_path.unlink(missing_ok=True)
+    return True
+
+
+def pdf_in_use(pdf_filename: str) -> bool:
+    return db.session.query(ConversionCache.key).filter(
+        ConversionCache.pdf_filename == pdf_filename,
+        ConversionCache.ref_count > 0,
+    ).first() is not None
+
+
+def evict_conversion_cache() -> None:
+    """Delete least recently used, unreferenced PDFs until the cache fits its size budget."""
+    with app.app_context():
+        limit = app.config["EPUB_PDF_CACHE_MAX_MB"] * 1024 * 1024
+        total = db.session.query(func.coalesce(func.sum(ConversionCache.size_bytes), 0)).scalar()
+        if total <= limit:
+            return
+        candidates = (
+            ConversionCache.query.filter(ConversionCache.ref_count <= 0)
+            .order_by(ConversionCache.last_used_at)
+            .all()
+        )
+        for entry in candidates:
+            if total <= limit:
+                break
+            entry.pdf_path.unlink(missing_ok=True)
+            total -= entry.size_bytes or 0
+            db.session.delete(entry)
+            app.logger.info("Evicted cached PDF %s", entry.pdf_filename)
+        db.session.commit()
+
+
+def convert_to_pdf(
+    source_path: Path,
+    output_path: Path,
+    settings: Dict[str, Any],
+    recorder: Optional[StageRecorder] = None,
+    degraded: bool = False,
+) -> None:
+    """Render the EPUB at ``source_path`` into ``output_path``.
+
+    The ``degraded`` profile, used when a job's first attempt hit a time or
+    memory limit, renders smaller chunks one at a time so each Chromium page
+    holds less of the book, and downsamples images at least to the
+    ``standard`` image profile.
+    """
     if not source_path.exists():
         raise FileNotFoundError("EPUB 文件不存在")
 
+    recorder = recorder or StageRecorder()
     page_size = settings.get("pageSize", "A4")
     margin_mm = float(settings.get("marginMm", 15.0))
+    image_quality = settings.get("imageQuality", "original")
+    if degraded and image_quality in {"original", "high"}:
+        image_quality = "standard"
 
     with tempfile.TemporaryDirectory() as tmpdir:
         tmpdir_path = Path(tmpdir)
-        extract_dir = tmpdir_path / "extracted"
-        extract_dir.mkdir(parents=True, exist_ok=True)
 
         if source_path.is_dir():
             temp_epub = tmpdir_path / "source.epub"
@@ -497,17 +2282,52 @@ def convert_to_pdf(source_path: Path, output_path: Path, settings: Dict[str, Any
             archive_path = source_path
 
         with zipfile.ZipFile(archive_path, "r") as zip_ref:
-            zip_ref.extractall(extract_dir)
-
-        book = epub.read_epub(str(archive_path))
-        rendered_html = assemble_html(book, extract_dir)
-        pdf_bytes = render_pdf_with_chromium(
-            rendered_html,
-            page_size=page_size,
-            margin_mm=margin_mm,
-        )
-
-    output_path.write_bytes(pdf_bytes)
+            with recorder.stage("package"):
+                package = EpubPackage(zip_ref)
+            images = optimize_book_images(package, page_size, margin_mm, IMAGE_PROFILES.get(image_quality), recorder)
+            serve_from_archive = app.config.get("EPUB_PDF_RESOURCE_MODE") != "extract"
+            if serve_from_archive:
+                base_href = BOOK_ORIGIN
+            else:
+                extract_dir = tmpdir_path / "extracted"
+                with recorder.stage("extract") as info:
+                    extracted = extract_members(zip_ref, extract_dir)
+                    info["bytes"] = sum(member.file_size for member in zip_ref.infolist())
+                    for path, (body, _) in images.items():
+                        # Only overwrite files the archive itself produced inside extract_dir.
+                        target = extracted.get(path.lstrip("/").lower())
+                        if target is not None:
+                            target.write_bytes(body)
+                base_href = extract_dir.as_uri().rstrip("/") + "/"
+
+            max_chunk_chars = app.config.get("EPUB_PDF_CHUNK_MAX_KB", 0) * 1024
+            if degraded:
+                max_chunk_chars = app.config["EPUB_PDF_DEGRADED_CHUNK_KB"] * 1024
+            chunks = iter_html_chunks(
+                package, base_href, max_chunk_chars or None, app.config.get("EPUB_PDF_CHUNK_DOCUMENTS") or None
+            )
+            render_book(
+                recorder.timed("assemble", chunks),
+                output_path,
+                page_size=page_size,
+                margin_mm=margin_mm,
+                resources=(OptimizedResources(package, images) if images else package) if serve_from_archive else None,
+                workdir=tmpdir_path,
+                cache_salt=f"{package.resource_fingerprint()}:{image_quality if images else 'original'}",
+                recorder=recorder,
+                max_in_flight=1 if degraded else None,
+            )
+
+
+def extract_members(archive: zipfile.ZipFile, dest: Path) -> Dict[str, Path]:
+    """Extract ``archive`` into ``dest``; returns ``{lower-cased member name: file}``."""
+    root = dest.resolve()
+    extracted = {}
+    for member in archive.infolist():
+        target = Path(archive.extract(member, dest)).resolve()
+        if not member.is_dir() and target.is_relative_to(root):
+            extracted[member.filename.lower()] = target
+    return extracted
 
 
 def is_epub_archive(path: Path) -> bool:
@@ -621,11 +2441,13 @@ def repack_epub_directory(source_dir: Path, output_path: Path) -> None:
     shutil.move(temp_epub, output_path)
 
 
-def build_output_filename(original_name: str) -> str:
+def build_output_filename(original_name: str, cache_key: Optional[str] = None) -> str:
     stem = Path(original_name).stem
     sanitized = re.sub(r"[^A-Za-z0-9._-]+", "_", stem).strip("._- ")
     if not sanitized:
         sanitized = f"converted_{uuid.uuid4().hex[:8]}"
+    if cache_key:
+        sanitized = f"{sanitized}_{cache_key[:12]}"
     return f"{sanitized}.pdf"
 
 
@@ -646,43 +2468,359 @@ def reveal_in_explorer(target: Path) -> None:
         subprocess.Popen(["xdg-open", str(target.parent)])
 
 
-def assemble_html(book: epub.EpubBook, extract_dir: Path) -> str:
-    styles = []
-    body_parts = []
+def assemble_html(package: "EpubPackage", base_href: str) -> str:
+    return wrap_html(collect_styles(package), list(iter_document_bodies(package)), base_href)
 
-    for item in book.get_items():
-        if item is None:
-            continue
-        if item.get_type() == ITEM_STYLE:
-            styles.append(_decode_bytes(item.get_content()))
 
-    for item in book.get_items_of_type(ITEM_DOCUMENT):
-        if item is None or not hasattr(item, "get_content"):
-            continue
-        body_content = _decode_bytes(item.get_content())
-        soup = BeautifulSoup(body_content, "lxml")
-        name = getattr(item, "get_name", lambda: "")()
-        doc_dir = PurePosixPath(name or "").parent
-
-        for tag in soup.find_all(src=True):
-            src = tag.get("src")
-            if not src:
+def iter_html_chunks(
+    package: "EpubPackage", base_href: str, max_chars: Optional[int], max_documents: Optional[int] = None
+) -> Iterator[str]:
+    """Yield standalone HTML pages holding consecutive spine documents.
+
+    Groups are fixed by spine position, so an edited chapter only changes its own chunk.
+    """
+    style_block = collect_styles(package)
+    parts: List[str] = []
+    size = 0
+    emitted = False
+    for index, body in enumerate(iter_document_bodies(package)):
+        group_starts = bool(max_documents) and index % max_documents == 0
+        if parts and (group_starts or (max_chars and size + len(body) > max_chars)):
+            yield wrap_html(style_block, parts, base_href)
+            emitted = True
+            parts, size = [], 0
+        parts.append(body)
+        size += len(body)
+    if parts or not emitted:
+        yield wrap_html(style_block, parts, base_href)
+
+
+class CssStats(NamedTuple):
+    sheets: int
+    duplicates: int
+    imports: int
+    rules: int
+    rules_removed: int
+    bytes_in: int
+    bytes_out: int
+
+
+def collect_styles(package: "EpubPackage") -> str:
+    started = time.perf_counter()
+    css, stats = build_stylesheet(package, prune=app.config["EPUB_PDF_CSS_PRUNE"])
+    app.logger.info(
+        "Stylesheets: %s sheets (%s duplicate, %s imported), removed %s of %s rules, %s -> %s bytes in %.3fs",
+        stats.sheets, stats.duplicates, stats.imports, stats.rules_removed, stats.rules,
+        stats.bytes_in, stats.bytes_out, time.perf_counter() - started,
+    )
+    return css
+
+
+def build_stylesheet(package: "EpubPackage", prune: bool = True) -> Tuple[str, CssStats]:
+    """Merge the book's stylesheets into one block, inlining ``@import``s and dropping duplicates."""
+    pieces: List[Tuple[str, str]] = []
+    imports = 0
+    bytes_in = 0
+
+    def add_sheet(path: str, media: str, stack: Tuple[str, ...]) -> None:
+        nonlocal imports, bytes_in
+        content = package.read(path)
+        if content is None:
+            return
+        bytes_in += len(content)
+        sheet_dir = PurePosixPath(path).parent
+        own: List[str] = []
+        for prelude, block in split_css_rules(decode_bytes(content)):
+            target = _CSS_IMPORT.match(prelude) if block is None else None
+            if target is None:
+                own.append(rewrite_css_urls(prelude + ("{" + block + "}" if block is not None else ";"), sheet_dir))
+                continue
+            href = target.group(1) or target.group(2)
+            imported = posixpath.normpath(posixpath.join(posixpath.dirname(path), href))
+            if _URL_SCHEME.match(href) or imported in stack:
                 continue
-            resolved = resolve_resource(doc_dir, src)
-            tag["src"] = resolved
+            imports += 1
+            add_sheet(imported, " and ".join(part for part in (media, target.group(3).strip()) if part), stack + (imported,))
+        key = hashlib.sha256(content + media.encode("utf-8")).hexdigest()
+        body = "\n".join(own)
+        pieces.append((key, f"@media {media} {{\n{body}\n}}" if media else body))
+
+    sheets = 0
+    for item in package.stylesheets():
+        sheets += 1
+        add_sheet(item.href, "", (item.href,))
+
+    last = {key: index for index, (key, _) in enumerate(pieces)}
+    unique = [css for index, (key, css) in enumerate(pieces) if last[key] == index]
+    used = scan_document_tokens(package) if prune and unique else None
+    rules = removed = 0
+    output = []
+    for sheet in unique:
+        pruned, total, dropped = prune_css(split_css_rules(sheet), used)
+        rules += total
+        removed += dropped
+        output.append(pruned)
+    css = "\n".join(output)
+    stats = CssStats(sheets, len(pieces) - len(unique), imports, rules, removed, bytes_in, len(css.encode("utf-8")))
+    return css, stats
+
+
+_URL_SCHEME = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+_CSS_URL = re.compile(r"""url\(\s*(["']?)([^"')]*)\1\s*\)""", re.IGNORECASE)
+_CSS_IMPORT = re.compile(
+    r"""@import\s+(?:url\(\s*["']?([^"')]+)["']?\s*\)|["']([^"']+)["'])(.*)$""",
+    re.IGNORECASE | re.DOTALL,
+)
+# At-rules whose blocks hold ordinary style rules that can be pruned.
+_CSS_GROUPING_RULES = {"media", "supports", "document", "-moz-document", "layer", "container"}
+
+
+def rewrite_css_urls(css: str, sheet_dir: PurePosixPath) -> str:
+    def replace(match: "re.Match[str]") -> str:
+        link = match.group(2).strip()
+        if not link or link.startswith(("#", "/")) or _URL_SCHEME.match(link):
+            return match.group(0)
+        return f'url("{resolve_resource(sheet_dir, link)}")'
+
+    return _CSS_URL.sub(replace, css)
+
+
+def split_css_rules(css: str) -> List[Tuple[str, Optional[str]]]:
+    """Split a stylesheet into top-level ``(prelude, block)`` pairs, dropping comments.
 
-        for tag in soup.find_all(href=True):
-            href = tag.get("href")
-            if not href:
+    ``block`` is the text between the braces, or ``None`` for statements such
+    as ``@import ...;``. Strings and nested braces are respected; an
+    unterminated block runs to the end of the text, as in browsers.
+    """
+    rules: List[Tuple[str, Optional[str]]] = []
+    length = len(css)
+    pos = 0
+    while pos < length:
+        prelude: List[str] = []
+        start = pos
+        while pos < length and css[pos] not in "{;}":
+            if css.startswith("/*", pos):
+                prelude.append(css[start:pos])
+                end = css.find("*/", pos + 2)
+                pos = length if end < 0 else end + 2
+                start = pos
+            elif css[pos] in "\"'":
+                pos = _skip_css_string(css, pos)
+            else:
+                pos += 1
+        prelude.append(css[start:pos])
+        head = "".join(prelude).strip()
+        if pos >= length or css[pos] in ";}":
+            if head:
+                rules.append((head, None))
+            pos += 1
+            continue
+        depth = 1
+        pos += 1
+        body_start = pos
+        while pos < length and depth:
+            char = css[pos]
+            if css.startswith("/*", pos):
+                end = css.find("*/", pos + 2)
+                pos = length if end < 0 else end + 2
+                continue
+            if char in "\"'":
+                pos = _skip_css_string(css, pos)
                 continue
-            resolved = resolve_resource(doc_dir, href)
-            tag["href"] = resolved
+            if char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+            pos += 1
+        rules.append((head, css[body_start:pos - 1 if not depth else pos]))
+    return rules
+
+
+def _skip_css_string(css: str, pos: int) -> int:
+    quote = css[pos]
+    pos += 1
+    while pos < len(css) and css[pos] not in (quote, "\n"):
+        pos += 2 if css[pos] == "\\" else 1
+    return pos + 1
+
+
+def prune_css(rules: List[Tuple[str, Optional[str]]], used: Optional["DocumentTokens"]) -> Tuple[str, int, int]:
+    """Serialize ``rules``, dropping selectors ``used`` rules out; returns the CSS and the total and removed rule counts."""
+    output: List[str] = []
+    total = removed = 0
+    for prelude, block in rules:
+        if prelude.startswith("@"):
+            name = prelude[1:].split(None, 1)[0].split("(", 1)[0].lower() if len(prelude) > 1 else ""
+            if block is None:
+                if name != "charset":
+                    output.append(prelude + ";")
+            elif name in _CSS_GROUPING_RULES:
+                inner, inner_total, inner_removed = prune_css(split_css_rules(block), used)
+                total += inner_total
+                removed += inner_removed
+                if inner.strip() or inner_total == inner_removed == 0:
+                    output.append(f"{prelude} {{\n{inner}\n}}")
+            else:
+                output.append(f"{prelude} {{{block}}}")
+            continue
+        if block is None:
+            continue
+        total += 1
+        selectors = split_selector_list(prelude)
+        if used is not None:
+            selectors = [selector for selector in selectors if selector_may_match(selector, used)]
+        if not selectors:
+            removed += 1
+            continue
+        output.append(f"{', '.join(selectors)} {{{block}}}")
+    return "\n".join(output), total, removed
+
+
+def split_selector_list(prelude: str) -> List[str]:
+    selectors, depth, start = [], 0, 0
+    for index, char in enumerate(prelude):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif char == "," and depth == 0:
+            selectors.append(prelude[start:index].strip())
+            start = index + 1
+    selectors.append(prelude[start:].strip())
+    return [selector for selector in selectors if selector]
+
+
+class DocumentTokens(NamedTuple):
+    tags: set
+    classes: set
+    ids: set
+
+
+# Elements the HTML parser or wrap_html add even when no document contains them.
+_IMPLIED_TAGS = {"html", "head", "body", "tbody", "meta", "base", "style", "title"}
+# Run on lower-cased text. Each pattern starts with a literal so ``re`` can
+# skip ahead quickly; a stray match (``data-id=``) only keeps extra rules.
+_DOC_TAG = re.compile(r"<([a-z][\w:.-]*)")
+_DOC_CLASS = re.compile(r"""class\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))""")
+_DOC_ID = re.compile(r"""id\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))""")
+
+
+def scan_document_tokens(package: "EpubPackage") -> DocumentTokens:
+    """Collect the tag names, classes and ids used anywhere in the book's documents (lower-cased)."""
+    tokens = DocumentTokens(set(_IMPLIED_TAGS), set(), set())
+    for item in package.documents():
+        content = package.read(item.href)
+        if content is None:
+            continue
+        document = decode_bytes(content).lower()
+        tokens.tags.update(tag.rpartition(":")[2] for tag in set(_DOC_TAG.findall(document)))
+        for values in _DOC_CLASS.findall(document):
+            tokens.classes.update("".join(values).split())
+        tokens.ids.update("".join(values).strip() for values in _DOC_ID.findall(document))
+    return tokens
+
+
+_SELECTOR_IGNORED = re.compile(r"""\[[^\]]*\]|"[^"]*"|'[^']*'""")
+_SELECTOR_NESTED = re.compile(r"\([^()]*\)")
+_SELECTOR_PSEUDO = re.compile(r"::?[\w-]+")
+_SELECTOR_CLASS = re.compile(r"\.([\w-]+)")
+_SELECTOR_ID = re.compile(r"#([\w-]+)")
+_SELECTOR_TYPE = re.compile(r"(?:^|[\s>+~])([A-Za-z][\w-]*)")
+
 
-        body = soup.body or soup
-        body_parts.append(str(body))
+def selector_may_match(selector: str, used: DocumentTokens) -> bool:
+    """Whether ``selector`` might match an element of the book.
 
-    style_block = "\n".join(styles)
-    base_href = extract_dir.as_uri().rstrip('/') + '/'
+    Conservative: a selector is only ruled out when it requires a tag, class
+    or id that appears in no document. Attribute selectors, pseudo-classes
+    and arguments of functional pseudo-classes such as ``:not()`` are
+    ignored, and selectors with escapes or namespaces are always kept.
+    """
+    if "\\" in selector or "|" in selector:
+        return True
+    simple = _SELECTOR_IGNORED.sub("", selector)
+    while True:
+        stripped = _SELECTOR_NESTED.sub("", simple)
+        if stripped == simple:
+            break
+        simple = stripped
+    simple = _SELECTOR_PSEUDO.sub("", simple)
+    if any(name.lower() not in used.classes for name in _SELECTOR_CLASS.findall(simple)):
+        return False
+    if any(name.lower() not in used.ids for name in _SELECTOR_ID.findall(simple)):
+        return False
+    return all(name.lower() in used.tags for name in _SELECTOR_TYPE.findall(simple))
+
+
+PREPROCESS_BATCH_SIZE = 16
+
+
+def iter_document_bodies(package: "EpubPackage") -> Iterator[str]:
+    """Yield the rewritten ``<body>`` of every spine document, in spine order.
+
+    Large books are rewritten on the preprocessing pool with bounded read-ahead.
+    """
+    items = list(package.documents())
+    batches = iter_document_batches(package, items)
+    executor = None
+    if len(items) >= app.config["EPUB_PDF_PREPROCESS_MIN_CHAPTERS"]:
+        executor = get_preprocess_executor()
+    if executor is None:
+        for batch in batches:
+            yield from rewrite_document_batch(batch)
+        return
+
+    max_batches = max(1, app.config["EPUB_PDF_PREPROCESS_MAX_IN_FLIGHT"] // PREPROCESS_BATCH_SIZE)
+    pending: "deque[Tuple[List[Tuple[bytes, str]], Optional[Future]]]" = deque()
+
+    def collect() -> List[str]:
+        nonlocal executor
+        batch, future = pending.popleft()
+        if future is not None:
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                app.logger.warning("Preprocessing pool died; rewriting the remaining documents in-process")
+                discard_preprocess_executor(executor)
+                executor = None
+        return rewrite_document_batch(batch)
+
+    try:
+        for batch in batches:
+            future = None
+            if executor is not None:
+                try:
+                    future = executor.submit(rewrite_document_batch, batch)
+                except (BrokenProcessPool, RuntimeError):
+                    discard_preprocess_executor(executor)
+                    executor = None
+            pending.append((batch, future))
+            if len(pending) >= max_batches:
+                yield from collect()
+        while pending:
+            yield from collect()
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+
+
+def iter_document_batches(package: "EpubPackage", items: List["ManifestItem"]) -> Iterator[List[Tuple[bytes, str]]]:
+    batch: List[Tuple[bytes, str]] = []
+    for item in items:
+        content = package.read(item.href)
+        if content is None:
+            app.logger.warning("Spine document missing from archive: %s", item.href)
+            continue
+        batch.append((content, str(PurePosixPath(item.href).parent)))
+        if len(batch) >= PREPROCESS_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def wrap_html(style_block: str, body_parts: List[str], base_href: str) -> str:
     assembled_html = f"""
     <!DOCTYPE html>
     <html lang=\"zh-CN\">
@@ -704,49 +2842,636 @@ def assemble_html(book: epub.EpubBook, extract_dir: Path) -> str:
     return assembled_html
 
 
-def render_pdf_with_chromium(html: str, page_size: str, margin_mm: float) -> bytes:
-    if os.environ.get("EPUB_PDF_TEST_MODE"):
-        return b"%PDF-1.4\n% Stub PDF generated for tests\n"
+class BrowserPool:
+    """Bounded pool of warm Chromium instances shared by the conversion workers.
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        html_path = Path(tmpdir) / "book.html"
-        html_path.write_text(html, encoding="utf-8")
+    Playwright's sync API is bound to the thread that started it, so every
+    rendering thread keeps its own driver and browser; the semaphore bounds the
+    number of browsers rendering at once across threads. Each job gets a fresh
+    context, and a browser is recycled after ``max_renders`` jobs or as soon as
+    a render fails. Drivers exit together with the process that owns them.
+    """
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            page = browser.new_page()
-            page.goto(html_path.as_uri(), wait_until="networkidle")
-            page.add_style_tag(content=f"@page {{ size: {page_size}; margin: {margin_mm}mm; }}")
-            pdf_bytes = page.pdf(format=page_size, print_background=True, margin={
-                "top": f"{margin_mm}mm",
-                "bottom": f"{margin_mm}mm",
-                "left": f"{margin_mm}mm",
-                "right": f"{margin_mm}mm",
-            })
+    def __init__(self, size: int, max_renders: int):
+        self.size = max(1, size)
+        self.max_renders = max(1, max_renders)
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._local = threading.local()
+
+    @contextmanager
+    def page(self, recorder: Optional[StageRecorder] = None) -> Iterator[Page]:
+        with self._slots:
+            browser = self._checkout(recorder or StageRecorder())
+            context = browser.new_context()
+            try:
+                yield context.new_page()
+            except JobCanceled:
+                # The browser is fine; only its context is thrown away.
+                raise
+            except Exception:
+                self._discard()
+                raise
+            finally:
+                try:
+                    context.close()
+                except PlaywrightError:
+                    self._discard()
+            self._local.renders += 1
+            if self._local.renders >= self.max_renders:
+                self._discard()
+
+    def _checkout(self, recorder: StageRecorder):
+        browser = getattr(self._local, "browser", None)
+        if browser is not None and browser.is_connected():
+            return browser
+        self._discard()
+        with recorder.stage("browser_launch"):
+            if getattr(self._local, "playwright", None) is None:
+                self._local.playwright = sync_playwright().start()
+            browser = self._local.playwright.chromium.launch()
+        self._local.browser = browser
+        self._local.renders = 0
+        return browser
+
+    def _discard(self) -> None:
+        browser = getattr(self._local, "browser", None)
+        self._local.browser = None
+        self._local.renders = 0
+        if browser is None:
+            return
+        try:
             browser.close()
+        except PlaywrightError:
+            pass
+
+    def close(self) -> None:
+        """Shut down the browser and driver owned by the calling thread."""
+        self._discard()
+        playwright = getattr(self._local, "playwright", None)
+        self._local.playwright = None
+        if playwright is not None:
+            try:
+                playwright.stop()
+            except Exception:  # pragma: no cover - driver already gone
+                pass
 
-    return pdf_bytes
 
+_browser_pool: Optional[BrowserPool] = None
+_browser_pool_lock = threading.Lock()
+
+
+def get_browser_pool() -> BrowserPool:
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is None:
+            _browser_pool = BrowserPool(
+                app.config["EPUB_PDF_BROWSER_POOL_SIZE"],
+                app.config["EPUB_PDF_BROWSER_MAX_RENDERS"],
+            )
+        return _browser_pool
+
+
+class ZipResources:
+    """Serves archive members to Chromium by path without extracting them."""
+
+    def __init__(self, archive: zipfile.ZipFile):
+        self._archive = archive
+        self._names = {name.lower(): name for name in archive.namelist() if not name.endswith("/")}
 
-def resolve_resource(doc_dir: PurePosixPath, link: str) -> str:
-    href_path = PurePosixPath(link)
-    if href_path.is_absolute() or href_path.anchor:
-        return href_path.as_posix()
-    if str(href_path).startswith("data:"):
-        return link
-    normalized = doc_dir.joinpath(href_path).as_posix()
-    return normalized
+    def read(self, path: str) -> Optional[bytes]:
+        name = self._names.get(path.lstrip("/").lower())
+        if name is None:
+            return None
+        return self._archive.read(name)
 
+    def content_type(self, path: str) -> str:
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
 
-def _decode_bytes(data: bytes) -> str:
-    for encoding in ("utf-8", "utf-16", "gb18030", "shift_jis"):
+    def fingerprint(self, exclude: Iterable[str] = ()) -> str:
+        """Digest of member names, sizes and CRCs, taken from the central directory."""
+        excluded = {path.lower() for path in exclude}
+        digest = hashlib.sha256()
+        for info in sorted(self._archive.infolist(), key=lambda info: info.filename):
+            if info.filename.lower() in excluded:
+                continue
+            digest.update(f"{info.filename}:{info.file_size}:{info.CRC}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+
+class ManifestItem(NamedTuple):
+    id: str
+    href: str
+    media_type: str
+
+
+class EpubPackage(ZipResources):
+    """Lightweight reader for the OPF package of an open EPUB archive.
+
+    ``container.xml`` and the OPF are parsed once; manifest hrefs are resolved
+    to archive paths, and document or stylesheet bytes are only read on demand.
+    """
+
+    document_types = {"application/xhtml+xml", "text/html", "application/x-dtbook+xml"}
+    non_resource_types = document_types | {"text/css", "application/x-dtbncx+xml"}
+    _xml_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+
+    def __init__(self, archive: zipfile.ZipFile):
+        super().__init__(archive)
+        self.opf_path = self._find_opf_path()
+        opf = self._parse(self.opf_path)
+        opf_dir = posixpath.dirname(self.opf_path)
+
+        self.manifest: Dict[str, ManifestItem] = {}
+        for node in opf.iterfind("{*}manifest/{*}item"):
+            item_id, href = node.get("id"), node.get("href")
+            if not item_id or not href:
+                continue
+            path = posixpath.normpath(posixpath.join(opf_dir, unquote(href.split("#", 1)[0])))
+            self.manifest[item_id] = ManifestItem(item_id, path, (node.get("media-type") or "").lower())
+
+        self.spine_ids = [
+            node.get("idref")
+            for node in opf.iterfind("{*}spine/{*}itemref")
+            if node.get("idref") in self.manifest
+        ]
+
+    def spine(self) -> List[ManifestItem]:
+        return [self.manifest[item_id] for item_id in self.spine_ids]
+
+    def documents(self) -> Iterator[ManifestItem]:
+        items = self.spine() or list(self.manifest.values())
+        return (item for item in items if item.media_type in self.document_types)
+
+    def stylesheets(self) -> Iterator[ManifestItem]:
+        return (item for item in self.manifest.values() if item.media_type == "text/css")
+
+    def resource_fingerprint(self) -> str:
+        """Fingerprint of the resources that rendered HTML pulls in (images, fonts, ...).
+
+        Documents and stylesheets are inlined into the HTML itself and package
+        metadata does not affect rendering, so none of them are included.
+        """
+        inlined = {item.href for item in self.manifest.values() if item.media_type in self.non_resource_types}
+        return self.fingerprint(exclude=inlined | {self.opf_path, "META-INF/container.xml", "mimetype"})
+
+    def _find_opf_path(self) -> str:
+        container = self.read("META-INF/container.xml")
+        if container is not None:
+            rootfile = self._parse_bytes(container).find(".//{*}rootfile")
+            if rootfile is not None and rootfile.get("full-path"):
+                return rootfile.get("full-path").lstrip("/")
+        candidates = sorted(name for name in self._names.values() if name.lower().endswith(".opf"))
+        if not candidates:
+            raise ValueError("EPUB 缺少 OPF 包文件")
+        return candidates[0]
+
+    def _parse(self, path: str) -> etree._Element:
+        data = self.read(path)
+        if data is None:
+            raise ValueError(f"EPUB 缺少包文件: {path}")
+        return self._parse_bytes(data)
+
+    def _parse_bytes(self, data: bytes) -> etree._Element:
+        root = etree.fromstring(data, parser=self._xml_parser)
+        if root is None:
+            raise ValueError("EPUB 包文件无法解析")
+        return root
+
+
+# Resolves true once the document and its subresources have loaded, web fonts
+# are ready and every image is decoded, or false when ``timeoutMs`` passes
+# first. Lazy images are made eager so nothing waits for a scroll.
+PAGE_READY_SCRIPT = """
+async (timeoutMs) => {
+  for (const img of document.images) img.loading = 'eager';
+  const ready = (async () => {
+    if (document.readyState !== 'complete') {
+      await new Promise((resolve) => window.addEventListener('load', resolve, { once: true }));
+    }
+    await document.fonts.ready;
+    await Promise.all(Array.from(document.images, (img) => img.decode().catch(() => undefined)));
+    return true;
+  })();
+  return Promise.race([ready, new Promise((resolve) => setTimeout(() => resolve(false), timeoutMs))]);
+}
+"""
+# Schemes that never leave the machine.
+LOCAL_URL_SCHEMES = {"file", "data", "blob", "about"}
+
+
+def route_book_request(route: Route, html: str, resources: Optional[Union[ZipResources, "OptimizedResources"]]) -> None:
+    """Serve book resources and block every other request that would leave the machine.
+
+    Hosts matching a pattern in ``EPUB_PDF_ALLOWED_HOSTS`` (e.g. ``fonts.gstatic.com``
+    or ``*.example.com``) are let through.
+    """
+    url = route.request.url
+    if resources is not None and url.startswith(BOOK_ORIGIN):
+        serve_book_request(route, html, resources)
+    elif request_allowed(url, app.config["EPUB_PDF_ALLOWED_HOSTS"]):
+        route.continue_()
+    else:
+        app.logger.debug("Blocked request to %s", url)
+        route.abort("blockedbyclient")
+
+
+def request_allowed(url: str, allowed_hosts: Iterable[str]) -> bool:
+    parts = urlsplit(url)
+    if parts.scheme in LOCAL_URL_SCHEMES:
+        return True
+    host = (parts.hostname or "").lower()
+    return bool(host) and any(fnmatch.fnmatchcase(host, pattern) for pattern in allowed_hosts)
+
+
+def serve_book_request(route: Route, html: str, resources: Union[ZipResources, "OptimizedResources"]) -> None:
+    path = unquote(urlsplit(route.request.url).path).lstrip("/")
+    if path == BOOK_DOCUMENT:
+        route.fulfill(status=200, content_type="text/html; charset=utf-8", body=html)
+        return
+    body = resources.read(path)
+    if body is None:
+        route.fulfill(status=404, body=b"")
+        return
+    route.fulfill(status=200, content_type=resources.content_type(path), body=body)
+
+
+_render_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_render_executor() -> ThreadPoolExecutor:
+    """Long-lived render threads, so the browsers they keep warm are reused across jobs."""
+    global _render_executor
+    with _browser_pool_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(
+                max_workers=render_thread_count(),
+                thread_name_prefix="epub-pdf-render",
+            )
+        return _render_executor
+
+
+_preprocess_executor: Optional[ProcessPoolExecutor] = None
+_preprocess_lock = threading.Lock()
+
+
+def preprocess_worker_count() -> int:
+    """``EPUB_PDF_PREPROCESS_WORKERS``, or by default the CPUs left per conversion worker."""
+    configured = app.config["EPUB_PDF_PREPROCESS_WORKERS"]
+    if configured > 0:
+        return configured
+    return max(1, (os.cpu_count() or 1) // max(1, app.config["EPUB_PDF_WORKERS"]))
+
+
+def get_preprocess_executor() -> Optional[ProcessPoolExecutor]:
+    """Long-lived chapter preprocessing processes; ``None`` when only one CPU is available to them."""
+    global _preprocess_executor
+    workers = preprocess_worker_count()
+    if workers < 2:
+        return None
+    with _preprocess_lock:
+        if _preprocess_executor is None:
+            # Spawned, not forked: this process runs Playwright and render threads.
+            _preprocess_executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(_preprocess_executor.shutdown, wait=False, cancel_futures=True)
+        return _preprocess_executor
+
+
+def discard_preprocess_executor(executor: Optional[ProcessPoolExecutor]) -> None:
+    global _preprocess_executor
+    with _preprocess_lock:
+        if _preprocess_executor is executor:
+            _preprocess_executor = None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def render_thread_count() -> int:
+    threads = app.config.get("EPUB_PDF_RENDER_THREADS") or app.config["EPUB_PDF_BROWSER_POOL_SIZE"]
+    return max(1, threads)
+
+
+def render_book(
+    chunks: Iterable[str],
+    output_path: Path,
+    page_size: str,
+    margin_mm: float,
+    resources: Optional[ZipResources],
+    workdir: Path,
+    cache_salt: str = "",
+    recorder: Optional[StageRecorder] = None,
+    max_in_flight: Optional[int] = None,
+) -> None:
+    """Render HTML chunks in parallel through the fragment cache and merge them into ``output_path``."""
+    recorder = recorder or StageRecorder()
+    executor = get_render_executor()
+    max_in_flight = max_in_flight or render_thread_count()
+    fragment_dir = fragment_cache_dir()
+    in_flight: Dict[Future, int] = {}
+    pieces: Dict[int, Path] = {}
+
+    def collect(done) -> None:
+        for future in done:
+            index = in_flight.pop(future)
+            piece = pieces[index]
+            partial = piece.with_name(f".{piece.name}.{uuid.uuid4().hex[:8]}.part")
+            partial.write_bytes(future.result())
+            os.replace(partial, piece)
+
+    try:
+        for index, html in enumerate(chunks):
+            if fragment_dir is None:
+                pieces[index] = workdir / f"chunk-{index:05d}.pdf"
+            else:
+                pieces[index] = fragment_dir / f"{fragment_key(html, page_size, margin_mm, cache_salt)}.pdf"
+                if pieces[index].exists():
+                    pieces[index].touch()
+                    continue
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(render_pdf_with_chromium, html, page_size, margin_mm, resources, recorder)
+            in_flight[future] = index
+        collect(wait(in_flight).done)
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+    with recorder.stage("write") as info:
+        partial_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex[:8]}.part")
+        ordered = [pieces[index] for index in sorted(pieces)]
+        if len(ordered) == 1:
+            shutil.copyfile(ordered[0], partial_path)
+        else:
+            merge_pdfs(ordered, partial_path)
+        os.replace(partial_path, output_path)
+        info["bytes"] = output_path.stat().st_size
+
+    if fragment_dir is not None:
+        prune_fragment_cache(fragment_dir)
+
+
+def fragment_cache_dir() -> Optional[Path]:
+    if app.config.get("EPUB_PDF_FRAGMENT_CACHE_MAX_MB", 0) <= 0:
+        return None
+    fragment_dir = STORAGE_DIR / "fragments"
+    fragment_dir.mkdir(parents=True, exist_ok=True)
+    return fragment_dir
+
+
+def fragment_key(html: str, page_size: str, margin_mm: float, salt: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"{page_size}:{margin_mm}:{salt}\n".encode("utf-8"))
+    digest.update(html.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def prune_fragment_cache(fragment_dir: Path, min_age_seconds: float = 600) -> None:
+    """Delete least recently used fragments beyond the cache budget.
+
+    Fragments touched within ``min_age_seconds`` are kept so that jobs merging
+    them right now never lose a piece.
+    """
+    prune_cache_dir(fragment_dir, "*.pdf", app.config["EPUB_PDF_FRAGMENT_CACHE_MAX_MB"] * 1024 * 1024, min_age_seconds)
+
+
+def prune_cache_dir(directory: Path, pattern: str, limit: int, min_age_seconds: float = 600) -> None:
+    """Delete the least recently used files matching ``pattern`` until ``directory`` fits ``limit`` bytes."""
+    entries = []
+    for path in directory.glob(pattern):
         try:
-            return data.decode(encoding)
-        except UnicodeDecodeError:
+            stat = path.stat()
+        except OSError:
             continue
-    return data.decode("utf-8", errors="ignore")
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - min_age_seconds
+    for mtime, size, path in sorted(entries):
+        if total <= limit or mtime > cutoff:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
 
 
-if __name__ == "__main__":
+class OptimizedResources:
+    """Archive resources with some images replaced by optimized copies."""
+
+    def __init__(self, resources: ZipResources, images: Dict[str, Tuple[bytes, str]]):
+        self._resources = resources
+        self._images = {path.lower(): image for path, image in images.items()}
+
+    def read(self, path: str) -> Optional[bytes]:
+        image = self._images.get(path.lstrip("/").lower())
+        return image[0] if image else self._resources.read(path)
+
+    def content_type(self, path: str) -> str:
+        image = self._images.get(path.lstrip("/").lower())
+        return image[1] if image else self._resources.content_type(path)
+
+
+def image_target_size(page_size: str, margin_mm: float, dpi: int) -> Tuple[int, int]:
+    """Largest useful image size in pixels: the page's content box at ``dpi``."""
+    width_mm, height_mm = PAGE_SIZES_MM.get(page_size, PAGE_SIZES_MM["A4"])
+
+    def to_pixels(length_mm: float) -> int:
+        return max(1, round(max(length_mm - 2 * margin_mm, 10.0) / 25.4 * dpi))
+
+    return to_pixels(width_mm), to_pixels(height_mm)
+
+
+def optimize_book_images(
+    package: "EpubPackage",
+    page_size: str,
+    margin_mm: float,
+    profile: Optional[ImageProfile],
+    recorder: Optional[StageRecorder] = None,
+) -> Dict[str, Tuple[bytes, str]]:
+    """Downsample and recompress the book's raster images for ``profile``.
+
+    Returns ``{archive path: (bytes, content type)}`` for the images that
+    changed; the rest are served as stored. Images are processed on
+    ``EPUB_PDF_IMAGE_THREADS`` threads (Pillow releases the GIL while
+    decoding, resizing and encoding) and results are cached by content hash.
+    """
+    if profile is None:
+        return {}
+    recorder = recorder or StageRecorder()
+    paths = [
+        item.href
+        for item in package.manifest.values()
+        if item.media_type.startswith("image/") and item.media_type != "image/svg+xml"
+    ]
+    if not paths:
+        return {}
+    max_size = image_target_size(page_size, margin_mm, profile.dpi)
+    cache_dir = image_cache_dir()
+
+    def process(path: str) -> Tuple[str, int, Optional[Tuple[bytes, str]]]:
+        data = package.read(path)
+        if data is None:
+            return path, 0, None
+        return path, len(data), cached_optimize_image(data, max_size, profile.quality, cache_dir)
+
+    results: Dict[str, Tuple[bytes, str]] = {}
+    bytes_in = bytes_out = 0
+    with recorder.stage("images") as info:
+        threads = max(1, min(app.config["EPUB_PDF_IMAGE_THREADS"], len(paths)))
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="epub-pdf-images") as executor:
+            for path, size, optimized in executor.map(process, paths):
+                bytes_in += size
+                if optimized is None:
+                    bytes_out += size
+                    continue
+                bytes_out += len(optimized[0])
+                results[path] = optimized
+        info["bytes"] = bytes_in
+    if cache_dir is not None:
+        prune_cache_dir(cache_dir, "*.img", app.config["EPUB_PDF_IMAGE_CACHE_MAX_MB"] * 1024 * 1024)
+    app.logger.info("Images: %s of %s optimized, %s -> %s bytes", len(results), len(paths), bytes_in, bytes_out)
+    return results
+
+
+def image_cache_dir() -> Optional[Path]:
+    if app.config.get("EPUB_PDF_IMAGE_CACHE_MAX_MB", 0) <= 0:
+        return None
+    cache_dir = STORAGE_DIR / "images"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def cached_optimize_image(
+    data: bytes, max_size: Tuple[int, int], quality: int, cache_dir: Optional[Path]
+) -> Optional[Tuple[bytes, str]]:
+    """``optimize_image`` with results kept under ``cache_dir``, keyed by image hash and target."""
+    if cache_dir is None:
+        return optimize_image(data, max_size, quality)
+    key = hashlib.sha256(data).hexdigest()
+    path = cache_dir / f"{key}_{max_size[0]}x{max_size[1]}_q{quality}.img"
+    try:
+        cached = path.read_bytes()
+        os.utime(path)
+    except OSError:
+        cached = None
+    if cached is not None:
+        # An empty entry records that the original is kept.
+        content_type, _, body = cached.partition(b"\n")
+        return (body, content_type.decode("ascii")) if body else None
+    result = optimize_image(data, max_size, quality)
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(result[1].encode("ascii") + b"\n" + result[0] if result else b"")
+    os.replace(tmp, path)
+    return result
+
+
+def optimize_image(data: bytes, max_size: Tuple[int, int], quality: int) -> Optional[Tuple[bytes, str]]:
+    """Fit one image into ``max_size`` and recompress it.
+
+    Photos become JPEG at ``quality``; images with transparency or few
+    colours stay lossless PNG. Returns ``None`` to keep the original: when it
+    cannot be decoded, is animated, or is already displayable and the result
+    would not be smaller.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            source_format = image.format
+            if getattr(image, "n_frames", 1) > 1:
+                return None
+            # EXIF orientations 5-8 rotate by 90 degrees; fit the image as displayed.
+            rotated = image.getexif().get(0x0112, 1) >= 5
+            width, height = image.size[::-1] if rotated else image.size
+            scale = min(1.0, max_size[0] / width, max_size[1] / height)
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            if source_format == "JPEG" and scale < 1:
+                # Let the decoder skip detail it would throw away anyway.
+                image.draft("RGB", size[::-1] if rotated else size)
+            image = ImageOps.exif_transpose(image)
+            has_alpha = image.mode in {"RGBA", "LA", "PA"} or "transparency" in image.info
+            lossless = has_alpha or image.mode in {"1", "P"} or source_format in {"PNG", "GIF"}
+            image = image.convert(("RGBA" if has_alpha else "RGB") if image.mode not in {"L", "RGB", "RGBA"} else image.mode)
+            if image.size != size:
+                image = image.resize(size, Image.LANCZOS)
+            output = io.BytesIO()
+            if lossless:
+                image.save(output, "PNG", optimize=True)
+                content_type = "image/png"
+            else:
+                image.save(output, "JPEG", quality=quality, optimize=True)
+                content_type = "image/jpeg"
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return None
+    optimized = output.getvalue()
+    if source_format in BROWSER_IMAGE_FORMATS and scale >= 1 and len(optimized) >= len(data):
+        return None
+    return optimized, content_type
+
+
+def merge_pdfs(paths: List[Path], output_path: Path) -> None:
+    writer = PdfWriter()
+    for path in paths:
+        writer.append(str(path))
+    with output_path.open("wb") as out:
+        writer.write(out)
+    writer.close()
+
+
+def render_pdf_with_chromium(
+    html: str,
+    page_size: str,
+    margin_mm: float,
+    resources: Optional[ZipResources] = None,
+    recorder: Optional[StageRecorder] = None,
+) -> bytes:
+    if os.environ.get("EPUB_PDF_TEST_MODE"):
+        return _stub_pdf()
+
+    recorder = recorder or StageRecorder()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if resources is None:
+            html_path = Path(tmpdir) / "book.html"
+            html_path.write_text(html, encoding="utf-8")
+            url = html_path.as_uri()
+        else:
+            url = BOOK_ORIGIN + BOOK_DOCUMENT
+
+        with get_browser_pool().page(recorder) as page:
+            page.route("**/*", lambda route: route_book_request(route, html, resources))
+            goto_limit = app.config["EPUB_PDF_STAGE_TIMEOUTS"].get("goto")
+            with recorder.stage("goto") as info:
+                # Fail inside Playwright, cleanly, before the watchdog would kill the worker.
+                # Navigation and the readiness wait share one deadline within the stage limit.
+                deadline = time.monotonic() + goto_limit * 0.9 if goto_limit else None
+                page.goto(url, wait_until="domcontentloaded", timeout=goto_limit * 1000 * 0.9 if goto_limit else 0)
+                ready_ms = app.config["EPUB_PDF_READY_TIMEOUT_SECONDS"] * 1000
+                if deadline is not None:
+                    ready_ms = min(ready_ms, max(0.0, (deadline - time.monotonic()) * 1000))
+                if not page.evaluate(PAGE_READY_SCRIPT, ready_ms):
+                    app.logger.warning("Page not ready after %.0f ms; rendering anyway", ready_ms)
+                info["bytes"] = len(html)
+            page.add_style_tag(content=f"@page {{ size: {page_size}; margin: {margin_mm}mm; }}")
+            with recorder.stage("pdf") as info:
+                pdf_bytes = page.pdf(format=page_size, print_background=True, margin={
+                    "top": f"{margin_mm}mm",
+                    "bottom": f"{margin_mm}mm",
+                    "left": f"{margin_mm}mm",
+                    "right": f"{margin_mm}mm",
+                })
+                info["bytes"] = len(pdf_bytes)
+
+    return pdf_bytes
+
+
+def _stub_pdf() -> bytes:
+    writer = PdfWriter()
+    writer.add_blank_page(width=595, height=842)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Start the pool with the server so jobs left queued or processing by a restart are picked up.
+if serves_web_requests():
+    init_db()
     start_worker()
+
+
+if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,403 @@
+"""Benchmarks for the EPUB → PDF conversion pipeline.
+
+Generates synthetic books and times the pipeline stages against them::
+
+    python bench.py --chapters 200 --images 20 --script cjk --json bench.json
+    python bench.py --scenario convert --iterations 3 --compare bench.json
+    python bench.py --api-load --scenario assemble --iterations 1
+
+Set ``EPUB_PDF_TEST_MODE=1`` to time everything except Chromium itself.
+Benchmarks use their own SQLite database unless ``EPUB_PDF_DATABASE_URL``
+is set.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+# Conversions run in this process; importing ``app`` must not start a worker pool.
+os.environ.setdefault("EPUB_PDF_SYNC", "1")
+os.environ.setdefault("EPUB_PDF_DATABASE_URL", f"sqlite:///{Path(tempfile.gettempdir()) / 'epub_pdf_bench.db'}")
+
+import app  # noqa: E402
+
+LATIN_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+).split()
+CJK_TEXT = "春眠不觉晓处处闻啼鸟夜来风雨声花落知多少床前明月光疑是地上霜举头望明月低头思故乡"
+
+
+def build_png(width: int, height: int, seed: int = 0) -> bytes:
+    """Encode a noisy RGB PNG; noise keeps the file size close to the pixel count."""
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+
+def build_synthetic_epub(
+    chapters: int = 20,
+    paragraphs: int = 30,
+    script: str = "latin",
+    images: int = 0,
+    image_px: int = 800,
+    css_rules: int = 50,
+    seed: int = 0,
+) -> bytes:
+    """Build an EPUB 2 book with the given shape.
+
+    ``script`` is ``latin`` or ``cjk``; images are spread round-robin over the
+    chapters and every chapter uses a handful of the generated CSS classes.
+    """
+    rng = random.Random(seed)
+
+    def paragraph() -> str:
+        if script == "cjk":
+            return "".join(rng.choice(CJK_TEXT) for _ in range(rng.randint(80, 200)))
+        return " ".join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(40, 120)))
+
+    manifest = ["<item id='css' href='Styles/book.css' media-type='text/css'/>"]
+    spine = []
+    files: Dict[str, bytes] = {}
+
+    css = "\n".join(
+        f".c{index} {{ margin: {index % 7}px 0; color: #{rng.randrange(0x1000000):06x}; }}"
+        for index in range(css_rules)
+    )
+    files["OEBPS/Styles/book.css"] = css.encode("utf-8")
+
+    for index in range(images):
+        name = f"Images/img{index:04d}.png"
+        files[f"OEBPS/{name}"] = build_png(image_px, image_px * 3 // 4, seed=seed + index)
+        manifest.append(f"<item id='img{index}' href='{name}' media-type='image/png'/>")
+
+    for index in range(chapters):
+        body = [f"<h1 class='c{index % max(css_rules, 1)}'>Chapter {index + 1}</h1>"]
+        for number in range(paragraphs):
+            css_class = f"c{rng.randrange(max(css_rules, 1))}"
+            body.append(f"<p class='{css_class}'>{paragraph()}</p>")
+        for image in range(index, images, max(chapters, 1)):
+            body.append(f"<p><img src='../Images/img{image:04d}.png' alt='figure {image}'/></p>")
+        name = f"Text/ch{index:04d}.xhtml"
+        files[f"OEBPS/{name}"] = (
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<html xmlns='http://www.w3.org/1999/xhtml'><head>"
+            "<link rel='stylesheet' type='text/css' href='../Styles/book.css'/></head>"
+            f"<body>{''.join(body)}</body></html>"
+        ).encode("utf-8")
+        manifest.append(f"<item id='ch{index}' href='{name}' media-type='application/xhtml+xml'/>")
+        spine.append(f"<itemref idref='ch{index}'/>")
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<container version='1.0' xmlns='urn:oasis:names:tc:opendocument:xmlns:container'>"
+            "<rootfiles><rootfile full-path='OEBPS/content.opf' media-type='application/oebps-package+xml'/>"
+            "</rootfiles></container>",
+        )
+        zf.writestr(
+            "OEBPS/content.opf",
+            "<?xml version='1.0' encoding='utf-8'?>"
+            "<package xmlns='http://www.idpf.org/2007/opf' version='2.0' unique-identifier='BookId'>"
+            "<metadata xmlns:dc='http://purl.org/dc/elements/1.1/'><dc:title>Synthetic</dc:title>"
+            "<dc:identifier id='BookId'>urn:uuid:synthetic</dc:identifier></metadata>"
+            f"<manifest>{''.join(manifest)}</manifest><spine>{''.join(spine)}</spine></package>",
+        )
+        for name, data in files.items():
+            # Images are already compressed; storing them mirrors real EPUBs.
+            compress = zipfile.ZIP_STORED if name.endswith(".png") else zipfile.ZIP_DEFLATED
+            zf.writestr(name, data, compress_type=compress)
+    return buffer.getvalue()
+
+
+def run_assemble(epub_path: Path, workdir: Path) -> None:
+    with zipfile.ZipFile(epub_path) as archive:
+        app.assemble_html(app.EpubPackage(archive), app.BOOK_ORIGIN)
+
+
+def run_validate(epub_path: Path, workdir: Path) -> None:
+    app.ensure_epub_archive(epub_path)
+
+
+def run_convert(epub_path: Path, workdir: Path) -> None:
+    # Every iteration converts the same book; the fragment cache would turn
+    # all but the first into cache hits.
+    app.app.config["EPUB_PDF_FRAGMENT_CACHE_MAX_MB"] = 0
+    app.convert_to_pdf(epub_path, workdir / "book.pdf", {"pageSize": "A4", "marginMm": 15.0})
+
+
+SCENARIOS: Dict[str, Callable[[Path, Path], None]] = {
+    "assemble": run_assemble,
+    "validate": run_validate,
+    "convert": run_convert,
+}
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class PeakRss:
+    """Peak resident memory of this process and its children (Playwright, Chromium) while in use.
+
+    Polls ``/proc`` every ``interval`` seconds, so each scenario gets its own
+    peak rather than the process's lifetime high-water mark. Reports ``None``
+    where there is no ``/proc``.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def __enter__(self) -> "PeakRss":
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _poll(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self) -> None:
+        rss = app._process_tree_rss(os.getpid())
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+
+
+def run_scenario(name: str, epub_bytes: bytes, iterations: int, warmup: int) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]
+    samples: List[float] = []
+    with tempfile.TemporaryDirectory() as tmp, PeakRss() as rss:
+        workdir = Path(tmp)
+        epub_path = workdir / "book.epub"
+        for iteration in range(warmup + iterations):
+            epub_path.write_bytes(epub_bytes)
+            started = time.perf_counter()
+            scenario(epub_path, workdir)
+            elapsed = time.perf_counter() - started
+            if iteration >= warmup:
+                samples.append(elapsed)
+
+    total = sum(samples)
+    megabytes = len(epub_bytes) / (1024 * 1024)
+    return {
+        "iterations": len(samples),
+        "meanSeconds": statistics.fmean(samples),
+        "p50Seconds": percentile(samples, 0.50),
+        "p90Seconds": percentile(samples, 0.90),
+        "p99Seconds": percentile(samples, 0.99),
+        "booksPerSecond": len(samples) / total if total else None,
+        "megabytesPerSecond": megabytes * len(samples) / total if total else None,
+        "peakRssBytes": rss.peak,
+    }
+
+
+def run_api_load(jobs: int, requests: int, readers: int, writers: int) -> Dict[str, Dict[str, Any]]:
+    """Time ``GET /api/jobs`` with idle workers, then while simulated workers write.
+
+    Each writer mimics a converting worker: uncoalesced progress updates,
+    lease renewals and stage rows committed in a loop against its own job.
+    With WAL the busy percentiles should track the idle ones; run again with
+    ``EPUB_PDF_SQLITE_JOURNAL_MODE=delete`` for the baseline.
+    """
+    with app.app.app_context():
+        user = app.User(id=str(uuid.uuid4()), display_name="bench")
+        app.db.session.add(user)
+        now = app.utc_now()
+        for index in range(jobs + writers):
+            app.db.session.add(app.Job(
+                id=str(uuid.uuid4()),
+                user_id=user.id,
+                original_filename=f"book{index}.epub",
+                status=app.JobStatus.COMPLETED if index < jobs else app.JobStatus.PROCESSING,
+                settings_json=json.dumps({"pageSize": "A4", "marginMm": 15.0}),
+                created_at=now,
+                pdf_size_bytes=1024 if index < jobs else None,
+            ))
+        app.db.session.commit()
+        busy_ids = [job_id for (job_id,) in app.db.session.query(app.Job.id).filter_by(user_id=user.id, status=app.JobStatus.PROCESSING)]
+        engine = app.db.engine
+
+    def read_phase() -> Dict[str, Any]:
+        samples: List[float] = []
+        lock = threading.Lock()
+
+        def reader(count: int) -> None:
+            client = app.app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = user.id
+            for _ in range(count):
+                started = time.perf_counter()
+                response = client.get("/api/jobs")
+                elapsed = time.perf_counter() - started
+                assert response.status_code == 200, response.status_code
+                with lock:
+                    samples.append(elapsed)
+
+        threads = [threading.Thread(target=reader, args=(requests // readers,)) for _ in range(readers)]
+        with PeakRss() as rss:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return {
+            "iterations": len(samples),
+            "p50Seconds": percentile(samples, 0.50),
+            "p90Seconds": percentile(samples, 0.90),
+            "p99Seconds": percentile(samples, 0.99),
+            "peakRssBytes": rss.peak,
+        }
+
+    stop = threading.Event()
+    writes = [0] * writers
+
+    def writer(slot: int, job_id: str) -> None:
+        progress = app.ProgressReporter(engine, job_id)
+        stages = ("package", "assemble", "goto", "pdf", "write")
+        while not stop.is_set():
+            progress(stages[writes[slot] % len(stages)])
+            with engine.begin() as conn:
+                conn.execute(app.update(app.Job).where(app.Job.id == job_id).values(lease_expires_at=app.lease_deadline()))
+                conn.execute(app.JobStage.__table__.insert().values(job_id=job_id, stage="pdf", seconds=0.01, bytes=1024))
+            writes[slot] += 1
+
+    try:
+        idle = read_phase()
+        threads = [threading.Thread(target=writer, args=(slot, job_id)) for slot, job_id in enumerate(busy_ids)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        busy = read_phase()
+        stop.set()
+        for thread in threads:
+            thread.join()
+        busy["workerWritesPerSecond"] = sum(writes) / (time.perf_counter() - started)
+    finally:
+        stop.set()
+        with app.app.app_context():
+            app.db.session.query(app.JobStage).filter(app.JobStage.job_id.in_(busy_ids)).delete(synchronize_session=False)
+            app.db.session.query(app.Job).filter_by(user_id=user.id).delete(synchronize_session=False)
+            app.db.session.query(app.User).filter_by(id=user.id).delete(synchronize_session=False)
+            app.db.session.commit()
+    return {"api-idle": idle, "api-busy": busy}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    lines = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric in ("p50Seconds", "p90Seconds", "peakRssBytes"):
+            before, after = previous.get(metric), current.get(metric)
+            if before and after is not None:
+                lines.append(f"{name:>10} {metric:<14} {before:>12.4g} -> {after:>12.4g} ({(after - before) / before:+.1%})")
+    return lines
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="repeatable; default: assemble and validate")
+    parser.add_argument("--chapters", type=int, default=50)
+    parser.add_argument("--paragraphs", type=int, default=30)
+    parser.add_argument("--script", choices=("latin", "cjk"), default="latin")
+    parser.add_argument("--images", type=int, default=0)
+    parser.add_argument("--image-px", type=int, default=800)
+    parser.add_argument("--css-rules", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--api-load", action="store_true", help="also time GET /api/jobs while simulated workers write")
+    parser.add_argument("--api-jobs", type=int, default=500, help="jobs in the listed history")
+    parser.add_argument("--api-requests", type=int, default=400)
+    parser.add_argument("--api-readers", type=int, default=4)
+    parser.add_argument("--api-writers", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--json", type=Path, help="write machine-readable results to this file")
+    parser.add_argument("--compare", type=Path, help="baseline JSON from an earlier run")
+    args = parser.parse_args(argv)
+    app.init_db()
+
+    book = {
+        "chapters": args.chapters,
+        "paragraphs": args.paragraphs,
+        "script": args.script,
+        "images": args.images,
+        "imagePx": args.image_px,
+        "cssRules": args.css_rules,
+    }
+    epub_bytes = build_synthetic_epub(
+        chapters=args.chapters,
+        paragraphs=args.paragraphs,
+        script=args.script,
+        images=args.images,
+        image_px=args.image_px,
+        css_rules=args.css_rules,
+    )
+    results: Dict[str, Any] = {
+        "book": {**book, "sizeBytes": len(epub_bytes)},
+        "testMode": bool(os.environ.get("EPUB_PDF_TEST_MODE")),
+        "python": platform.python_version(),
+        "scenarios": {},
+    }
+
+    for name in args.scenario or ["assemble", "validate"]:
+        stats = run_scenario(name, epub_bytes, args.iterations, args.warmup)
+        results["scenarios"][name] = stats
+        print(
+            f"{name:>10}: p50 {stats['p50Seconds'] * 1000:8.1f} ms  p90 {stats['p90Seconds'] * 1000:8.1f} ms  "
+            f"{stats['megabytesPerSecond']:7.1f} MB/s  peak RSS {(stats['peakRssBytes'] or 0) / 2**20:7.1f} MB"
+        )
+
+    if args.api_load:
+        load = run_api_load(args.api_jobs, args.api_requests, args.api_readers, args.api_writers)
+        results["scenarios"].update(load)
+        results["journalMode"] = app.app.config["EPUB_PDF_SQLITE_JOURNAL_MODE"]
+        for name, stats in load.items():
+            print(
+                f"{name:>10}: p50 {stats['p50Seconds'] * 1000:8.1f} ms  p90 {stats['p90Seconds'] * 1000:8.1f} ms  "
+                f"p99 {stats['p99Seconds'] * 1000:8.1f} ms"
+            )
+        print(f"{'':>10}  {load['api-busy']['workerWritesPerSecond']:.0f} worker writes/s")
+
+    if args.compare:
+        for line in compare(results, json.loads(args.compare.read_text())):
+            print(line)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,97 @@
+"""Decoding and link rewriting for EPUB documents.
+
+Kept apart from ``app`` because the chapter preprocessing pool runs
+``rewrite_document_batch`` in spawned processes: importing this module has
+no side effects (no Flask app, database or directories), so those processes
+start quickly and never touch the database.
+"""
+
+import codecs
+import re
+from pathlib import PurePosixPath
+from typing import List, Optional, Tuple
+
+from lxml import etree, html as lxml_html
+
+
+def rewrite_document_batch(batch: List[Tuple[bytes, str]]) -> List[str]:
+    return [rewrite_document_body(content, PurePosixPath(doc_dir)) for content, doc_dir in batch]
+
+
+def rewrite_document_body(content: bytes, doc_dir: PurePosixPath) -> str:
+    """Return the ``<body>`` of one spine document with ``src``/``href`` links resolved against ``doc_dir``.
+
+    libxml2 parses and serializes; Python only touches elements carrying a
+    link, in a single pass.
+    """
+    text = _XML_DECLARATION.sub("", decode_bytes(content), count=1)
+    try:
+        root = lxml_html.document_fromstring(text)
+    except etree.ParserError:
+        # Empty or whitespace-only document.
+        return ""
+    body = root.find("body")
+    if body is None:
+        body = root
+    for element in body.iter(etree.Element):
+        attrib = element.attrib
+        for name in ("src", "href"):
+            link = attrib.get(name)
+            if link:
+                attrib[name] = resolve_resource(doc_dir, link)
+    return lxml_html.tostring(body, encoding="unicode", with_tail=False)
+
+
+def resolve_resource(doc_dir: PurePosixPath, link: str) -> str:
+    href_path = PurePosixPath(link)
+    if href_path.is_absolute() or href_path.anchor:
+        return href_path.as_posix()
+    if str(href_path).startswith("data:"):
+        return link
+    normalized = doc_dir.joinpath(href_path).as_posix()
+    return normalized
+
+
+_XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*\?>")
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+# XML declaration, <meta charset> / http-equiv content type, or CSS @charset.
+_DECLARED_CHARSET = re.compile(
+    rb"""<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._:-]+)["']"""
+    rb"""|<meta[^>]*?charset\s*=\s*["']?([A-Za-z0-9._:-]+)"""
+    rb"""|^@charset\s+["']([A-Za-z0-9._:-]+)["']""",
+    re.IGNORECASE,
+)
+
+
+def sniff_encoding(data: bytes) -> Optional[str]:
+    """Encoding named by a BOM, or declared near the start of an XML, HTML or CSS document."""
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+    match = _DECLARED_CHARSET.search(data, 0, 2048)
+    if not match:
+        return None
+    name = next(group for group in match.groups() if group).decode("ascii")
+    try:
+        encoding = codecs.lookup(name).name
+    except LookupError:
+        return None
+    # A UTF-16/32 document can't declare itself in ASCII-compatible bytes.
+    return None if encoding.startswith(("utf-16", "utf-32")) else encoding
+
+
+def decode_bytes(data: bytes) -> str:
+    """Decode with the sniffed encoding, falling back to common EPUB encodings."""
+    declared = sniff_encoding(data)
+    for encoding in ((declared,) if declared else ()) + ("utf-8", "gb18030", "shift_jis"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="ignore")
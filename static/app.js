@@ -14,6 +14,7 @@ const translations = {
     statPendingLabel: 'Queued',
     actionsHeading: 'Actions',
     refreshButton: 'Refresh List',
+    loadMoreButton: 'Load older jobs',
     clearButton: 'Clear History',
     actionsTip1: 'Uploads enter the queue automatically. Sign in on the same browser to keep your history.',
     actionsTip2: 'Need custom page size or margins? Adjust them from Settings before uploading.',
@@ -26,6 +27,11 @@ const translations = {
     settingsNamePlaceholder: 'Name for your history',
     settingsPageLabel: 'Default Page Size',
     settingsMarginLabel: 'Margins (mm)',
+    settingsImageLabel: 'Image quality',
+    imageQualityOriginal: 'Original',
+    imageQualityHigh: 'High (300 DPI)',
+    imageQualityStandard: 'Standard (150 DPI)',
+    imageQualityCompact: 'Compact (96 DPI)',
     settingsMarginLabelShort: 'Margins',
     settingsCancel: 'Cancel',
     settingsSave: 'Save',
@@ -37,6 +43,15 @@ const translations = {
     statusCompleted: 'Completed',
     statusFailed: 'Failed',
     statusCanceled: 'Canceled',
+    progressParsing: 'Reading EPUB',
+    progressAssembling: 'Assembling pages',
+    progressRendering: 'Rendering',
+    progressWriting: 'Writing PDF',
+    progressChunk: 'part',
+    degradedNote: 'Rendered with the reduced profile after hitting a time or memory limit',
+    queuePosition: 'Position in queue',
+    queueEta: 'about',
+    queueBulk: 'bulk',
     actionDownload: 'Download PDF',
     actionReveal: 'Open Folder',
     actionRetry: 'Retry',
@@ -94,6 +109,7 @@ const translations = {
     statPendingLabel: '排队中',
     actionsHeading: '操作',
     refreshButton: '刷新列表',
+    loadMoreButton: '加载更早的任务',
     clearButton: '清空历史',
     actionsTip1: '上传后任务会自动进入队列。使用同一浏览器即可继续查看历史记录。',
     actionsTip2: '若需自定义纸张或页边距，请先在设置中调整。',
@@ -106,6 +122,11 @@ const translations = {
     settingsNamePlaceholder: '用于历史记录的昵称',
     settingsPageLabel: '默认纸张尺寸',
     settingsMarginLabel: '页边距 (毫米)',
+    settingsImageLabel: '图片质量',
+    imageQualityOriginal: '原图',
+    imageQualityHigh: '高 (300 DPI)',
+    imageQualityStandard: '标准 (150 DPI)',
+    imageQualityCompact: '精简 (96 DPI)',
     settingsMarginLabelShort: '页边距',
     settingsCancel: '取消',
     settingsSave: '保存',
@@ -117,6 +138,15 @@ const translations = {
     statusCompleted: '已完成',
     statusFailed: '失败',
     statusCanceled: '已取消',
+    progressParsing: '读取 EPUB',
+    progressAssembling: '组装页面',
+    progressRendering: '渲染中',
+    progressWriting: '写入 PDF',
+    progressChunk: '分段',
+    degradedNote: '因超时或内存超限，已使用降级模式渲染',
+    queuePosition: '排队位置',
+    queueEta: '预计约',
+    queueBulk: '批量',
     actionDownload: '下载 PDF',
     actionReveal: '打开文件夹',
     actionRetry: '重新转换',
@@ -171,14 +201,18 @@ try {
 const state = {
   user: null,
   jobs: [],
+  nextCursor: null,
+  counts: null,
   settings: {
     pageSize: localStorage.getItem('epub:pageSize') || 'A4',
     marginMm: Number(localStorage.getItem('epub:marginMm') || 15),
+    imageQuality: localStorage.getItem('epub:imageQuality') || 'original',
   },
   locale: localStorage.getItem('epub:locale') || 'en',
   forceRegen: localStorage.getItem('epub:forceRegen') === '1',
   autoRefresh: true,
   refreshTimer: null,
+  eventSource: null,
   uploading: false,
   analytics: storedAnalytics,
 };
@@ -193,6 +227,7 @@ const statTotal = document.getElementById('stat-total');
 const statCompleted = document.getElementById('stat-completed');
 const statPending = document.getElementById('stat-pending');
 const refreshJobsBtn = document.getElementById('refresh-jobs');
+const loadMoreJobsBtn = document.getElementById('load-more-jobs');
 const clearJobsBtn = document.getElementById('clear-jobs');
 const autoRefreshToggle = document.getElementById('auto-refresh');
 const toastContainer = document.getElementById('toast');
@@ -208,6 +243,7 @@ const saveSettingsBtn = document.getElementById('settings-save');
 const settingsNameInput = document.getElementById('settings-name');
 const settingsPageSelect = document.getElementById('settings-page');
 const settingsMarginInput = document.getElementById('settings-margin');
+const settingsImageSelect = document.getElementById('settings-image-quality');
 const displayNameEl = document.getElementById('display-name');
 const localeToggle = document.getElementById('locale-toggle');
 
@@ -215,6 +251,7 @@ async function init() {
   settingsNameInput.value = window.__INITIAL_DISPLAY_NAME || '';
   settingsPageSelect.value = state.settings.pageSize;
   settingsMarginInput.value = state.settings.marginMm;
+  settingsImageSelect.value = state.settings.imageQuality;
 
   applyTranslations();
   if (state.analytics) {
@@ -244,13 +281,47 @@ function applyTranslations() {
 }
 
 function setupAutoRefresh() {
-  if (state.autoRefresh) {
-    if (state.refreshTimer) clearInterval(state.refreshTimer);
-    state.refreshTimer = setInterval(refreshJobs, 5000);
-  } else if (state.refreshTimer) {
+  if (state.refreshTimer) {
     clearInterval(state.refreshTimer);
     state.refreshTimer = null;
   }
+  if (state.eventSource) {
+    state.eventSource.close();
+    state.eventSource = null;
+  }
+  if (!state.autoRefresh) return;
+
+  if (window.EventSource) {
+    // The server pushes only jobs whose status or progress changed; the browser
+    // reconnects with Last-Event-ID whenever the stream ends.
+    const since = encodeURIComponent(latestJobUpdate());
+    state.eventSource = new EventSource(`/api/jobs/events?since=${since}`);
+    state.eventSource.addEventListener('job', (event) => mergeJob(JSON.parse(event.data)));
+  } else {
+    state.refreshTimer = setInterval(refreshJobs, 5000);
+  }
+}
+
+function latestJobUpdate() {
+  return state.jobs.reduce((latest, job) => (job.updatedAt && job.updatedAt > latest ? job.updatedAt : latest), '');
+}
+
+function mergeJob(job) {
+  const index = state.jobs.findIndex((item) => item.id === job.id);
+  const previousStatus = index === -1 ? null : state.jobs[index].status;
+  if (index === -1) {
+    state.jobs.unshift(job);
+  } else {
+    state.jobs[index] = job;
+  }
+  if (state.counts && previousStatus !== job.status) {
+    if (previousStatus) state.counts[previousStatus] = Math.max((state.counts[previousStatus] || 0) - 1, 0);
+    state.counts[job.status] = (state.counts[job.status] || 0) + 1;
+  }
+  renderJobs();
+  if (previousStatus !== job.status && ['completed', 'failed', 'canceled'].includes(job.status)) {
+    fetchAnalytics();
+  }
 }
 
 async function fetchSession() {
@@ -273,6 +344,8 @@ async function refreshJobs() {
     }
     const data = await res.json();
     state.jobs = data.jobs || [];
+    state.nextCursor = data.nextCursor || null;
+    state.counts = data.counts || null;
     renderJobs();
     await fetchAnalytics();
   } catch (error) {
@@ -280,6 +353,25 @@ async function refreshJobs() {
   }
 }
 
+async function loadMoreJobs() {
+  if (!state.nextCursor) return;
+  try {
+    const res = await fetch(`/api/jobs?cursor=${encodeURIComponent(state.nextCursor)}`, { credentials: 'include' });
+    if (!res.ok) {
+      showToast(t('toastRefreshFailed'), 'error');
+      return;
+    }
+    const data = await res.json();
+    const known = new Set(state.jobs.map((job) => job.id));
+    state.jobs = state.jobs.concat((data.jobs || []).filter((job) => !known.has(job.id)));
+    state.nextCursor = data.nextCursor || null;
+    state.counts = data.counts || state.counts;
+    renderJobs();
+  } catch (error) {
+    showToast(t('toastRefreshFailed'), 'error');
+  }
+}
+
 function renderJobs() {
   if (!state.jobs.length) {
     jobsList.innerHTML = '';
@@ -289,9 +381,13 @@ function renderJobs() {
     jobsList.innerHTML = state.jobs.map(renderJobCard).join('');
   }
 
-  const total = state.jobs.length;
-  const completed = state.jobs.filter((job) => job.status === 'completed').length;
-  const pending = state.jobs.filter((job) => ['queued', 'processing'].includes(job.status)).length;
+  loadMoreJobsBtn.classList.toggle('hidden', !state.nextCursor);
+
+  // Only the loaded page is in state.jobs; the server reports totals for the whole history.
+  const counts = state.counts || state.jobs.reduce((acc, job) => ({ ...acc, [job.status]: (acc[job.status] || 0) + 1 }), {});
+  const total = Object.values(counts).reduce((sum, value) => sum + value, 0);
+  const completed = counts.completed || 0;
+  const pending = (counts.queued || 0) + (counts.processing || 0);
 
   statTotal.textContent = total;
   statCompleted.textContent = completed;
@@ -329,12 +425,14 @@ function renderJobCard(job) {
           <h3 class="text-lg font-semibold">${escapeHtml(job.originalFilename)}</h3>
           <p class="text-xs text-slate-400">${t('jobCreatedAt')} ${created} · ${t('jobUpdatedAt')} ${updated}</p>
         </div>
-        <span class="inline-flex items-center rounded-full px-3 py-1 text-xs font-semibold ${statusMeta.badge}">${statusMeta.label}</span>
+        <span class="inline-flex items-center rounded-full px-3 py-1 text-xs font-semibold ${statusMeta.badge}">${statusMeta.label}${job.status === 'processing' && job.progress ? ` · ${progressLabel(job.progress)}` : ''}</span>
       </div>
       <div class="grid gap-2 text-sm text-slate-300 md:grid-cols-2">
         <div>${fileSizeLabel}: ${size}</div>
         <div>${paperLabel}: ${job.settings?.pageSize || 'A4'} · ${marginLabel}: ${job.settings?.marginMm ?? 15}mm</div>
       </div>
+      ${job.status === 'queued' && job.queuePosition ? `<div class="text-xs text-cyan-300">${queueLabel(job)}</div>` : ''}
+      ${job.degraded ? `<div class="text-xs text-amber-300">${t('degradedNote')}</div>` : ''}
       ${job.error ? `<div class="text-sm text-rose-300">${t('statusFailed')}: ${escapeHtml(job.error)}</div>` : ''}
       <div class="flex flex-wrap gap-3">
         ${actions.join('') || `<span class="text-sm text-slate-500">${t('noActions')}</span>`}
@@ -343,6 +441,21 @@ function renderJobCard(job) {
   `;
 }
 
+function progressLabel(progress) {
+  const [phase, chunk] = progress.split(':');
+  const label = t(`progress${phase.charAt(0).toUpperCase()}${phase.slice(1)}`);
+  return chunk ? `${label} (${t('progressChunk')} ${chunk})` : label;
+}
+
+function queueLabel(job) {
+  let label = `${t('queuePosition')}: ${job.queuePosition}`;
+  if (job.etaSeconds != null) {
+    const minutes = Math.max(1, Math.round(job.etaSeconds / 60));
+    label += ` · ${t('queueEta')} ${minutes} min`;
+  }
+  return job.priority === 'bulk' ? `${label} · ${t('queueBulk')}` : label;
+}
+
 function statusInfo(status) {
   switch (status) {
     case 'queued':
@@ -397,6 +510,7 @@ async function handleUpload(files) {
     formData.append('file', file);
     formData.append('pageSize', state.settings.pageSize);
     formData.append('margin', state.settings.marginMm);
+    formData.append('imageQuality', state.settings.imageQuality);
     formData.append('force', state.forceRegen ? '1' : '0');
 
     try {
@@ -434,6 +548,11 @@ async function handleUpload(files) {
   state.uploading = false;
   fileInput.value = '';
   refreshJobs();
+  if (!state.user?.userId && (created.length || skipped)) {
+    // The first upload creates the visitor's identity; reconnect the event stream with it.
+    await fetchSession();
+    setupAutoRefresh();
+  }
 }
 
 function renderAnalytics(data) {
@@ -447,6 +566,10 @@ function renderAnalytics(data) {
   const totals = data.totals || {};
   const successRate = data.successRate != null ? `${(data.successRate * 100).toFixed(1)}%` : t('analyticsUnavailable');
   const avgLatency = data.averageLatencySeconds != null ? `${data.averageLatencySeconds.toFixed(1)} ${t('analyticsSeconds')}` : t('analyticsUnavailable');
+  const percentiles = data.latencyPercentilesSeconds || {};
+  const latencySpread = percentiles.p50 != null
+    ? `p50 ${percentiles.p50.toFixed(1)} · p90 ${percentiles.p90.toFixed(1)} · p99 ${percentiles.p99.toFixed(1)} ${t('analyticsSeconds')}`
+    : '';
 
   analyticsSummary.innerHTML = `
     <div class="grid gap-3 md:grid-cols-5 text-sm">
@@ -479,6 +602,7 @@ function renderAnalytics(data) {
       <div class="rounded-xl bg-slate-800/60 px-4 py-3">
         <p class="text-slate-400 uppercase text-xs">${t('analyticsAverageLatency')}</p>
         <p class="text-lg font-semibold">${avgLatency}</p>
+        ${latencySpread ? `<p class="text-xs text-slate-400">${latencySpread}</p>` : ''}
       </div>
     </div>
   `;
@@ -567,6 +691,7 @@ async function saveSettings() {
   const displayName = settingsNameInput.value.trim();
   const pageSize = settingsPageSelect.value;
   const marginMm = Number(settingsMarginInput.value) || 15;
+  const imageQuality = settingsImageSelect.value;
 
   const res = await fetch('/api/profile', {
     method: 'POST',
@@ -584,7 +709,9 @@ async function saveSettings() {
   state.settings.pageSize = pageSize;
   state.settings.marginMm = marginMm;
   localStorage.setItem('epub:pageSize', pageSize);
+  state.settings.imageQuality = imageQuality;
   localStorage.setItem('epub:marginMm', marginMm.toString());
+  localStorage.setItem('epub:imageQuality', imageQuality);
   hideSettings();
 }
 
@@ -633,6 +760,7 @@ jobsList.addEventListener('click', (event) => {
 });
 
 refreshJobsBtn.addEventListener('click', refreshJobs);
+loadMoreJobsBtn.addEventListener('click', loadMoreJobs);
 clearJobsBtn.addEventListener('click', handleClearJobs);
 autoRefreshToggle.addEventListener('change', (event) => {
   state.autoRefresh = event.target.checked;
@@ -1,32 +1,35 @@
 import io
 import os
+import tempfile
 import zipfile
 from pathlib import Path
 
 import pytest
+from pypdf import PdfReader, PdfWriter
 
 os.environ.setdefault("EPUB_PDF_TEST_MODE", "1")
 os.environ.setdefault("EPUB_PDF_SYNC", "1")
+# The engine is created when ``app`` is imported, so the test database must be chosen first.
+os.environ["EPUB_PDF_DATABASE_URL"] = f"sqlite:///{Path(tempfile.mkdtemp(prefix='epub-pdf-tests-')) / 'test.db'}"
 
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in os.sys.path:
     os.sys.path.insert(0, str(ROOT))
 
 import app  # noqa: E402
+import epub_text  # noqa: E402
 from app import db, Job, JobStatus
 
 
 @pytest.fixture
 def client(tmp_path, monkeypatch):
-    db_path = tmp_path / "test.db"
-    app.app.config.update(
-        TESTING=True,
-        SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_path}",
-    )
+    app.app.config.update(TESTING=True)
 
     storage_path = tmp_path / "storage"
     storage_path.mkdir(parents=True, exist_ok=True)
     monkeypatch.setattr(app, "STORAGE_DIR", storage_path, raising=False)
+    monkeypatch.setattr(app, "OUTPUT_DIR", tmp_path / "output", raising=False)
+    monkeypatch.setattr(app, "_queue_estimates_cache", {}, raising=False)
 
     with app.app.app_context():
         db.drop_all()
@@ -106,6 +109,42 @@ def build_epub_bytes() -> bytes:
     return buffer.getvalue()
 
 
+def build_multi_chapter_epub_bytes(chapters) -> bytes:
+    manifest = "".join(
+        f"<item id='ch{index}' href='Text/ch{index}.xhtml' media-type='application/xhtml+xml'/>"
+        for index in range(len(chapters))
+    )
+    spine = "".join(f"<itemref idref='ch{index}'/>" for index in range(len(chapters)))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            """<?xml version='1.0' encoding='utf-8'?>
+            <container version='1.0' xmlns='urn:oasis:names:tc:opendocument:xmlns:container'>
+              <rootfiles>
+                <rootfile full-path='OEBPS/content.opf' media-type='application/oebps-package+xml'/>
+              </rootfiles>
+            </container>
+            """,
+        )
+        zf.writestr(
+            "OEBPS/content.opf",
+            f"""<?xml version='1.0' encoding='utf-8'?>
+            <package xmlns='http://www.idpf.org/2007/opf' version='2.0'>
+              <manifest>{manifest}</manifest>
+              <spine>{spine}</spine>
+            </package>
+            """,
+        )
+        for index, body in enumerate(chapters):
+            zf.writestr(
+                f"OEBPS/Text/ch{index}.xhtml",
+                f"<html xmlns='http://www.w3.org/1999/xhtml'><body>{body}</body></html>",
+            )
+    return buffer.getvalue()
+
+
 def build_invalid_epub_bytes() -> bytes:
     buffer = io.BytesIO()
     with zipfile.ZipFile(buffer, "w") as zf:
@@ -219,6 +258,81 @@ def test_invalid_epub_rejected(client):
     assert "container" in resp.get_data(as_text=True) or "valid EPUB" in resp.get_data(as_text=True)
 
 
+def test_batch_upload_expands_zip_bundles(client):
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(bundle, "w") as zf:
+        zf.writestr("books/a.epub", build_epub_bytes())
+        zf.writestr("books/b.epub", build_dir_epub_bytes())
+        zf.writestr("books/bad.epub", b"not an epub")
+        zf.writestr("notes.txt", "ignored")
+    resp = client.post(
+        "/api/batches",
+        data={
+            "files": [(io.BytesIO(bundle.getvalue()), "library.zip"), (io.BytesIO(build_epub_bytes()), "again.epub")],
+            "pageSize": "A4",
+            "margin": "15",
+        },
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 202
+    batch = resp.get_json()["batch"]
+    assert [job["originalFilename"] for job in batch["jobs"]] == ["a.epub", "b.epub", "again.epub"]
+    assert batch["skipped"] == 1
+    assert [item["filename"] for item in batch["rejected"]] == ["bad.epub"]
+    assert {job["priority"] for job in batch["jobs"]} == {"bulk"}
+
+    status = client.get(f"/api/batches/{batch['id']}").get_json()["batch"]
+    assert status["counts"]["completed"] == 3
+    assert client.get("/api/batches/missing").status_code == 404
+
+    # A batch of books the user already has still lists them under its own id.
+    resp = client.post(
+        "/api/batches",
+        data={"files": [(io.BytesIO(build_epub_bytes()), "a.epub")], "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    repeat = resp.get_json()["batch"]
+    assert repeat["skipped"] == 1
+    status = client.get(f"/api/batches/{repeat['id']}").get_json()["batch"]
+    assert [job["id"] for job in status["jobs"]] == [job["id"] for job in repeat["jobs"]]
+    assert status["counts"]["completed"] == 1
+    assert db.session.get(app.ConversionCache, db.session.get(Job, repeat["jobs"][0]["id"]).cache_key).ref_count == 3
+
+
+def test_bundle_expansion_counts_against_the_upload_limit(monkeypatch):
+    from werkzeug.datastructures import FileStorage
+
+    book = build_epub_bytes()
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(bundle, "w", zipfile.ZIP_DEFLATED) as zf:
+        for index in range(4):
+            zf.writestr(f"book{index}.epub", book)
+    monkeypatch.setitem(app.app.config, "MAX_CONTENT_LENGTH", 2 * len(book) + 1)
+
+    uploads = [FileStorage(stream=io.BytesIO(bundle.getvalue()), filename="library.zip")]
+    expanded = [(name, upload is not None) for name, upload in app.iter_batch_uploads(uploads)]
+    assert expanded == [("book0.epub", True), ("book1.epub", True), ("book2.epub", False), ("book3.epub", False)]
+
+
+def test_convert_dir_command_skips_cached_books(client, tmp_path):
+    source = tmp_path / "library"
+    (source / "nested").mkdir(parents=True)
+    (source / "one.epub").write_bytes(build_epub_bytes())
+    (source / "nested" / "two.epub").write_bytes(build_dir_epub_bytes())
+    with zipfile.ZipFile(io.BytesIO(build_epub_bytes())) as zf:
+        zf.extractall(source / "three.epub")
+    (source / "broken.epub").write_bytes(b"nope")
+
+    runner = app.app.test_cli_runner()
+    first = runner.invoke(args=["convert-dir", str(source), "--margin", "12"])
+    assert first.exit_code == 0, first.output
+    assert "3 converted, 0 skipped (cached), 1 failed of 4 books" in first.output
+    assert "REJECTED broken.epub" in first.output
+
+    second = runner.invoke(args=["convert-dir", str(source), "--margin", "12"])
+    assert "0 converted, 3 skipped (cached)" in second.output
+
+
 def test_directory_style_epub(client):
     data = {
         "file": (io.BytesIO(build_dir_epub_bytes()), "bundle.epub"),
@@ -302,3 +416,1187 @@ def test_analytics_endpoint(client):
     assert "successRate" in payload
     assert "averageLatencySeconds" in payload
     assert isinstance(payload["totals"].get("total"), int)
+
+
+def test_analytics_aggregates_in_sql(client):
+    client.post("/api/profile", json={"displayName": "tester"})
+    user_id = app.User.query.first().id
+    now = app.utc_now()
+    for index, latency in enumerate([1.0, 2.0, 3.0, 4.0, 100.0]):
+        db.session.add(Job(
+            id=f"latency-{index}",
+            user_id=user_id,
+            status=JobStatus.COMPLETED,
+            created_at=now,
+            completed_at=now,
+            latency_seconds=latency,
+        ))
+    db.session.add(Job(id="failed-0", user_id=user_id, status=JobStatus.FAILED, created_at=now))
+    db.session.add(Job(id="old-0", user_id=user_id, status=JobStatus.FAILED, created_at=now - app.timedelta(days=30)))
+    db.session.commit()
+
+    payload = client.get("/api/analytics").get_json()
+    assert payload["totals"] == {"total": 7, "completed": 5, "failed": 2, "canceled": 0, "queued": 0}
+    assert payload["averageLatencySeconds"] == pytest.approx(22.0)
+    assert payload["latencyPercentilesSeconds"] == {"p50": 3.0, "p90": 100.0, "p99": 100.0}
+    assert payload["daily"] == [{"date": now.date().isoformat(), "total": 6, "completed": 5, "failed": 1}]
+
+
+class FakeBrowser:
+    def __init__(self, log):
+        self.log = log
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def new_context(self):
+        browser = self
+
+        class FakeContext:
+            def new_page(self):
+                return browser
+
+            def close(self):
+                pass
+
+        return FakeContext()
+
+    def close(self):
+        self.connected = False
+        self.log.append("close")
+
+
+def test_browser_pool_reuses_and_recycles(monkeypatch):
+    log = []
+
+    class FakePlaywright:
+        class chromium:
+            @staticmethod
+            def launch():
+                log.append("launch")
+                return FakeBrowser(log)
+
+        def stop(self):
+            log.append("stop")
+
+    class FakeDriver:
+        def start(self):
+            return FakePlaywright()
+
+    monkeypatch.setattr(app, "sync_playwright", FakeDriver)
+    pool = app.BrowserPool(size=1, max_renders=2)
+
+    with pool.page() as first:
+        pass
+    with pool.page() as second:
+        assert second is first
+    assert log == ["launch", "close"]
+
+    with pytest.raises(RuntimeError):
+        with pool.page():
+            raise RuntimeError("renderer crashed")
+    assert log == ["launch", "close", "launch", "close"]
+
+    with pool.page():
+        pass
+    pool.close()
+    assert log[-3:] == ["launch", "close", "stop"]
+
+
+def test_render_routes_block_remote_requests(monkeypatch):
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_ALLOWED_HOSTS", ("fonts.gstatic.com", "*.example.com"))
+    served = []
+    monkeypatch.setattr(app, "serve_book_request", lambda route, html, resources: served.append(route.request.url))
+
+    class FakeRoute:
+        def __init__(self, url):
+            self.request = type("Request", (), {"url": url})()
+            self.outcome = None
+
+        def continue_(self):
+            self.outcome = "continue"
+
+        def abort(self, error_code):
+            self.outcome = error_code
+
+    def route(url, resources=object()):
+        fake = FakeRoute(url)
+        app.route_book_request(fake, "<html></html>", resources)
+        return fake.outcome
+
+    assert route(f"{app.BOOK_ORIGIN}OEBPS/a.png") is None
+    assert served == [f"{app.BOOK_ORIGIN}OEBPS/a.png"]
+    assert route("file:///tmp/book/index.html", resources=None) == "continue"
+    assert route("data:image/png;base64,AAAA") == "continue"
+    assert route("https://fonts.gstatic.com/s/font.woff2") == "continue"
+    assert route("https://cdn.example.com/x.css") == "continue"
+    assert route("https://example.com.evil.net/x.css") == "blockedbyclient"
+    assert route("https://tracker.net/pixel.gif") == "blockedbyclient"
+    # Without an archive the book origin is just another remote host.
+    assert route(f"{app.BOOK_ORIGIN}OEBPS/a.png", resources=None) == "blockedbyclient"
+
+
+def test_fail_job_marks_unfinished_jobs_only(client):
+    data = {
+        "file": (io.BytesIO(build_epub_bytes()), "crash.epub"),
+        "pageSize": "A4",
+        "margin": "15",
+    }
+    job_id = client.post("/api/jobs", data=data, content_type="multipart/form-data").get_json()["job"]["id"]
+
+    app.fail_job(job_id, "worker crashed")
+    assert db.session.get(Job, job_id).status == JobStatus.COMPLETED
+
+    job = db.session.get(Job, job_id)
+    job.status = JobStatus.PROCESSING
+    db.session.commit()
+    app.fail_job(job_id, "worker crashed")
+    db.session.expire_all()
+    job = db.session.get(Job, job_id)
+    assert job.status == JobStatus.FAILED
+    assert job.error_message == "worker crashed"
+
+
+def test_jobs_claimed_once_and_stale_leases_recovered(client):
+    client.post("/api/profile", json={"displayName": "tester"})
+    user_id = app.User.query.first().id
+    now = app.utc_now()
+    for index in range(2):
+        db.session.add(Job(id=f"queued-{index}", user_id=user_id, status=JobStatus.QUEUED, created_at=now + app.timedelta(seconds=index)))
+    db.session.add(Job(
+        id="stale", user_id=user_id, status=JobStatus.PROCESSING, attempts=1,
+        lease_owner="gone:1", lease_expires_at=now - app.timedelta(minutes=5), created_at=now + app.timedelta(seconds=5),
+    ))
+    db.session.add(Job(
+        id="exhausted", user_id=user_id, status=JobStatus.PROCESSING, attempts=3,
+        lease_owner="gone:1", lease_expires_at=now - app.timedelta(minutes=5), created_at=now,
+    ))
+    db.session.add(Job(
+        id="alive", user_id=user_id, status=JobStatus.PROCESSING, attempts=1,
+        lease_owner="busy:1", lease_expires_at=now + app.timedelta(minutes=5), created_at=now,
+    ))
+    db.session.commit()
+
+    assert app.claim_next_job("a:1") == "queued-0"
+    assert app.claim_next_job("b:1") == "queued-1"
+    assert app.claim_next_job("a:1") is None
+
+    assert app.recover_stale_jobs() == 2
+    db.session.expire_all()
+    assert db.session.get(Job, "stale").status == JobStatus.QUEUED
+    assert db.session.get(Job, "exhausted").status == JobStatus.FAILED
+    assert db.session.get(Job, "alive").status == JobStatus.PROCESSING
+    claimed = db.session.get(Job, "queued-0")
+    assert (claimed.status, claimed.lease_owner, claimed.attempts) == (JobStatus.PROCESSING, "a:1", 1)
+
+    assert app.claim_next_job("b:1") == "stale"
+    db.session.expire_all()
+    assert db.session.get(Job, "stale").attempts == 2
+
+
+def test_batch_pool_claims_only_its_own_jobs(client):
+    client.post("/api/profile", json={"displayName": "tester"})
+    user_id = app.User.query.first().id
+    now = app.utc_now()
+    db.session.add(Job(id="upload", user_id=user_id, status=JobStatus.QUEUED, created_at=now))
+    db.session.add(Job(id="batched", user_id=user_id, status=JobStatus.QUEUED, batch_id="batch-1",
+                       created_at=now + app.timedelta(seconds=1)))
+    db.session.commit()
+
+    assert app.claim_next_job("cli:1", "batch-1") == "batched"
+    assert app.claim_next_job("cli:1", "batch-1") is None
+    assert app.claim_next_job("web:1") == "upload"
+
+
+def test_worker_pool_starts_with_the_web_server_only(monkeypatch):
+    import click
+
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_SYNC", False)
+    monkeypatch.setitem(app.app.config, "TESTING", False)
+    monkeypatch.delenv("WERKZEUG_RUN_MAIN", raising=False)
+    monkeypatch.delenv("FLASK_DEBUG", raising=False)
+
+    def serves(command, **params):
+        ctx = click.Context(click.Command(command), info_name=command)
+        ctx.params.update(params)
+        with ctx:
+            return app.serves_web_requests()
+
+    assert app.serves_web_requests()  # WSGI server import
+    assert serves("run", reload=False)
+    assert not serves("run", reload=True)  # the reloader's watcher
+    assert not serves("worker")
+    assert not serves("convert-dir")
+    monkeypatch.setenv("WERKZEUG_RUN_MAIN", "true")
+    assert serves("run", reload=True)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_SYNC", True)
+    assert not app.serves_web_requests()
+
+
+def test_result_dropped_after_lease_taken_over(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, "TESTING", False)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_SYNC", False)
+    monkeypatch.setattr(app, "enqueue_job", lambda job_id: None)
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "lease.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    job_id = resp.get_json()["job"]["id"]
+    assert app.claim_next_job("slow:1") == job_id
+    with app.app.app_context():
+        engine = db.engine
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        # The lease lapses mid-render and another worker re-claims the job.
+        with engine.begin() as conn:
+            conn.execute(app.update(Job).where(Job.id == job_id).values(lease_owner="fast:1"))
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+    app.process_job(job_id, lease_owner="slow:1")
+
+    db.session.expire_all()
+    job = db.session.get(Job, job_id)
+    assert (job.status, job.lease_owner) == (JobStatus.PROCESSING, "fast:1")
+    assert app.JobStage.query.filter(app.JobStage.job_id == job_id, app.JobStage.stage != "upload").count() == 0
+
+
+def test_scheduler_interleaves_users_by_priority_and_size(client, monkeypatch):
+    client.post("/api/profile", json={"displayName": "tester"})
+    heavy = app.User.query.first().id
+    db.session.add(app.User(id="light"))
+    now = app.utc_now()
+    mb = 1024 * 1024
+    for index in range(3):
+        db.session.add(Job(id=f"heavy-{index}", user_id=heavy, status=JobStatus.QUEUED, size_bytes=mb,
+                           created_at=now + app.timedelta(seconds=index)))
+    db.session.add(Job(id="light-big", user_id="light", status=JobStatus.QUEUED, size_bytes=80 * mb,
+                       created_at=now + app.timedelta(seconds=10)))
+    db.session.add(Job(id="light-small", user_id="light", status=JobStatus.QUEUED, size_bytes=mb,
+                       created_at=now + app.timedelta(seconds=11)))
+    db.session.add(Job(id="light-bulk", user_id="light", status=JobStatus.QUEUED, size_bytes=mb,
+                       priority=app.JobPriority.BULK, created_at=now))
+    db.session.add(Job(id="old-bulk", user_id="light", status=JobStatus.QUEUED, size_bytes=80 * mb,
+                       priority=app.JobPriority.BULK, created_at=now - app.timedelta(hours=1)))
+    db.session.commit()
+
+    order = db.session.execute(app.scheduled_queue()).scalars().all()
+    assert order == ["old-bulk", "heavy-0", "heavy-1", "light-small", "heavy-2", "light-big", "light-bulk"]
+
+    db.session.add(Job(id="done", user_id="light", status=JobStatus.COMPLETED, service_seconds=30.0,
+                       completed_at=now))
+    db.session.commit()
+    app.app.config["EPUB_PDF_WORKERS"], workers = 2, app.app.config["EPUB_PDF_WORKERS"]
+    try:
+        payload = client.get("/api/jobs?status=queued").get_json()
+    finally:
+        app.app.config["EPUB_PDF_WORKERS"] = workers
+    jobs = {job["id"]: job for job in payload["jobs"]}
+    assert (jobs["heavy-0"]["queuePosition"], jobs["heavy-0"]["etaSeconds"]) == (2, 30.0)
+    assert (jobs["heavy-2"]["queuePosition"], jobs["heavy-2"]["etaSeconds"]) == (5, 90.0)
+    assert jobs["heavy-2"]["priority"] == "interactive"
+
+    computed = []
+    original = app.compute_queue_estimates
+    monkeypatch.setattr(app, "compute_queue_estimates", lambda: computed.append(1) or original())
+    for _ in range(3):
+        client.get("/api/jobs?status=queued")
+    # Unchanged queue: every request reuses the estimates computed above.
+    assert computed == []
+    db.session.add(Job(id="late", user_id="light", status=JobStatus.QUEUED, size_bytes=mb))
+    db.session.commit()
+    client.get("/api/jobs?status=queued")
+    client.get("/api/jobs?status=queued")
+    assert computed == [1]
+
+    assert app.claim_next_job("a:1") == "old-bulk"
+    db.session.expire_all()
+    # "light" now has a job rendering, so "heavy" gets the next turn.
+    assert db.session.execute(app.scheduled_queue()).scalars().first() == "heavy-0"
+
+
+def test_supervisor_kills_worker_stuck_on_canceled_job(client, monkeypatch):
+    import multiprocessing
+    import time
+    from types import SimpleNamespace
+
+    client.post("/api/profile", json={"displayName": "tester"})
+    user_id = app.User.query.first().id
+    db.session.add(Job(id="stuck", user_id=user_id, status=JobStatus.PROCESSING))
+    db.session.commit()
+
+    stuck = multiprocessing.get_context("fork").Process(target=time.sleep, args=(60,))
+    stuck.start()
+    pool = app.WorkerPool(1)
+    pool._workers = [app._WorkerHandle(stuck, SimpleNamespace(value=b"stuck"))]
+    replacement = app._WorkerHandle(None, SimpleNamespace(value=b""))
+    monkeypatch.setattr(pool, "_spawn", lambda: replacement)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CANCEL_GRACE_SECONDS", 0)
+
+    pool._reap_canceled()
+    assert stuck.is_alive()
+
+    db.session.get(Job, "stuck").status = JobStatus.CANCELED
+    db.session.commit()
+    pool._reap_canceled()
+    assert not stuck.is_alive()
+    assert pool._workers == [replacement]
+
+
+def test_watchdog_enforces_job_and_stage_limits(monkeypatch):
+    import time
+    from types import SimpleNamespace
+
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_JOB_TIMEOUT_SECONDS", 600)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_STAGE_TIMEOUTS", {"pdf": 60})
+    pool = app.WorkerPool(1)
+    now = time.time()
+    worker = app._WorkerHandle(
+        SimpleNamespace(pid=os.getpid()),
+        SimpleNamespace(value=b"job"),
+        SimpleNamespace(value=b"pdf"),
+        [now - 30, now - 30],
+    )
+    assert pool._limit_exceeded(worker) is None
+
+    worker.clock[1] = now - 61
+    assert "pdf" in pool._limit_exceeded(worker)
+
+    worker.current_stage.value = b"goto"
+    assert pool._limit_exceeded(worker) is None
+    worker.clock[0] = now - 601
+    assert "600" in pool._limit_exceeded(worker)
+
+
+def test_goto_and_readiness_share_one_deadline(monkeypatch):
+    import contextlib
+    from types import SimpleNamespace
+
+    clock = [1000.0]
+    waits = []
+
+    class FakePage:
+        def route(self, pattern, handler):
+            pass
+
+        def goto(self, url, wait_until, timeout):
+            clock[0] += 40  # navigation used most of the budget
+
+        def evaluate(self, script, timeout_ms):
+            waits.append(timeout_ms)
+            return True
+
+        def add_style_tag(self, content):
+            pass
+
+        def pdf(self, **options):
+            return app._stub_pdf()
+
+    monkeypatch.delenv("EPUB_PDF_TEST_MODE")
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(app, "get_browser_pool", lambda: SimpleNamespace(page=lambda recorder: contextlib.nullcontext(FakePage())))
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_STAGE_TIMEOUTS", {"goto": 50})
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_READY_TIMEOUT_SECONDS", 30)
+
+    with app.app.app_context():
+        app.render_pdf_with_chromium("<p>x</p>", "A4", 15)
+    # 0.9 * 50 s stage limit minus the 40 s spent navigating.
+    assert waits == [5000]
+
+
+def test_limit_hit_retries_once_with_degraded_profile(client, monkeypatch):
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(4)]
+    calls = []
+
+    def flaky_render(html, page_size, margin_mm, resources=None, recorder=None):
+        calls.append(html)
+        if len(calls) == 1:
+            raise app.PlaywrightTimeoutError("Timeout 162000ms exceeded.")
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", flaky_render)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 0)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_DEGRADED_CHUNK_KB", 1)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_FRAGMENT_CACHE_MAX_MB", 0)
+
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_multi_chapter_epub_bytes(chapters)), "heavy.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    job = db.session.get(Job, resp.get_json()["job"]["id"])
+    db.session.refresh(job)
+    assert job.status == JobStatus.COMPLETED
+    assert job.degraded
+    # One whole-book attempt, then one chunk per chapter.
+    assert len(calls) == 1 + len(chapters)
+
+    job.status = JobStatus.PROCESSING
+    db.session.commit()
+    app.retry_degraded_or_fail(job.id, "转换超时")
+    db.session.expire_all()
+    assert db.session.get(Job, job.id).status == JobStatus.FAILED
+
+
+def test_process_tree_rss_reports_current_process():
+    if not Path("/proc").exists():
+        pytest.skip("requires /proc")
+    assert app._process_tree_rss(os.getpid()) > 0
+
+
+def test_benchmark_peak_rss_counts_child_processes():
+    import subprocess
+    import sys
+
+    import bench
+
+    if not Path("/proc").exists():
+        pytest.skip("requires /proc")
+    with bench.PeakRss(interval=0.01) as quiet:
+        pass
+    child = subprocess.Popen([sys.executable, "-c", "import time; data = b'x' * (64 * 2**20); time.sleep(1)"])
+    with bench.PeakRss(interval=0.01) as busy:
+        child.wait()
+    assert busy.peak > quiet.peak + 48 * 2**20
+    # A later scenario does not inherit the earlier peak.
+    with bench.PeakRss(interval=0.01) as after:
+        pass
+    assert after.peak < busy.peak
+
+
+def test_cache_hit_across_names_and_users(client):
+    epub_bytes = build_epub_bytes()
+    first = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(epub_bytes), "original.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert first.status_code == 202
+    first_job = db.session.get(Job, first.get_json()["job"]["id"])
+
+    with app.app.test_client() as other_client:
+        renamed = other_client.post(
+            "/api/jobs",
+            data={"file": (io.BytesIO(epub_bytes), "renamed.epub"), "pageSize": "A4", "margin": "15"},
+            content_type="multipart/form-data",
+        )
+    assert renamed.status_code == 200
+    payload = renamed.get_json()
+    assert payload["skipped"] is True
+    assert payload["job"]["id"] != first_job.id
+    assert payload["job"]["status"] == JobStatus.COMPLETED
+
+    entry = db.session.get(app.ConversionCache, first_job.cache_key)
+    assert entry.ref_count == 2
+    assert db.session.get(Job, payload["job"]["id"]).pdf_filename == entry.pdf_filename
+
+
+def test_same_name_different_content_is_converted(client):
+    first = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "same.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert first.status_code == 202
+
+    second = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_dir_epub_bytes()), "same.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert second.status_code == 202
+    assert second.get_json().get("skipped") is None
+
+
+def test_unreferenced_cache_entries_evicted(client, monkeypatch):
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "evict.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    job = db.session.get(Job, resp.get_json()["job"]["id"])
+    pdf_path = job.pdf_path
+    cache_key = job.cache_key
+
+    assert client.delete(f"/api/jobs/{job.id}").status_code == 200
+    assert db.session.get(app.ConversionCache, cache_key).ref_count == 0
+    assert pdf_path.exists()
+
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CACHE_MAX_MB", 0)
+    app.evict_conversion_cache()
+    db.session.expire_all()
+    assert db.session.get(app.ConversionCache, cache_key) is None
+    assert not pdf_path.exists()
+
+
+def test_reupload_under_another_name_shares_one_cached_pdf(client, monkeypatch):
+    epub_bytes = build_epub_bytes()
+    jobs = []
+    for name in ("a.epub", "b.epub"):
+        resp = client.post(
+            "/api/jobs",
+            data={"file": (io.BytesIO(epub_bytes), name), "pageSize": "A4", "margin": "15", "force": "1"},
+            content_type="multipart/form-data",
+        )
+        assert resp.status_code == 202
+        jobs.append(db.session.get(Job, resp.get_json()["job"]["id"]))
+    assert jobs[0].pdf_filename == jobs[1].pdf_filename == f"a_{jobs[0].cache_key[:12]}.pdf"
+    assert len(list(app.OUTPUT_DIR.glob("*.pdf"))) == 1
+    download = client.get(f"/api/jobs/{jobs[1].id}/download")
+    assert 'filename=b.pdf' in download.headers["Content-Disposition"]
+
+    cache_key = jobs[0].cache_key
+    assert db.session.get(app.ConversionCache, cache_key).ref_count == 2
+    for job in jobs:
+        assert client.delete(f"/api/jobs/{job.id}").status_code == 200
+    assert db.session.get(app.ConversionCache, cache_key).ref_count == 0
+
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CACHE_MAX_MB", 0)
+    app.evict_conversion_cache()
+    db.session.expire_all()
+    assert db.session.get(app.ConversionCache, cache_key) is None
+    assert list(app.OUTPUT_DIR.glob("*.pdf")) == []
+
+
+def test_wellformed_upload_skips_archive_repair(client, monkeypatch):
+    def fail_repair(path):
+        raise AssertionError("well-formed uploads must not be re-read")
+
+    monkeypatch.setattr(app, "ensure_epub_archive", fail_repair)
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "fast.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 202
+    job = db.session.get(Job, resp.get_json()["job"]["id"])
+    assert job.size_bytes == len(build_epub_bytes())
+    assert list((app.STORAGE_DIR / "incoming").iterdir()) == []
+
+
+def test_central_directory_check_matches_zipfile():
+    epub_bytes = build_epub_bytes()
+    assert app._central_directory_is_epub(epub_bytes[:256], epub_bytes, len(epub_bytes))
+    for payload in (build_invalid_epub_bytes(), build_dir_epub_bytes(), build_nested_epub_bytes()):
+        assert not app._central_directory_is_epub(payload[:256], payload, len(payload))
+
+
+class FakeRoute:
+    def __init__(self, url):
+        self.request = type("FakeRequest", (), {"url": url})()
+        self.fulfilled = None
+
+    def fulfill(self, **kwargs):
+        self.fulfilled = kwargs
+
+
+def test_book_resources_served_from_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STORAGE_DIR", tmp_path / "storage", raising=False)
+    source = tmp_path / "book.epub"
+    source.write_bytes(build_epub_bytes())
+
+    def no_extract(*args, **kwargs):
+        raise AssertionError("archive must not be extracted")
+
+    monkeypatch.setattr(zipfile.ZipFile, "extractall", no_extract)
+    app.convert_to_pdf(source, tmp_path / "book.pdf", {"pageSize": "A4", "marginMm": 15})
+    assert (tmp_path / "book.pdf").read_bytes().startswith(b"%PDF")
+
+    with zipfile.ZipFile(source) as archive:
+        resources = app.ZipResources(archive)
+        css_route = FakeRoute(app.BOOK_ORIGIN + "oebps/styles/style.css")
+        app.serve_book_request(css_route, "<html></html>", resources)
+        assert css_route.fulfilled["status"] == 200
+        assert css_route.fulfilled["content_type"] == "text/css"
+        assert b"#2563eb" in css_route.fulfilled["body"]
+
+        page_route = FakeRoute(app.BOOK_ORIGIN + app.BOOK_DOCUMENT)
+        app.serve_book_request(page_route, "<html></html>", resources)
+        assert page_route.fulfilled["body"] == "<html></html>"
+
+        missing_route = FakeRoute(app.BOOK_ORIGIN + "OEBPS/Images/missing%20cover.png")
+        app.serve_book_request(missing_route, "<html></html>", resources)
+        assert missing_route.fulfilled["status"] == 404
+
+
+def test_epub_package_reads_spine_lazily():
+    with zipfile.ZipFile(io.BytesIO(build_epub_bytes())) as archive:
+        package = app.EpubPackage(archive)
+        assert package.opf_path == "OEBPS/content.opf"
+        assert [item.href for item in package.spine()] == ["OEBPS/Text/ch1.xhtml"]
+        assert [item.href for item in package.documents()] == ["OEBPS/Text/ch1.xhtml"]
+        assert [item.href for item in package.stylesheets()] == ["OEBPS/Styles/style.css"]
+
+        html = app.assemble_html(package, app.BOOK_ORIGIN)
+    assert "第一章 起航" in html
+    assert "#2563eb" in html
+    assert f'<base href="{app.BOOK_ORIGIN}">' in html
+
+
+def test_document_links_rewritten_in_one_pass():
+    content = (
+        "<?xml version='1.0' encoding='gb18030'?>\n"
+        "<html xmlns='http://www.w3.org/1999/xhtml'><head><title>t</title></head>"
+        "<body class='c'><p>中文<img src='../Images/a.png'/><a href='ch2.xhtml#n'>注</a></p>"
+        "<img src=''/></body></html>"
+    ).encode("gb18030")
+    body = epub_text.rewrite_document_body(content, app.PurePosixPath("OEBPS/Text"))
+    assert body.startswith("<body class=\"c\">") and body.endswith("</body>")
+    assert 'src="OEBPS/Text/../Images/a.png"' in body
+    assert 'href="OEBPS/Text/ch2.xhtml#n"' in body
+    assert "中文" in body and "<title>" not in body
+    assert epub_text.rewrite_document_body(b"  ", app.PurePosixPath("")) == ""
+
+
+def test_decode_bytes_sniffs_declared_charset():
+    text = "<p>日本語のテキスト</p>"
+    assert epub_text.decode_bytes(("<meta charset='shift_jis'>" + text).encode("shift_jis")).endswith(text)
+    assert epub_text.decode_bytes(text.encode("utf-16")) == text
+    assert epub_text.decode_bytes(b"\xef\xbb\xbf" + text.encode("utf-8")) == text
+    assert epub_text.decode_bytes(("@charset \"gbk\";\n" + "中文").encode("gbk")).endswith("中文")
+    assert epub_text.decode_bytes("中文".encode("gb18030")) == "中文"
+    # A wrong declaration falls back to the usual guesses.
+    assert epub_text.decode_bytes(("<?xml version='1.0' encoding='bogus'?>" + "中文").encode("utf-8")).endswith("中文")
+
+
+def test_chunked_render_merges_in_spine_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STORAGE_DIR", tmp_path / "storage", raising=False)
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(3)]
+    source = tmp_path / "long.epub"
+    source.write_bytes(build_multi_chapter_epub_bytes(chapters))
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        writer = PdfWriter()
+        for index in range(3):
+            if f"Chapter {index}" in html:
+                writer.add_blank_page(width=100 + index, height=100)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return buffer.getvalue()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 1)
+    app.convert_to_pdf(source, tmp_path / "long.pdf", {"pageSize": "A4", "marginMm": 15})
+
+    reader = PdfReader(str(tmp_path / "long.pdf"))
+    assert [float(page.mediabox.width) for page in reader.pages] == [100, 101, 102]
+
+
+def test_cancel_stops_rendering_between_chunks(client, monkeypatch):
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(6)]
+    rendered = []
+    with app.app.app_context():
+        engine = db.engine
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        with recorder.stage("goto"):
+            rendered.append(html)
+            if len(rendered) == 1:
+                with engine.begin() as conn:
+                    conn.execute(app.update(Job).values(status=JobStatus.CANCELED))
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 1)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_RENDER_THREADS", 1)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CANCEL_CHECK_SECONDS", 0)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_FRAGMENT_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(app, "_render_executor", None)
+
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_multi_chapter_epub_bytes(chapters)), "cancel.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    job = db.session.get(Job, resp.get_json()["job"]["id"])
+    db.session.refresh(job)
+    assert job.status == JobStatus.CANCELED
+    assert job.error_message == "任务已取消"
+    assert len(rendered) == 1
+    assert not job.pdf_path.exists()
+
+
+def test_job_deleted_while_rendering_is_dropped(client, monkeypatch):
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(4)]
+    rendered = []
+    with app.app.app_context():
+        engine = db.engine
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        with recorder.stage("goto"):
+            rendered.append(html)
+            if len(rendered) == 1:
+                # What "clear all" does to a job that is still processing.
+                with engine.begin() as conn:
+                    conn.execute(app.JobStage.__table__.delete())
+                    conn.execute(Job.__table__.delete())
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 1)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_RENDER_THREADS", 1)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CANCEL_CHECK_SECONDS", 0)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_FRAGMENT_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(app, "_render_executor", None)
+
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_multi_chapter_epub_bytes(chapters)), "gone.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 202
+    assert len(rendered) == 1
+    db.session.expire_all()
+    assert Job.query.count() == 0
+    assert app.JobStage.query.count() == 0
+    assert list(app.OUTPUT_DIR.glob("*.pdf")) == []
+
+
+def test_fragment_cache_rerenders_only_changed_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STORAGE_DIR", tmp_path / "storage", raising=False)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 1)
+    rendered = []
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        rendered.append(html)
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(3)]
+    source = tmp_path / "book.epub"
+    settings = {"pageSize": "A4", "marginMm": 15}
+    source.write_bytes(build_multi_chapter_epub_bytes(chapters))
+    app.convert_to_pdf(source, tmp_path / "first.pdf", settings)
+    assert len(rendered) == 3
+
+    rendered.clear()
+    app.convert_to_pdf(source, tmp_path / "retry.pdf", settings)
+    assert rendered == []
+
+    chapters[1] = f"<h1>Chapter 1 (revised)</h1><p>{'y' * 900}</p>"
+    source.write_bytes(build_multi_chapter_epub_bytes(chapters))
+    app.convert_to_pdf(source, tmp_path / "revised.pdf", settings)
+    assert len(rendered) == 1 and "revised" in rendered[0]
+    assert len(PdfReader(str(tmp_path / "revised.pdf")).pages) == 3
+
+
+def test_editing_a_chapter_rerenders_only_its_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STORAGE_DIR", tmp_path / "storage", raising=False)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_MAX_KB", 8)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_CHUNK_DOCUMENTS", 2)
+    rendered = []
+
+    def fake_render(html, page_size, margin_mm, resources=None, recorder=None):
+        rendered.append(html)
+        return app._stub_pdf()
+
+    monkeypatch.setattr(app, "render_pdf_with_chromium", fake_render)
+
+    chapters = [f"<h1>Chapter {index}</h1><p>{'x' * 900}</p>" for index in range(8)]
+    source = tmp_path / "book.epub"
+    settings = {"pageSize": "A4", "marginMm": 15}
+    source.write_bytes(build_multi_chapter_epub_bytes(chapters))
+    app.convert_to_pdf(source, tmp_path / "first.pdf", settings)
+    assert len(rendered) == 4
+
+    rendered.clear()
+    chapters[0] += f"<p>{'y' * 900}</p>"
+    source.write_bytes(build_multi_chapter_epub_bytes(chapters))
+    app.convert_to_pdf(source, tmp_path / "edited.pdf", settings)
+    assert len(rendered) == 1
+    assert "Chapter 0" in rendered[0] and "Chapter 1" in rendered[0] and "Chapter 2" not in rendered[0]
+
+
+def test_stage_metrics_recorded_and_exported(client):
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "metrics.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    job_id = resp.get_json()["job"]["id"]
+
+    stages = client.get(f"/api/jobs/{job_id}/stages").get_json()["stages"]
+    names = {stage["stage"] for stage in stages}
+    assert {"upload", "package", "assemble", "write"} <= names
+    upload = next(stage for stage in stages if stage["stage"] == "upload")
+    assert upload["bytes"] == len(build_epub_bytes())
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    body = metrics.get_data(as_text=True)
+    assert 'epub_pdf_stage_seconds_bucket{stage="assemble",le="+Inf"}' in body
+    assert 'epub_pdf_stage_seconds_count{stage="upload"}' in body
+    assert 'epub_pdf_jobs{status="completed"}' in body
+
+
+def test_metrics_read_running_totals_not_stage_history(client):
+    def scrape():
+        body = client.get("/metrics").get_data(as_text=True)
+        return {
+            line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in body.splitlines()
+            if line.startswith("epub_pdf_stage_") and "_sum{" not in line
+        }
+
+    def upload(name):
+        client.post(
+            "/api/jobs",
+            data={"file": (io.BytesIO(build_epub_bytes()), name), "pageSize": "A4", "margin": "15", "force": "1"},
+            content_type="multipart/form-data",
+        )
+
+    with app.app.app_context(), db.engine.begin() as conn:
+        conn.execute(app.JobStage.__table__.delete())
+        conn.execute(app.StageHistogram.__table__.delete())
+    upload("first.epub")
+    before = scrape()
+    upload("second.epub")
+    after = scrape()
+    assert after['epub_pdf_stage_seconds_count{stage="upload"}'] == before['epub_pdf_stage_seconds_count{stage="upload"}'] + 1
+    assert after['epub_pdf_stage_bytes_total{stage="upload"}'] == (
+        before['epub_pdf_stage_bytes_total{stage="upload"}'] + len(build_epub_bytes())
+    )
+    # Buckets are cumulative and end at the count.
+    buckets = [value for key, value in after.items() if key.startswith('epub_pdf_stage_seconds_bucket{stage="upload"')]
+    assert buckets == sorted(buckets) and buckets[-1] == after['epub_pdf_stage_seconds_count{stage="upload"}']
+
+    # A database from before the rollup existed gets its history rolled up once.
+    with app.app.app_context():
+        app.StageHistogram.__table__.drop(db.engine)
+        app.ensure_schema()
+    assert scrape() == after
+
+
+def test_synthetic_benchmark_book_is_valid(tmp_path):
+    import bench
+
+    epub_bytes = bench.build_synthetic_epub(chapters=4, paragraphs=2, script="cjk", images=2, image_px=16)
+    path = tmp_path / "synthetic.epub"
+    path.write_bytes(epub_bytes)
+    assert app.is_epub_archive(path)
+
+    with zipfile.ZipFile(path) as archive:
+        package = app.EpubPackage(archive)
+        assert len(package.spine()) == 4
+        html = app.assemble_html(package, app.BOOK_ORIGIN)
+    assert html.count("<img") == 2
+
+
+def build_styled_epub_bytes() -> bytes:
+    shared = ".note { color: red; }\n.unused-a, p.lead { margin: 0; }\n"
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            "<container xmlns='urn:oasis:names:tc:opendocument:xmlns:container'><rootfiles>"
+            "<rootfile full-path='OEBPS/content.opf' media-type='application/oebps-package+xml'/></rootfiles></container>",
+        )
+        zf.writestr(
+            "OEBPS/content.opf",
+            "<package xmlns='http://www.idpf.org/2007/opf' version='2.0'><manifest>"
+            "<item id='a' href='Styles/a.css' media-type='text/css'/>"
+            "<item id='b' href='Styles/b.css' media-type='text/css'/>"
+            "<item id='copy' href='Styles/copy.css' media-type='text/css'/>"
+            "<item id='ch1' href='Text/ch1.xhtml' media-type='application/xhtml+xml'/>"
+            "</manifest><spine><itemref idref='ch1'/></spine></package>",
+        )
+        zf.writestr("OEBPS/Styles/a.css", "@charset \"utf-8\";\n@import url('base.css') print;\n" + shared)
+        zf.writestr("OEBPS/Styles/b.css", "#missing { x: 1 }\n@media screen { .gone { x: 2 } h1:not(.gone) { x: 3 } }\n"
+                    "@font-face { font-family: f; src: url(../Fonts/f.ttf); }\n/* a { } */ a[href]:hover::after { content: '}' }\n")
+        zf.writestr("OEBPS/Styles/copy.css", "@charset \"utf-8\";\n@import url('base.css') print;\n" + shared)
+        zf.writestr("OEBPS/Styles/base.css", "body { background: url('../Images/bg.png'); }\n@import 'a.css';\n")
+        zf.writestr(
+            "OEBPS/Text/ch1.xhtml",
+            "<html xmlns='http://www.w3.org/1999/xhtml'><body><h1 id='top'>T</h1>"
+            "<p class='Note lead'>x</p><a href='#top'>up</a></body></html>",
+        )
+    return buffer.getvalue()
+
+
+def test_stylesheets_deduplicated_inlined_and_pruned():
+    with zipfile.ZipFile(io.BytesIO(build_styled_epub_bytes())) as archive:
+        package = app.EpubPackage(archive)
+        css, stats = app.build_stylesheet(package)
+        unpruned, _ = app.build_stylesheet(package, prune=False)
+
+    # copy.css repeats a.css; base.css is imported twice under print and its import of a.css is a cycle.
+    assert (stats.sheets, stats.duplicates, stats.imports) == (3, 2, 3)
+    assert css.count(".note") == 2 and css.count("@media print") == 2
+    assert "@charset" not in css and "@import" not in css
+    assert css.index("h1:not(.gone)") < css.index(".note")
+    assert '@media print {\nbody { background: url("OEBPS/Styles/../Images/bg.png"); }' in css
+    assert 'url("OEBPS/Styles/../Fonts/f.ttf")' in css
+    assert "p.lead {" in css and ".unused-a" not in css
+    assert "#missing" not in css and ".gone {" not in css
+    assert "h1:not(.gone)" in css and "a[href]:hover::after" in css
+    assert "/* a { } */" not in css
+    assert (stats.rules, stats.rules_removed) == (9, 2)
+    assert stats.bytes_out < stats.bytes_in
+    assert ".unused-a" in unpruned
+
+
+def test_selector_pruning_is_conservative():
+    used = app.DocumentTokens({"html", "body", "p", "div", "svg"}, {"x"}, {"main"})
+    keep = ["p", "div > p.x", "#main p", "*", ".x:not(.y)", "p:nth-child(2n+1)", "[data-y] p", "svg|rect", ".\\31 0", "html body"]
+    drop = ["h2", "p.y", "#other", "div .y:hover", "table p"]
+    assert all(app.selector_may_match(selector, used) for selector in keep)
+    assert not any(app.selector_may_match(selector, used) for selector in drop)
+
+
+def build_illustrated_epub_bytes() -> bytes:
+    from PIL import Image
+
+    def encode(image, fmt, **options) -> bytes:
+        out = io.BytesIO()
+        image.save(out, fmt, **options)
+        return out.getvalue()
+
+    photo = Image.linear_gradient("L").resize((3000, 2000)).convert("RGB")
+    images = {
+        "scan.jpg": ("image/jpeg", encode(photo, "JPEG", quality=95)),
+        "plate.tif": ("image/tiff", encode(photo.resize((400, 300)), "TIFF")),
+        "icon.png": ("image/png", encode(Image.new("RGBA", (16, 16), (255, 0, 0, 128)), "PNG")),
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            "<container xmlns='urn:oasis:names:tc:opendocument:xmlns:container'><rootfiles>"
+            "<rootfile full-path='OEBPS/content.opf' media-type='application/oebps-package+xml'/></rootfiles></container>",
+        )
+        manifest = "".join(
+            f"<item id='i{index}' href='Images/{name}' media-type='{media_type}'/>"
+            for index, (name, (media_type, _)) in enumerate(images.items())
+        )
+        zf.writestr(
+            "OEBPS/content.opf",
+            "<package xmlns='http://www.idpf.org/2007/opf' version='2.0'><manifest>"
+            f"{manifest}<item id='ch1' href='Text/ch1.xhtml' media-type='application/xhtml+xml'/>"
+            "</manifest><spine><itemref idref='ch1'/></spine></package>",
+        )
+        for name, (_, data) in images.items():
+            zf.writestr(f"OEBPS/Images/{name}", data)
+        zf.writestr("OEBPS/Text/ch1.xhtml", "<html><body><img src='../Images/scan.jpg'/></body></html>")
+    return buffer.getvalue()
+
+
+def test_images_downsampled_for_the_page_and_cached(client, monkeypatch):
+    from PIL import Image
+
+    epub_bytes = build_illustrated_epub_bytes()
+    assert app.image_target_size("A4", 15, 96) == (680, 1009)
+    assert app.parse_settings({"imageQuality": "compact"})["imageQuality"] == "compact"
+    assert app.parse_settings({"imageQuality": "bogus"})["imageQuality"] == "original"
+
+    calls = []
+    original = app.optimize_image
+    monkeypatch.setattr(app, "optimize_image", lambda *args: calls.append(args) or original(*args))
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as archive:
+        package = app.EpubPackage(archive)
+        assert app.optimize_book_images(package, "A4", 15, app.IMAGE_PROFILES["original"]) == {}
+        images = app.optimize_book_images(package, "A4", 15, app.IMAGE_PROFILES["compact"])
+        again = app.optimize_book_images(package, "A4", 15, app.IMAGE_PROFILES["compact"])
+        resources = app.OptimizedResources(package, images)
+
+        assert set(images) == {"OEBPS/Images/scan.jpg", "OEBPS/Images/plate.tif"}
+        scan, content_type = images["OEBPS/Images/scan.jpg"]
+        assert content_type == "image/jpeg" and len(scan) < len(package.read("OEBPS/Images/scan.jpg"))
+        assert Image.open(io.BytesIO(scan)).size == (680, 453)
+        # TIFF is not displayable by Chromium and is converted even though it fits.
+        assert resources.content_type("OEBPS/Images/plate.tif") == "image/jpeg"
+        assert resources.read("OEBPS/Images/icon.png") == package.read("OEBPS/Images/icon.png")
+        assert resources.content_type("OEBPS/Images/icon.png") == "image/png"
+    assert again == images
+    assert len(calls) == 3
+
+
+def test_extracted_image_overrides_stay_inside_the_temp_dir(tmp_path, monkeypatch):
+    from PIL import Image
+
+    victim = tmp_path / "victim.jpg"
+    victim.write_bytes(b"keep me")
+    photo = io.BytesIO()
+    Image.linear_gradient("L").resize((3000, 2000)).convert("RGB").save(photo, "JPEG")
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            "<container xmlns='urn:oasis:names:tc:opendocument:xmlns:container'><rootfiles>"
+            "<rootfile full-path='content.opf' media-type='application/oebps-package+xml'/></rootfiles></container>",
+        )
+        zf.writestr(
+            "content.opf",
+            "<package xmlns='http://www.idpf.org/2007/opf' version='2.0'><manifest>"
+            f"<item id='img' href='{victim}' media-type='image/jpeg'/>"
+            "<item id='ch1' href='ch1.xhtml' media-type='application/xhtml+xml'/>"
+            "</manifest><spine><itemref idref='ch1'/></spine></package>",
+        )
+        zf.writestr(str(victim).lstrip("/"), photo.getvalue())
+        zf.writestr("ch1.xhtml", "<html><body><p>x</p></body></html>")
+    source = tmp_path / "book.epub"
+    source.write_bytes(buffer.getvalue())
+    monkeypatch.setattr(app, "STORAGE_DIR", tmp_path / "storage")
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_RESOURCE_MODE", "extract")
+
+    with app.app.app_context():
+        app.convert_to_pdf(source, tmp_path / "out.pdf", {"imageQuality": "compact"})
+    assert victim.read_bytes() == b"keep me"
+    assert (tmp_path / "out.pdf").exists()
+
+
+def test_chapters_preprocessed_on_process_pool_in_spine_order(monkeypatch):
+    import bench
+
+    epub_bytes = bench.build_synthetic_epub(chapters=40, paragraphs=2, script="latin", images=3, image_px=16)
+    with zipfile.ZipFile(io.BytesIO(epub_bytes)) as archive:
+        package = app.EpubPackage(archive)
+        sequential = list(app.iter_document_bodies(package))
+
+        monkeypatch.setitem(app.app.config, "EPUB_PDF_PREPROCESS_WORKERS", 2)
+        monkeypatch.setitem(app.app.config, "EPUB_PDF_PREPROCESS_MIN_CHAPTERS", 10)
+        monkeypatch.setitem(app.app.config, "EPUB_PDF_PREPROCESS_MAX_IN_FLIGHT", 32)
+        submitted = []
+        executor = app.get_preprocess_executor()
+        original_submit = executor.submit
+        monkeypatch.setattr(executor, "submit", lambda fn, batch: submitted.append(len(batch)) or original_submit(fn, batch))
+        try:
+            bodies = app.iter_document_bodies(package)
+            first = next(bodies)
+            # Only MAX_IN_FLIGHT chapters are read ahead of the consumer.
+            assert sum(submitted) <= 32
+            parallel = [first] + list(bodies)
+        finally:
+            app.discard_preprocess_executor(executor)
+    assert parallel == sequential
+    assert submitted == [16, 16, 8]
+    # Children import only this side-effect-free module, never app and its database.
+    assert app.rewrite_document_batch.__module__ == "epub_text"
+
+
+def test_job_events_stream_only_changed_jobs(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_EVENTS_POLL_SECONDS", 0)
+    monkeypatch.setitem(app.app.config, "EPUB_PDF_EVENTS_STREAM_SECONDS", 0.05)
+    resp = client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "events.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 202
+    job = client.get("/api/jobs").get_json()["jobs"][0]
+    assert job["progress"] == "writing"
+
+    stream = client.get("/api/jobs/events?since=2000-01-01T00:00:00")
+    assert stream.headers["Content-Type"].startswith("text/event-stream")
+    body = stream.get_data(as_text=True)
+    assert body.count("event: job") == 1
+    assert f"id: {job['updatedAt']}" in body
+
+    quiet = client.get("/api/jobs/events", headers={"Last-Event-ID": job["updatedAt"]})
+    body = quiet.get_data(as_text=True)
+    assert "event: job" not in body
+    assert ": keep-alive" in body
+
+
+def test_jobs_listing_paginates_and_filters(client, monkeypatch):
+    for index in range(5):
+        client.post(
+            "/api/jobs",
+            data={"file": (io.BytesIO(build_epub_bytes()), f"page{index}.epub"), "pageSize": "A4", "margin": str(10 + index)},
+            content_type="multipart/form-data",
+        )
+    first = client.get("/api/jobs").get_json()["jobs"]
+    failed = db.session.get(Job, first[0]["id"])
+    failed.status = JobStatus.FAILED
+    failed.pdf_size_bytes = None
+    db.session.commit()
+
+    def no_stat(self):
+        raise AssertionError("listing must not touch the filesystem")
+
+    seen = []
+    cursor = None
+    with monkeypatch.context() as patch:
+        patch.setattr(Path, "exists", no_stat)
+        while True:
+            query = "/api/jobs?limit=2" + (f"&cursor={cursor}" if cursor else "")
+            page = client.get(query).get_json()
+            seen.extend(job["id"] for job in page["jobs"])
+            cursor = page["nextCursor"]
+            if not cursor:
+                break
+
+    assert seen == [job["id"] for job in first]
+    assert page["counts"]["completed"] == 4
+    assert page["counts"]["failed"] == 1
+
+    completed = client.get("/api/jobs?status=completed").get_json()["jobs"]
+    assert len(completed) == 4
+    assert all(job["downloadUrl"] and job["pdfSizeBytes"] for job in completed)
+    assert client.get("/api/jobs?status=bogus").status_code == 400
+
+    since = client.get(f"/api/jobs?updatedSince={first[1]['updatedAt']}").get_json()["jobs"]
+    assert [job["id"] for job in since] == [first[0]["id"]]
+
+
+def test_sqlite_connections_use_wal_and_busy_timeout(client):
+    with app.app.app_context(), db.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == app.app.config["EPUB_PDF_SQLITE_BUSY_TIMEOUT_MS"]
+
+
+def test_sqlite_only_options_skipped_for_server_databases():
+    assert app.engine_options("sqlite:///x.db")["connect_args"] == {"check_same_thread": False}
+    options = app.engine_options("postgresql://db.internal/epub_pdf")
+    assert "connect_args" not in options and options["pool_pre_ping"]
+
+
+def test_progress_writes_are_coalesced(client):
+    client.post("/api/profile", json={"displayName": "tester"})
+    user_id = app.User.query.first().id
+    db.session.add(Job(id="progress", user_id=user_id, status=JobStatus.PROCESSING))
+    db.session.commit()
+
+    reporter = app.ProgressReporter(db.engine, "progress", min_interval=60)
+    for stage in ("package", "assemble", "pdf", "pdf", "write"):
+        reporter(stage)
+    db.session.expire_all()
+    assert db.session.get(Job, "progress").last_progress == "parsing"
+    assert reporter.latest == "writing"
+
+
+def test_read_only_requests_do_not_create_users(client):
+    for path in ("/health", "/metrics", "/api/session", "/api/jobs", "/"):
+        assert client.get(path).status_code == 200
+    assert app.User.query.count() == 0
+    assert client.get("/api/session").get_json()["userId"] is None
+
+    client.post(
+        "/api/jobs",
+        data={"file": (io.BytesIO(build_epub_bytes()), "identity.epub"), "pageSize": "A4", "margin": "15"},
+        content_type="multipart/form-data",
+    )
+    assert app.User.query.count() == 1
+    session = client.get("/api/session").get_json()
+    assert session["userId"] == app.User.query.first().id
+    assert len(client.get("/api/jobs").get_json()["jobs"]) == 1
+
+
+def test_prune_users_keeps_users_with_jobs(client):
+    old = app.utc_now() - app.timedelta(days=90)
+    with app.app.app_context():
+        db.session.add_all([
+            app.User(id="idle-old", created_at=old),
+            app.User(id="idle-new"),
+            app.User(id="busy-old", created_at=old),
+        ])
+        db.session.add(Job(id="kept", user_id="busy-old", status=JobStatus.COMPLETED))
+        db.session.commit()
+
+        assert app.prune_users(app.timedelta(days=30)) == 1
+        assert {user.id for user in app.User.query.all()} == {"idle-new", "busy-old"}